@@ -5,6 +5,7 @@
 # See test and test1 for examples of what this looks like
 import sys
 import os
+import time
 
 import subprocess
 from select import select
@@ -32,13 +33,20 @@ class ProgramRunner:
     """
     This runs a program.
 
-    The exit status will be in .exitCode
+    The exit status will be in .exitCode and the peak resident memory of the
+    program, in bytes, in .maxRSS.  A program that runs longer than timeout
+    seconds is killed and has .timedOut set.  A program that cannot be
+    started has the exception in .error and an .exitCode of 127
     """
 
-    def __init__(self, cmd, stdoutf, stderrf, addEnv=None, env=None, log=False):
+    def __init__(self, cmd, stdoutf, stderrf, addEnv=None, env=None, log=False,
+                 timeout=None, preexec_fn=None, onDone=None):
         """
         addEnv takes the contents of addEnv and adds them to the current environment.  env only passes what is specified
         as the environment
+
+        cmd is run through the shell if it is a string, and directly if it is a list.
+        onDone is called with the runner once the program has exited
         """
         self.cmd = cmd
         self.stdoutf = stdoutf
@@ -46,7 +54,14 @@ class ProgramRunner:
         self.addEnv = addEnv
         self.env = env
         self.log = log
+        self.timeout = timeout
+        self.preexec_fn = preexec_fn
+        self.onDone = onDone
         self.exitCode = None
+        self.maxRSS = None
+        self.timedOut = False
+        self.deadline = None
+        self.error = None
 
     def __call__(self):
         """
@@ -68,17 +83,43 @@ class ProgramRunner:
             env = functional.updateDict(dict(self.env), self.addEnv)
             
         pipe = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                shell=True, env=env)
+                                shell=isinstance(self.cmd, basestring), env=env,
+                                preexec_fn=self.preexec_fn)
         self.pipe = pipe
+        if self.timeout:
+            self.deadline = time.time() + self.timeout
                                 
         return (self.onComplete, [(pipe.stdout, self.stdoutf), (pipe.stderr, self.stderrf)])
 
+    def kill(self):
+        """Kill the program, once it has run past its deadline"""
+        self.timedOut = True
+        try:
+            self.pipe.kill()
+        except OSError:
+            pass
+
+    def fail(self, error):
+        """Record that the program could not be started"""
+        self.error = error
+        self.exitCode = 127
+        if self.onDone:
+            self.onDone(self)
+
     def onComplete(self):
-        self.exitCode = self.pipe.wait()
+        _pid, status, usage = os.wait4(self.pipe.pid, 0)
+        if os.WIFSIGNALED(status):
+            self.pipe.returncode = -os.WTERMSIG(status)
+        else:
+            self.pipe.returncode = os.WEXITSTATUS(status)
+        self.exitCode = self.pipe.returncode
+        self.maxRSS = usage.ru_maxrss*1024
         
         self.pipe.stdout.close()
         self.pipe.stderr.close()
         #self.pipe.stdin.close()
+        if self.onDone:
+            self.onDone(self)
 
 
 
@@ -135,15 +176,20 @@ def runSystemEx(cmd, addEnv=None, env=None, log=False):
         
         
 def getStreams(state):
-    (_gen, (_oncomplete, streams)) = state
+    (_gen, (_oncomplete, streams, _runner)) = state
 
     return streams
 
 def getOnComplete(state):
-    (_gen, (onComplete, _streams)) = state
+    (_gen, (onComplete, _streams, _runner)) = state
 
     return onComplete
 
+def getRunner(state):
+    (_gen, (_oncomplete, _streams, runner)) = state
+
+    return runner
+
 def ctorGenerators(gens):
     """Construct the generators"""
 
@@ -160,7 +206,7 @@ def activeOutputStreams(states):
         if s:
             _, v = s
             if v:
-                _, streams = v
+                _, streams, _ = v
                 res.extend([(x, idx) for x in streams.keys()])
 
     return res
@@ -179,7 +225,7 @@ def nextIteration(states):
                 try:
                     runner = g.next()
                     onComplete, streams = runner()
-                    states[idx] = (g, (onComplete, dict(streams)))
+                    states[idx] = (g, (onComplete, dict(streams), runner))
                 except StopIteration:
                     # Turn this guy off if we are done
                     states[idx] = None
@@ -194,6 +240,39 @@ def callStreamF(stream, data, state):
     if streams[stream]:
         streams[stream](data)
 
+
+def readLines(stream, partial):
+    """
+    Read whatever is available on stream without blocking on a whole line.
+    partial maps each stream to the incomplete line read so far.  Returns the
+    complete lines read, and True once the stream is exhausted, in which case
+    the last incomplete line is returned as well
+    """
+    data = os.read(stream.fileno(), 65536)
+    if not data:
+        rest = partial.pop(stream, '')
+        return (rest and [rest] or []), True
+    lines = (partial.get(stream, '') + data).split('\n')
+    partial[stream] = lines.pop()
+    return [l + '\n' for l in lines], False
+
+
+def selectTimeout(runners):
+    """Seconds until the nearest deadline of the runners, None if they have none"""
+    deadlines = [getattr(r, 'deadline', None) for r in runners]
+    deadlines = [d for d in deadlines if d is not None]
+    if not deadlines:
+        return None
+    return max(0, min(deadlines) - time.time())
+
+
+def killExpired(runners):
+    """Kill the runners that are past their deadline"""
+    now = time.time()
+    for r in runners:
+        if getattr(r, 'deadline', None) is not None and now >= r.deadline and not getattr(r, 'timedOut', False):
+            r.kill()
+
     
 def removeStream(stream, state):
     streams = getStreams(state)
@@ -228,16 +307,19 @@ def runCommandGens(generators):
 
     outputStreams = dict(activeOutputStreams(states))
 
+    partial = {}
     while outputStreams:
-        input, _output, _error = select(outputStreams.keys(), [], [])
+        running = [getRunner(states[idx]) for idx in set(outputStreams.values())]
+        input, _output, _error = select(outputStreams.keys(), [], [], selectTimeout(running))
+        killExpired(running)
 
         iterateAndBuild = False
         for s in input:
-            line = s.readline()
-
-            if line:
+            lines, done = readLines(s, partial)
+            for line in lines:
                 callStreamF(s, line, states[outputStreams[s]])
-            else:
+
+            if done:
                 iterateAndBuild = True
                             
                 ##
@@ -260,6 +342,63 @@ def runCommandGens(generators):
             outputStreams = dict(activeOutputStreams(states))
                 
 
+def runProgramQueue(nextRunner, maxRunning):
+    """
+    Runs programs from this one thread, at most maxRunning at a time.
+
+    nextRunner() is called whenever there is room for another program.  It
+    returns a ProgramRunner, None if nothing can start until a running
+    program completes, or raises StopIteration once there is nothing left
+    to run.  Output is handed to each runner's stream functions a line at a
+    time, programs past their timeout are killed, and a runner's onDone is
+    called as soon as its program exits, so it can make more programs ready.
+    A program that cannot be started is marked failed with its fail method
+    and the others keep running
+    """
+    streamRunner = {}
+    remaining = {}
+    partial = {}
+    exhausted = False
+    while True:
+        while not exhausted and len(remaining) < maxRunning:
+            try:
+                runner = nextRunner()
+            except StopIteration:
+                exhausted = True
+                break
+            if runner is None:
+                break
+            try:
+                onComplete, streams = runner()
+            except Exception, err:
+                runner.fail(err)
+                continue
+            remaining[runner] = [onComplete, dict(streams)]
+            for stream, _f in streams:
+                streamRunner[stream] = runner
+
+        if not remaining:
+            if exhausted:
+                return
+            raise ValueError('no program is running and none can be started')
+
+        input, _output, _error = select(streamRunner.keys(), [], [], selectTimeout(remaining.keys()))
+        killExpired(remaining.keys())
+
+        for s in input:
+            runner = streamRunner[s]
+            onComplete, streams = remaining[runner]
+            lines, done = readLines(s, partial)
+            if streams[s]:
+                for line in lines:
+                    streams[s](line)
+            if done:
+                del streams[s]
+                del streamRunner[s]
+                if not streams:
+                    del remaining[runner]
+                    onComplete()
+
 
 def test():
     import random
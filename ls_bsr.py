@@ -16,7 +16,9 @@ import errno
 import types
 from ls_bsr.util import *
 from igs.utils import logging
+from igs.threading import threads
 import glob
+import threading
 
 def test_file(option, opt_str, value, parser):
     try:
@@ -39,12 +41,14 @@ def test_blast(option, opt_str, value, parser):
         setattr(parser.values, option.dest, value)
     elif "blastn" in value:
         setattr(parser.values, option.dest, value)
+    elif "blastp" in value:
+        setattr(parser.values, option.dest, value)
     elif "blat" in value:
         setattr(parser.values, option.dest, value)
     elif "blastall" in value:
         setattr(parser.values, option.dest, value)
     else:
-        print "Blast option not supported.  Only select from tblastn, blat, or blastn"
+        print "Blast option not supported.  Only select from tblastn, blastp, blat, or blastn"
         sys.exit()
 
 def test_dir(option, opt_str, value, parser):
@@ -79,19 +83,191 @@ def test_fplog(option, opt_str, value, parser):
         print "select from T or F for f_plog setting"
         sys.exit()
 
+def test_self_scores(option, opt_str, value, parser):
+    if value in ["calc", "blast", "validate"]:
+        setattr(parser.values, option.dest, value)
+    else:
+        print "self score option not supported.  Only select from calc, blast, or validate"
+        sys.exit()
+
+def test_shard(option, opt_str, value, parser):
+    if value in ["prepare", "merge"]:
+        setattr(parser.values, option.dest, value)
+        return
+    try:
+        parse_shard(value)
+    except TypeError, err:
+        print "%s; select from prepare, i/N (counted from 1), or merge" % err
+        sys.exit()
+    setattr(parser.values, option.dest, value)
+
+def write_matrix(names, new_names, columns, ref_scores, start_dir, f_plog, mem_limit):
+    """write the BSR matrix, the genome names and the filtered matrix
+    into start_dir, along with the other files users keep.  The matrix
+    is written a block of genes at a time, in mem_limit bytes"""
+    names, ref = hit_table_arrays(names, ref_scores)
+    names_out = open("names.txt", "w")
+    for x in new_names: print >> names_out, x
+    names_out.close()
+    write_bsr_matrix("%s/bsr_matrix_values.txt" % start_dir, names, ref, new_names, columns, mem_limit)
+    logging.logPrint("matrix built")
+    if "T" in f_plog:
+        filter_paralogs("%s/bsr_matrix_values.txt" % start_dir, "paralog_ids.txt")
+        os.system("cp bsr_matrix_values_filtered.txt %s" % start_dir)
+    else:
+        pass
+    try:
+        subprocess.check_call("cp names.txt consensus.pep consensus.fasta duplicate_ids.txt paralog_ids.txt cluster_membership.txt prescreen_skipped.txt hit_stats.txt %s" % start_dir, shell=True, stderr=open(os.devnull, 'w'))
+    except:
+        sys.exc_clear()
+
+def reference_scores(self_scores, queries, blast, penalty, reward, self_search):
+    """get the reference bit score for every query, either calculated
+    from the sequence or taken from a self-search"""
+    if "calc" == self_scores:
+        return calculate_self_scores(queries, blast, penalty, reward)
+    self_search()
+    subprocess.check_call("sort -u -k 1,1 tmp_blast.out > self_blast.out", shell=True)
+    ref_scores=parse_self_blast(open("self_blast.out", "U"))
+    subprocess.check_call("rm tmp_blast.out self_blast.out", shell=True)
+    if "validate" == self_scores:
+        calc_scores = calculate_self_scores(queries, blast, penalty, reward)
+        deviations = compare_self_scores(calc_scores, ref_scores).values()
+        if deviations:
+            logging.logPrint("calculated self scores differ from the self-search by at most %.2f%% (mean %.2f%%) over %s genes" %
+                             (100*max(map(abs, deviations)), 100*sum(map(abs, deviations))/len(deviations), len(deviations)))
+        logging.logPrint("%s genes had no self-search hit and use the calculated score" % (len(calc_scores)-len(deviations)))
+        calc_scores.update(ref_scores)
+        ref_scores = calc_scores
+    return ref_scores
+
 def main(directory, id, filter, processors, genes, usearch, vsearch, blast, penalty, reward, length,
-         max_plog, min_hlog, f_plog, keep, filter_peps, debug):
+         max_plog, min_hlog, f_plog, keep, filter_peps, debug, self_scores, batch, max_memory, pin, prodigal_cache, fast, prescreen, search_timeout, shard, hosts, remote_dir, matrix_memory):
     start_dir = os.getcwd()
     ap=os.path.abspath("%s" % start_dir)
     dir_path=os.path.abspath("%s" % directory)
+    slots = processors
+    budget = core_budget(processors)
+    if budget < processors:
+        logging.logPrint("only %s cores are available, using them instead of %s" % (budget, processors))
+    processors = budget
+    mem_limit = memory_ceiling(max_memory)
+    matrix_limit = memory_ceiling(matrix_memory)
+    if "T" == batch and (max_memory > 0 or "T" == pin or "null" != hosts):
+        print "batches of genomes are searched here, with -p alone; -a T can't be used with -c, -j or --hosts"
+        sys.exit()
+    if "T" == batch and "blastp" == blast:
+        print "blastp searches each genome's Prodigal proteome; -a T can't be used with -b blastp"
+        sys.exit()
+    if "null" != hosts and "blastp" == blast:
+        print "blastp searches Prodigal proteomes and cannot be run on other hosts"
+        sys.exit()
+    def _prescreen(queries, protein, genome_queries=None):
+        """gene x genome pairs with too few shared k-mers are not searched"""
+        if prescreen <= 0:
+            return genome_queries
+        logging.logPrint("prescreening genes against genomes at a containment of %s" % prescreen)
+        return prescreen_queries(queries, glob.glob(os.path.join(os.getcwd(), "*.fasta.new")), protein, prescreen,
+                                 processors, "prescreen_skipped.txt", genome_queries)
+    reduced = {}
+    store = {}
+    def _store():
+        """genomes' best scores are kept on disk as they are parsed"""
+        if not store:
+            store.update(column_store(os.path.join(os.getcwd(), COLUMN_STORE), len(clusters)))
+        return store
+    if "null" == hosts:
+        execute = local_executor(dir_path, processors, filter, penalty, reward, length, min_hlog, batch, mem_limit, pin, search_timeout)
+    else:
+        """-p searches run at once on each host without a slot count
+        of its own; the hosts' cores aren't bound by the ones here"""
+        try:
+            ssh_execute = ssh_executor(hosts.split(","), remote_dir, slots, filter, penalty, reward, length, min_hlog, search_timeout)
+        except TypeError, err:
+            print err
+            sys.exit()
+        def execute(*args):
+            try:
+                ssh_execute(*args)
+            except TypeError, err:
+                print err
+                sys.exit()
+    def _search(queries, search_blast, protein, hits=None):
+        """search the queries against the genomes in the current directory.
+        With hits taken from cluster membership, only the remaining gene x
+        genome pairs are searched.  With --shard prepare, only the manifest
+        the shards search from is written"""
+        if "prepare" == shard:
+            write_manifest(RUN_MANIFEST, search_blast, queries, protein, fast, glob.glob(os.path.join(os.getcwd(), "*.fasta.new")))
+            write_ref_scores(REF_SCORES, ref_scores)
+            return
+        if hits is None:
+            """each genome's hit table is parsed as soon as its search is done"""
+            execute(queries, search_blast, _prescreen(queries, protein), clusters, ref_scores, reduced, _store())
+            return
+        genome_queries = ambiguous_queries(queries, glob.glob(os.path.join(os.getcwd(), "*.fasta.new")), hits)
+        execute(queries, search_blast, _prescreen(queries, protein, genome_queries), clusters, ref_scores)
+        write_membership_hits(hits, ref_scores)
     logging.logPrint("Testing paths of dependencies")
-    if blast=="blastn" or blast=="tblastn":
+    if blast=="blastn" or blast=="tblastn" or blast=="blastp":
         ab = subprocess.call(['which', 'blastn'])
         if ab == 0:
             print "citation: Altschul SF, Madden TL, Schaffer AA, Zhang J, Zhang Z, Miller W, and Lipman DJ. 1997. Gapped BLAST and PSI-BLAST: a new generation of protein database search programs. Nucleic Acids Res 25:3389-3402"
         else:
             print "blastn isn't in your path, but needs to be!"
             sys.exit()
+    joined = os.path.join(dir_path, "joined")
+    if "merge" == shard:
+        """assemble the matrix from the archives of every shard"""
+        os.chdir(joined)
+        manifest = read_manifest(RUN_MANIFEST)
+        clusters = get_cluster_ids(manifest["queries"])
+        ref_scores = read_ref_scores(REF_SCORES)
+        try:
+            shard_files = complete_shard_files(glob.glob("shard_*_of_*.npz"))
+        except TypeError, err:
+            print err
+            sys.exit()
+        logging.logPrint("merging %s shards" % len(shard_files))
+        names, new_names, columns, summary, stats = merge_shard_columns(shard_files, _store())
+        write_hit_stats("hit_stats.txt", new_names, stats)
+        report_dups(names, summary, max_plog)
+        write_matrix(names, new_names, columns, ref_scores, start_dir, f_plog, matrix_limit)
+        logging.logPrint("all Done")
+        os.chdir("%s" % dir_path)
+        if "T" != keep:
+            os.system("rm -rf joined")
+        os.chdir("%s" % ap)
+        return
+    if shard not in ["null", "prepare"]:
+        """search one slice of the genomes of a prepared run, and save
+        their matrix columns for the merge"""
+        shard_num, num_shards = parse_shard(shard)
+        manifest = read_manifest(os.path.join(joined, RUN_MANIFEST))
+        work_dir = os.path.join(joined, "shard_%s_of_%s" % (shard_num, num_shards))
+        os.system("rm -rf %s" % work_dir)
+        os.makedirs(work_dir)
+        for name in shard_genomes(manifest["genomes"], shard_num, num_shards):
+            for f in [name, "%s_genes.pep" % name]:
+                if os.path.exists(os.path.join(joined, f)):
+                    os.link(os.path.join(joined, f), os.path.join(work_dir, f))
+        os.chdir(work_dir)
+        clusters = get_cluster_ids(manifest["queries"])
+        ref_scores = read_ref_scores(os.path.join(joined, REF_SCORES))
+        hits = None
+        if "T" == manifest["fast"]:
+            hits = membership_hits(os.path.join(joined, "cluster_membership.txt"), os.path.join(joined, "gene_origins.txt"))
+            hits = dict([(genome, v) for genome, v in hits.iteritems() if os.path.exists(genome)])
+        logging.logPrint("searching shard %s of %s" % (shard_num, num_shards))
+        _search(manifest["queries"], manifest["blast"], "True" == manifest["protein"], hits)
+        write_shard_columns(os.path.join(joined, shard_file(shard_num, num_shards)),
+                            *hit_table_columns(clusters, ref_scores, length, min_hlog, processors, debug, reduced, _store()))
+        logging.logPrint("shard %s of %s done" % (shard_num, num_shards))
+        os.chdir(joined)
+        if "T" != keep:
+            os.system("rm -rf %s" % work_dir)
+        os.chdir("%s" % ap)
+        return
     try:
         os.makedirs('%s/joined' % dir_path)
     except:
@@ -119,76 +295,112 @@ def main(directory, id, filter, processors, genes, usearch, vsearch, blast, pena
             else:
                 print "You have requested blat, but it is not in your PATH"
                 sys.exit()
+        stop_formatting = threading.Event()
+        formatter = None
+        gene_processors = processors
+        if blast != "blat" and "T" != batch and "prepare" != shard and "null" == hosts and processors > 1:
+            """genome databases don't depend on the genes, so they are
+            formatted on a core of their own while genes are predicted
+            and clustered on the others"""
+            gene_processors = processors-1
+            formatter = threads.runThread(format_genome_dbs, sorted(glob.glob(os.path.join(dir_path, "joined", "*.fasta.new"))),
+                                          "nucl", stop_formatting)
         logging.logPrint("predicting genes with Prodigal")
-        predict_genes(dir_path, processors)
+        if "null" == prodigal_cache:
+            prodigal_cache = os.path.join(dir_path, "prodigal_cache")
+        num_genes = predict_genes(dir_path, gene_processors, pin, os.path.abspath(prodigal_cache), "all_sorted.txt", "gene_origins.txt")
         logging.logPrint("Prodigal done")
-        os.system("cat *genes.seqs > all_gene_seqs.out")
-        filter_scaffolds("all_gene_seqs.out")
-        os.system("mv tmp.out all_gene_seqs.out")
-        rename_fasta_header("all_gene_seqs.out", "all_sorted.txt")
+        if num_genes == 0:
+            print "no usable fasta records were found"
+            stop_formatting.set()
+            sys.exit()
+        num_unique = collapse_duplicates("all_sorted.txt", "unique_sorted.txt", "duplicate_table.txt")
+        logging.logPrint("%s of %s predicted genes are distinct" % (num_unique, num_genes))
+        os.system("mv unique_sorted.txt all_sorted.txt")
         if os.path.exists(usearch) and os.path.exists(vsearch):
             print "usearch and vsearch both selected, only usearch will be used"
         if os.path.exists(usearch):
-            os.system("mkdir split_files")
-            os.system("cp all_sorted.txt split_files/")
-            os.system("rm all_sorted.txt")
-            os.chdir("split_files/")
-            os.system("split -l 200000 all_sorted.txt")
             logging.logPrint("clustering with USEARCH at an ID of %s" % id)
-            run_usearch(usearch, id)
-            os.system("cat *.usearch.out > all_sorted.txt")
-            os.system("mv all_sorted.txt %s/joined" % dir_path)
-            os.chdir("%s/joined" % dir_path)
+            chunks = split_fasta_chunks("all_sorted.txt", "all_sorted.chunk")
+            if len(chunks) > 1:
+                uc_files = run_usearch(usearch, id, chunks, gene_processors)
+                os.system("cat all_sorted.chunk*.usearch.out > all_sorted.txt")
+            else:
+                uc_files = [ ]
             uclust_cluster(usearch, id)
+            uc_files.append("results.uc")
             logging.logPrint("USEARCH clustering finished")
         elif os.path.exists(vsearch):
             logging.logPrint("clustering with VSEARCH at an ID of %s" % id)
-            run_vsearch(vsearch, id, processors)
+            run_vsearch(vsearch, id, gene_processors)
             os.system("mv vsearch.out consensus.fasta")
+            uc_files = ["results.uc"]
             logging.logPrint("VSEARCH clustering finished")
         else:
-            print "neither usearch or vsearch selected for use with Prodigal!, exiting."
-            sys.exit()
-        if "tblastn" == blast:
-            subprocess.check_call("makeblastdb -in consensus.fasta -dbtype nucl > /dev/null 2>&1", shell=True)
-            translate_consensus("consensus.fasta")
+            logging.logPrint("clustering with built-in k-mer clustering at an ID of %s" % id)
+            kmer_cluster("all_sorted.txt", id, gene_processors, "consensus.fasta", "results.uc")
+            uc_files = ["results.uc"]
+            logging.logPrint("clustering finished")
+        cluster_membership(uc_files, "duplicate_table.txt", "cluster_membership.txt")
+        if "tblastn" == blast or "blastp" == blast:
+            translate_consensus("consensus.fasta", gene_processors)
             if filter_peps == "T":
                 filter_seqs("tmp.pep")
                 os.system("rm tmp.pep")
             else:
                 os.system("mv tmp.pep consensus.pep")
             clusters = get_cluster_ids("consensus.pep")
-            blast_against_self_tblastn("tblastn", "consensus.fasta", "consensus.pep", "tmp_blast.out", processors)
+            def _self_search():
+                subprocess.check_call("makeblastdb -in consensus.fasta -dbtype nucl > /dev/null 2>&1", shell=True)
+                blast_against_self_tblastn("tblastn", "consensus.fasta", "consensus.pep", "tmp_blast.out", gene_processors)
+            if "blastp" == blast:
+                def _self_search():
+                    subprocess.check_call("makeblastdb -in consensus.pep -dbtype prot > /dev/null 2>&1", shell=True)
+                    blast_against_self_tblastn("blastp", "consensus.pep", "consensus.pep", "tmp_blast.out", gene_processors)
+            ref_scores = reference_scores(self_scores, "consensus.pep", blast, penalty, reward, _self_search)
         elif "blastn" == blast:
-            subprocess.check_call("makeblastdb -in consensus.fasta -dbtype nucl > /dev/null 2>&1", shell=True)
-            blast_against_self_blastn("blastn", "consensus.fasta", "consensus.fasta", "tmp_blast.out", filter, penalty, reward, processors)
+            def _self_search():
+                subprocess.check_call("makeblastdb -in consensus.fasta -dbtype nucl > /dev/null 2>&1", shell=True)
+                blast_against_self_blastn("blastn", "consensus.fasta", "consensus.fasta", "tmp_blast.out", filter, penalty, reward, gene_processors)
+            ref_scores = reference_scores(self_scores, "consensus.fasta", blast, penalty, reward, _self_search)
             clusters = get_cluster_ids("consensus.fasta")
         elif "blat" == blast:
-            blat_against_self("consensus.fasta", "consensus.fasta", "tmp_blast.out", processors)
+            def _self_search():
+                blat_against_self("consensus.fasta", "consensus.fasta", "tmp_blast.out", gene_processors)
+            ref_scores = reference_scores(self_scores, "consensus.fasta", blast, penalty, reward, _self_search)
             clusters = get_cluster_ids("consensus.fasta")
         else:
             pass
-        subprocess.check_call("sort -u -k 1,1 tmp_blast.out > self_blast.out", shell=True)
-        ref_scores=parse_self_blast(open("self_blast.out", "U"))
-        subprocess.check_call("rm tmp_blast.out self_blast.out", shell=True)
-        os.system("rm *new_genes.*")
-        if blast == "tblastn" or blast == "blastn":
+        if "blastp" != blast:
+            """blastp searches the predicted proteomes"""
+            os.system("rm *new_genes.*")
+        """genomes the background formatting didn't reach are
+        formatted as the first task of their search"""
+        stop_formatting.set()
+        if formatter:
+            formatter.join()
+        if blast == "tblastn" or blast == "blastn" or blast == "blastp":
             logging.logPrint("starting BLAST")
         else:
             logging.logPrint("starting BLAT")
-        if "tblastn" == blast:
-            #blast_against_each_genome(dir_path, processors, filter, "consensus.pep", blast, penalty, reward)
-            blast_against_each_genome_tblastn(dir_path, processors, "consensus.pep")
-        elif "blastn" == blast:
-            #blast_against_each_genome(dir_path, processors, filter, "consensus.fasta", blast, penalty, reward)
-            blast_against_each_genome_blastn(dir_path, processors, filter, "consensus.fasta", penalty, reward)
-        elif "blat" == blast:
-            blat_against_each_genome(dir_path, "consensus.fasta",processors)
+        if "tblastn" == blast or "blastp" == blast:
+            queries = "consensus.pep"
         else:
-            pass
-        find_dups(ref_scores, length, max_plog, min_hlog)
+            queries = "consensus.fasta"
+        if "T" == fast:
+            """genomes that contributed a member to a cluster have it; only
+            the remaining centroid x genome pairs are searched"""
+            hits = membership_hits("cluster_membership.txt", "gene_origins.txt")
+            logging.logPrint("presence of %s gene x genome pairs taken from clustering" % sum([len(x) for x in hits.values()]))
+            _search(queries, blast, blast != "blastn" and blast != "blat", hits)
+        else:
+            #blast_against_each_genome(dir_path, processors, filter, queries, blast, penalty, reward)
+            _search(queries, blast, blast != "blastn" and blast != "blat")
     else:
         logging.logPrint("Using pre-compiled set of predicted genes")
+        if "blastp" == blast:
+            print "blastp searches the proteomes predicted by Prodigal, and can't be used with a set of genes"
+            sys.exit()
         files = glob.glob(os.path.join(dir_path, "*.fasta"))
         if len(files)==0:
             print "no usable reference genomes found!"
@@ -201,66 +413,62 @@ def main(directory, id, filter, processors, genes, usearch, vsearch, blast, pena
         os.chdir("%s/joined" % dir_path)
         if gene_path.endswith(".pep"):
             logging.logPrint("using tblastn on peptides")
-            try:
-                #subprocess.check_call("formatdb -i %s" % gene_path, shell=True)
-                subprocess.check_call("makeblastdb -in %s -dbtype prot > /dev/null 2>&1" % gene_path, shell=True)
-            except:
-                logging.logPrint("problem encountered with BLAST database")
-                sys.exit()
-                #blast_against_self(gene_path, gene_path, "tmp_blast.out", filter, "blastp", penalty, reward, processors)
-            blast_against_self_tblastn("tblastn", gene_path, gene_path, "tmp_blast.out", processors)
-            subprocess.check_call("sort -u -k 1,1 tmp_blast.out > self_blast.out", shell=True)
-            ref_scores=parse_self_blast(open("self_blast.out", "U"))
-            subprocess.check_call("rm tmp_blast.out self_blast.out", shell=True)
+            def _self_search():
+                try:
+                    #subprocess.check_call("formatdb -i %s" % gene_path, shell=True)
+                    subprocess.check_call("makeblastdb -in %s -dbtype prot > /dev/null 2>&1" % gene_path, shell=True)
+                except:
+                    logging.logPrint("problem encountered with BLAST database")
+                    sys.exit()
+                    #blast_against_self(gene_path, gene_path, "tmp_blast.out", filter, "blastp", penalty, reward, processors)
+                blast_against_self_tblastn("tblastn", gene_path, gene_path, "tmp_blast.out", processors)
+            ref_scores = reference_scores(self_scores, gene_path, "tblastn", penalty, reward, _self_search)
             logging.logPrint("starting BLAST")
             #blast_against_each_genome(dir_path, processors, filter, gene_path, "tblastn", penalty, reward)
-            blast_against_each_genome_tblastn(dir_path, processors, gene_path)
+            _search(gene_path, "tblastn", True)
         elif gene_path.endswith(".fasta"):    
             if "tblastn" == blast:
                 logging.logPrint("using tblastn")
-                translate_genes(gene_path)
-                try:
-                    #subprocess.check_call("formatdb -i %s -p F" % gene_path, shell=True)
-                    subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % gene_path, shell=True)
-                except:
-                    logging.logPrint("problem encountered with BLAST database")
-                    sys.exit()
-                    #blast_against_self(gene_path, "genes.pep", "tmp_blast.out", filter, blast, penalty, reward, processors)
-                blast_against_self_tblastn("tblastn", gene_path, "genes.pep", "tmp_blast.out", processors)
-                subprocess.check_call("sort -u -k 1,1 tmp_blast.out > self_blast.out", shell=True)
-                ref_scores=parse_self_blast(open("self_blast.out", "U"))
-                subprocess.check_call("rm tmp_blast.out self_blast.out", shell=True)
+                translate_genes(gene_path, processors)
+                def _self_search():
+                    try:
+                        #subprocess.check_call("formatdb -i %s -p F" % gene_path, shell=True)
+                        subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % gene_path, shell=True)
+                    except:
+                        logging.logPrint("problem encountered with BLAST database")
+                        sys.exit()
+                        #blast_against_self(gene_path, "genes.pep", "tmp_blast.out", filter, blast, penalty, reward, processors)
+                    blast_against_self_tblastn("tblastn", gene_path, "genes.pep", "tmp_blast.out", processors)
+                ref_scores = reference_scores(self_scores, "genes.pep", blast, penalty, reward, _self_search)
                 logging.logPrint("starting BLAST")
-                blast_against_each_genome(dir_path, processors, filter, "genes.pep", blast, penalty, reward)
+                _search("genes.pep", blast, True)
                 os.system("cp genes.pep %s" % start_dir)
             elif "blastn" == blast:
                 logging.logPrint("using blastn")
-                try:
-                    #subprocess.check_call("formatdb -i %s -p F" % gene_path, shell=True)
-                    subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % gene_path, shell=True)
-                except:
-                    logging.logPrint("Database not formatted correctly...exiting")
-                    sys.exit()
-                    #blast_against_self(gene_path, gene_path, "tmp_blast.out", filter, blast, penalty, reward, processors)
-                try:
-                    blast_against_self_blastn("blastn", gene_path, gene_path, "tmp_blast.out", filter, penalty, reward, processors)
-                except:
-                    print "problem with blastn, exiting"
-                    sys.exit()
-                subprocess.check_call("sort -u -k 1,1 tmp_blast.out > self_blast.out", shell=True)
-                ref_scores=parse_self_blast(open("self_blast.out", "U"))
-                subprocess.check_call("rm tmp_blast.out self_blast.out", shell=True)
+                def _self_search():
+                    try:
+                        #subprocess.check_call("formatdb -i %s -p F" % gene_path, shell=True)
+                        subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % gene_path, shell=True)
+                    except:
+                        logging.logPrint("Database not formatted correctly...exiting")
+                        sys.exit()
+                        #blast_against_self(gene_path, gene_path, "tmp_blast.out", filter, blast, penalty, reward, processors)
+                    try:
+                        blast_against_self_blastn("blastn", gene_path, gene_path, "tmp_blast.out", filter, penalty, reward, processors)
+                    except:
+                        print "problem with blastn, exiting"
+                        sys.exit()
+                ref_scores = reference_scores(self_scores, gene_path, blast, penalty, reward, _self_search)
                 logging.logPrint("starting BLAST")
                 #blast_against_each_genome(dir_path, processors, filter, gene_path, blast, penalty, reward)
-                blast_against_each_genome_blastn(dir_path, processors, filter, gene_path, penalty, reward)
+                _search(gene_path, blast, False)
             elif "blat" == blast:
                 logging.logPrint("using blat")
-                blat_against_self(gene_path, gene_path, "tmp_blast.out", processors)
-                subprocess.check_call("sort -u -k 1,1 tmp_blast.out > self_blast.out", shell=True)
-                ref_scores=parse_self_blast(open("self_blast.out", "U"))
-                subprocess.check_call("rm tmp_blast.out self_blast.out", shell=True)
+                def _self_search():
+                    blat_against_self(gene_path, gene_path, "tmp_blast.out", processors)
+                ref_scores = reference_scores(self_scores, gene_path, blast, penalty, reward, _self_search)
                 logging.logPrint("starting BLAT")
-                blat_against_each_genome(dir_path,gene_path,processors)
+                _search(gene_path, blast, False)
             else:
                 pass
         else:
@@ -270,43 +478,15 @@ def main(directory, id, filter, processors, genes, usearch, vsearch, blast, pena
         logging.logPrint("BLAT done")
     else:
         logging.logPrint("BLAST done")
-    parse_blast_report("false")
-    get_unique_lines()
-    curr_dir=os.getcwd()
-    table_files = glob.glob(os.path.join(curr_dir, "*.filtered.unique"))
-    files_and_temp_names = [(str(idx), os.path.join(curr_dir, f))
-                            for idx, f in enumerate(table_files)]
-    names=[]
-    table_list = []
-    nr_sorted=sorted(clusters)
-    centroid_list = []
-    centroid_list.append(" ")
-    for x in nr_sorted:
-        centroid_list.append(x)
-    table_list.append(centroid_list)
+    if "prepare" == shard:
+        logging.logPrint("run prepared; search it with --shard i/N, then --shard merge")
+        os.chdir("%s" % ap)
+        return
     logging.logPrint("starting matrix building")
-    new_names,new_table = new_loop(files_and_temp_names, processors, clusters, debug)
-    new_table_list = table_list+new_table
-    logging.logPrint("matrix built")
-    open("ref.list", "a").write("\n")
-    for x in nr_sorted:
-        open("ref.list", "a").write("%s\n" % x)
-    names_out = open("names.txt", "w")
-    names_redux = [val for subl in new_names for val in subl]
-    for x in names_redux: print >> names_out, "".join(x)
-    names_out.close()
-    create_bsr_matrix_dev(new_table_list)
-    divide_values("bsr_matrix", ref_scores)
-    subprocess.check_call("paste ref.list BSR_matrix_values.txt > %s/bsr_matrix_values.txt" % start_dir, shell=True)
-    if "T" in f_plog:
-        filter_paralogs("%s/bsr_matrix_values.txt" % start_dir, "paralog_ids.txt")
-        os.system("cp bsr_matrix_values_filtered.txt %s" % start_dir)
-    else:
-        pass
-    try:
-        subprocess.check_call("cp names.txt consensus.pep consensus.fasta duplicate_ids.txt paralog_ids.txt %s" % start_dir, shell=True, stderr=open(os.devnull, 'w'))
-    except:
-        sys.exc_clear()
+    names, new_names, columns, summary, stats = hit_table_columns(clusters, ref_scores, length, min_hlog, processors, debug, reduced, _store())
+    write_hit_stats("hit_stats.txt", new_names, stats)
+    report_dups(names, summary, max_plog)
+    write_matrix(names, new_names, columns, ref_scores, start_dir, f_plog, matrix_limit)
     logging.logPrint("all Done")
     os.chdir("%s" % dir_path)
     if "T" == keep:
@@ -328,19 +508,19 @@ if __name__ == "__main__":
                       help="to use blast filtering or not, default is F or filter, change to T to turn off filtering",
                       default="F", type="string")
     parser.add_option("-p", "--parallel_workers", dest="processors",
-                      help="How much work to do in parallel, defaults to 2",
+                      help="How many cores to use, shared by all stages, defaults to 2",
                       default="2", type="int")
     parser.add_option("-g", "--genes", dest="genes", action="callback", callback=test_file,
                       help="predicted genes (nucleotide) to screen against genomes, will not use prodigal, must end in fasta (nt) or pep (aa)",
                       type="string",default="null")
     parser.add_option("-u", "--usearch", dest="usearch", action="store",
-                      help="path to usearch v6, either this or vsearch needs to be used with Prodigal",
+                      help="path to usearch v6, used to cluster Prodigal genes; built-in clustering is used if neither usearch or vsearch is given",
                       type="string", default="NULL")
     parser.add_option("-v", "--vsearch", dest="vsearch", action="store",
-                      help="path to vsearch, either this or usearch needs to be used with prodigal",
+                      help="path to vsearch, used to cluster Prodigal genes if usearch isn't given",
                       type="string", default="NULL")
     parser.add_option("-b", "--blast", dest="blast", action="callback", callback=test_blast,
-                      help="use tblastn, blastn, or blat (nucleotide search only), default is tblastn",
+                      help="use tblastn, blastp (Prodigal proteomes, tblastn for genes without a hit), blastn, or blat (nucleotide search only), default is tblastn",
                       default="tblastn", type="string")
     parser.add_option("-q", "--penalty", dest="penalty", action="store",
                       help="mismatch penalty, only to be used with blastn and -g option, default is -4",
@@ -369,6 +549,42 @@ if __name__ == "__main__":
     parser.add_option("-z", "--debug", dest="debug", action="callback",
                       help="turn debug on?  Defaults to F",
                       default="F", callback=test_filter, type="string")
+    parser.add_option("-x", "--self_scores", dest="self_scores", action="callback",
+                      help="how to get reference bit scores: blast (self-search), calc (from the scoring system, ignoring composition-based statistics and SEG/dust masking), or validate (self-search, reporting how far calc deviates from it).  Defaults to blast",
+                      default="blast", callback=test_self_scores, type="string")
+    parser.add_option("-a", "--batch", dest="batch", action="callback",
+                      help="search many small genomes at once, one database per batch of genomes?  Defaults to F",
+                      default="F", callback=test_filter, type="string")
+    parser.add_option("-c", "--max_memory", dest="max_memory", action="store",
+                      help="GB of memory that concurrent searches may use, defaults to 90% of the machine's memory",
+                      default="0", type="float")
+    parser.add_option("-j", "--pin", dest="pin", action="callback",
+                      help="pin each search or Prodigal process to CPUs of one NUMA node?  Defaults to F",
+                      default="F", callback=test_filter, type="string")
+    parser.add_option("-e", "--prodigal_cache", dest="prodigal_cache", action="store",
+                      help="directory of cached Prodigal predictions, defaults to prodigal_cache in the genomes directory",
+                      type="string", default="null")
+    parser.add_option("-w", "--fast", dest="fast", action="callback", callback=test_filter,
+                      help="with Prodigal, take presence and approximate BSR values from cluster membership and only search the rest (T or F), defaults to F",
+                      default="F", type="string")
+    parser.add_option("-y", "--prescreen", dest="prescreen", action="store",
+                      help="don't search a gene against a genome when less than this fraction of its k-mers are in the genome (0.0-1.0), defaults to 0 (search all)",
+                      type="float", default="0")
+    parser.add_option("--search_timeout", dest="search_timeout", action="store",
+                      help="seconds after which a search of one genome is killed, defaults to 0 (no limit)",
+                      type="float", default="0")
+    parser.add_option("--shard", dest="shard", action="callback", callback=test_shard,
+                      help="split a run over many jobs: prepare the genes and the manifest, search shard i/N of the genomes, or merge the shards into the matrix; run every phase with the same options",
+                      type="string", default="null")
+    parser.add_option("--hosts", dest="hosts", action="store",
+                      help="comma separated hosts to search the genomes on over ssh, each as host or host:slots, running its slots or else -p searches at a time; LS-BSR and the search programs must be installed on every host.  Defaults to searching here",
+                      type="string", default="null")
+    parser.add_option("--remote_dir", dest="remote_dir", action="store",
+                      help="scratch directory on the --hosts; each run copies its genomes and queries to a directory of its own in it and removes that when done.  Defaults to /tmp/ls_bsr",
+                      type="string", default="/tmp/ls_bsr")
+    parser.add_option("--matrix_memory", dest="matrix_memory", action="store",
+                      help="GB of memory the BSR matrix is built in, a block of genes at a time, or 0 for 90% of the machine's memory; defaults to 1",
+                      type="float", default="1")
     options, args = parser.parse_args()
     
     mandatories = ["directory"]
@@ -380,5 +596,6 @@ if __name__ == "__main__":
 
     main(options.directory, options.id, options.filter, options.processors, options.genes, options.usearch, options.vsearch, options.blast,
          options.penalty, options.reward, options.length, options.max_plog, options.min_hlog, options.f_plog, options.keep,
-         options.filter_peps,options.debug)
+         options.filter_peps,options.debug,options.self_scores,options.batch,options.max_memory,options.pin,options.prodigal_cache,options.fast,options.prescreen,
+         options.search_timeout,options.shard,options.hosts,options.remote_dir,options.matrix_memory)
 
@@ -11,6 +11,11 @@ import shlex
 from subprocess import call
 import random
 import collections
+try:
+    import numpy as np
+except:
+    print "NumPy is not in your PATH, but needs to be"
+    sys.exit()
 try:
     from Bio.SeqRecord import SeqRecord
     import Bio
@@ -22,21 +27,177 @@ except:
 try:
     from igs.utils import functional as func
     from igs.utils import logging
+    from igs.utils import commands
+    from igs.utils import ssh
     from igs.threading import functional as p_func
+    from igs.threading import threads
+    from igs.threading.channels import Channel
 except:
     print "Your environment is not set correctly.  Please add LS-BSR to your PYTHONPATH and try again"
     sys.exit()
 import errno
 import threading
 import types
+import math
+import hashlib
+import itertools
+import mmap
+import Queue
+import shutil
+import time
+import tempfile
+import socket
+import uuid
+import multiprocessing
+import ctypes
+import ctypes.util
+import array
 from collections import deque,OrderedDict
-import collections
+
+"""BLOSUM62 scores of each residue aligned against itself"""
+BLOSUM62_SELF = {'A':4, 'R':5, 'N':6, 'D':6, 'C':9, 'Q':5, 'E':5, 'G':6,
+                 'H':8, 'I':4, 'L':4, 'K':5, 'M':5, 'F':6, 'P':7, 'S':4,
+                 'T':5, 'W':11, 'Y':7, 'V':4, 'B':4, 'J':3, 'Z':4, 'X':-1,
+                 '*':1}
+
+"""gapped Karlin-Altschul lambda and K for BLOSUM62 with the
+default 11/1 gap costs"""
+BLOSUM62_LAMBDA_K = (0.267, 0.041)
+
+"""Karlin-Altschul lambda and K used by blastn (megablast, linear
+gap costs) for each supported reward/penalty pair"""
+BLASTN_LAMBDA_K = {(1,-5):(1.39,0.747), (1,-4):(1.383,0.738),
+                   (1,-3):(1.374,0.711), (1,-2):(1.28,0.46),
+                   (2,-7):(0.69,0.73), (2,-5):(0.675,0.65),
+                   (2,-3):(0.55,0.21)}
+
+"""blastz scores used by BLAT for an identical base pair, and the
+factor BLAT uses to convert them into bits"""
+BLASTZ_SELF = {'A':91, 'C':100, 'G':100, 'T':91}
+BLASTZ_TO_BITS = 0.0205
+
+"""most bases of genome sequence to put in one batched search"""
+MAX_BATCH_BASES = 100000000
+
+"""genome x query shard tasks to aim for per worker, and the
+fewest queries to put in one shard"""
+TASKS_PER_WORKER = 4
+MIN_SHARD_QUERIES = 200
+
+"""most sequences and bases to put in one first-level USEARCH
+chunk, keeping each run inside the 32-bit memory limit"""
+CHUNK_SEQS = 100000
+CHUNK_BASES = 100000000
+
+"""k-mer length, candidates aligned per sequence and sequences
+assigned per pass of the built-in clustering"""
+KMER_SIZE = 8
+MAX_REJECTS = 32
+CLUSTER_BATCH = 10000
+
+"""k-mer lengths of the containment prescreen, for nucleotide
+and translated (amino acid) comparisons"""
+PRESCREEN_NT_K = 16
+PRESCREEN_AA_K = 6
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+"""records translated together, and per task of the process pool"""
+TRANSLATE_CHUNK = 20000
+
+"""bytes of a tabular hit file parsed at a time, most bytes of its
+fields gathered at once, and the longest number gathered with them"""
+HIT_CHUNK_BYTES = 64*1024*1024
+FIELD_GATHER_BYTES = 1024*1024
+NUMBER_BYTES = 32
+
+"""file in the genome directory holding measured task durations,
+and the cost of each sequence in a genome, in bytes, when the
+duration has to be estimated"""
+TASK_TIMES = "ls_bsr_task_times.txt"
+SEQ_OVERHEAD = 10000
+
+"""files in the working directory of a sharded run: what the
+shards search, and the reference scores of the queries"""
+RUN_MANIFEST = "ls_bsr_manifest.txt"
+REF_SCORES = "ref_scores.txt"
+
+"""seconds a search on a host is given past its timeout, to be
+stopped there by timeout(1), before its ssh is killed here"""
+SSH_TIMEOUT_GRACE = 60
+
+"""ssh and scp options for the hosts: never prompt for a password
+and give up on a host that doesn't answer, so an unreachable host
+fails instead of hanging the run"""
+SSH_OPTIONS = "-o BatchMode=yes -o ConnectTimeout=30"
+
+"""file in the working directory that genomes' best scores are
+written to as they are parsed, one float64 column after another"""
+COLUMN_STORE = "bsr_columns.f8"
+
+"""bytes the BSR matrix writer holds per value of a block of genes,
+its float64, and per genome for the one row being formatted, its
+boxed float and text"""
+MATRIX_VALUE_BYTES = 8
+MATRIX_ROW_BYTES = 64
+
+"""peak memory model of one search, in bytes"""
+MEM_BASE = 50*1024**2
+MEM_PER_GENOME_BYTE = 4
+MEM_PER_QUERY_BYTE = 20
+
+def read_fasta(in_fasta, titles=False):
+    """yield (id, sequence) for each record of a fasta file or
+    handle, or (title, sequence) with titles set.  As with SeqIO,
+    the id is the first word of the title, anything before the
+    first record is skipped and spaces are removed from sequences"""
+    if hasattr(in_fasta, "read"):
+        infile = in_fasta
+    else:
+        infile = open(in_fasta, "rU")
+    title = None
+    lines = [ ]
+    for line in infile:
+        if line[:1] == ">":
+            if title is not None:
+                yield fasta_record(title, lines, titles)
+            title = line[1:].rstrip()
+            lines = [ ]
+        elif title is not None:
+            lines.append(line.rstrip())
+    if title is not None:
+        yield fasta_record(title, lines, titles)
+    if infile is not in_fasta:
+        infile.close()
+
+def fasta_id(title):
+    """the id of a record, the first word of its title as with SeqIO"""
+    return (title.split(None, 1) or [""])[0]
+
+def fasta_record(title, lines, titles):
+    seq = "".join(lines).replace(" ", "").replace("\r", "")
+    if titles:
+        return title, seq
+    return fasta_id(title), seq
+
+def write_fasta(handle, title, seq, width=None):
+    """write one record, wrapping the sequence every width
+    characters as SeqIO.write does if width is set"""
+    if width is None:
+        handle.write(">%s\n%s\n" % (title, seq))
+    else:
+        handle.write(">%s\n" % title)
+        handle.write("".join(["%s\n" % seq[i:i+width] for i in range(0, len(seq), width)]))
+
+def fasta_ids(in_fasta):
+    """ids of the records in a fasta file, reading headers only"""
+    ids = [ ]
+    for line in open(in_fasta, "rU"):
+        if line[:1] == ">":
+            ids.append(fasta_id(line[1:]))
+    return ids
 
 def get_cluster_ids(in_fasta):
-    clusters = []
-    infile = open(in_fasta, "U")
-    for record in SeqIO.parse(infile, "fasta"):
-        clusters.append(record.id)
+    clusters = fasta_ids(in_fasta)
     nr = list(OrderedDict.fromkeys(clusters))
     if len(clusters) == len(nr):
         return clusters
@@ -44,50 +205,355 @@ def get_cluster_ids(in_fasta):
         print "Problem with gene list.  Are there duplicate headers in your file?"
         sys.exit()
 
-def divide_values(file, ref_scores):
-    """divide each BSR value in a row by that row's maximum value"""
-    infile = open(file, "U")
-    firstLine = infile.readline()
-    FL_F=firstLine.split()
-    outfile = open("BSR_matrix_values.txt", "a")
-    print >> outfile, '\t'.join([str(item) for item in FL_F])
-    outdata=[ ]
-    for line in infile:
-        fields=line.split()
-        all_fields=list(fields)
+def parse_cpu_list(cpu_list):
+    """expand a kernel cpu list such as 0-3,8,10-11"""
+    cpus = [ ]
+    for part in cpu_list.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last)+1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def cgroup_cpu_limit(cgroup_root="/sys/fs/cgroup"):
+    """cores allowed by a cgroup v2 or v1 CPU quota, or None if
+    there is no quota"""
+    try:
+        quota, period = open(os.path.join(cgroup_root, "cpu.max")).read().split()
+        if quota == "max":
+            return None
+        return int(quota)/int(period)
+    except (IOError, ValueError):
+        pass
+    for controller in ["cpu", "cpu,cpuacct"]:
         try:
-            fields=map(float, fields[1:])
-        except:
-            raise TypeError("abnormal number of fields observed")
-        values= [ ]
-        for x in fields:
-            try:
-                values.append(float(x)/float(ref_scores.get(all_fields[0])))
-            except:
-                """somewhat arbitrary, but covers the case where the reference
-                value is missing"""
-                values.append(float(x)/float("1000"))
-        sort_values=['%.2f' % elem for elem in values]
-        print >> outfile, '\t'.join([str(item) for item in sort_values])
-        outdata.append(values)
-    return outdata
+            quota = int(open(os.path.join(cgroup_root, controller, "cpu.cfs_quota_us")).read())
+            period = int(open(os.path.join(cgroup_root, controller, "cpu.cfs_period_us")).read())
+            if quota <= 0:
+                return None
+            return quota/period
+        except (IOError, ValueError):
+            pass
+    return None
+
+def allowed_cpus(proc_status="/proc/self/status"):
+    """the CPUs in this process' affinity mask"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        for line in open(proc_status):
+            if line.startswith("Cpus_allowed_list:"):
+                return parse_cpu_list(line.split(":",1)[1])
+    except IOError:
+        pass
+    return range(multiprocessing.cpu_count())
+
+def available_cores(proc_status="/proc/self/status", cgroup_root="/sys/fs/cgroup"):
+    """cores this process may use: the CPUs in its affinity mask,
+    capped by any cgroup CPU quota"""
+    cores = len(allowed_cpus(proc_status))
+    quota = cgroup_cpu_limit(cgroup_root)
+    if quota:
+        cores = min(cores, max(1, int(quota)))
+    return cores
+
+def core_budget(processors):
+    """the number of cores shared by all stages that launch
+    programs: what was asked for, but no more than is available"""
+    return max(1, min(int(processors), available_cores()))
+
+def numa_cpu_sets(sysfs_root="/sys/devices/system/node", cpus=None):
+    """the allowed CPUs of each NUMA node, read from sysfs.  Without
+    NUMA information all allowed CPUs are treated as one node"""
+    if cpus is None:
+        cpus = allowed_cpus()
+    nodes = [ ]
+    for node in sorted(glob.glob(os.path.join(sysfs_root, "node[0-9]*")),
+                       key=lambda x: int(os.path.basename(x)[4:])):
+        try:
+            node_cpus = [x for x in parse_cpu_list(open(os.path.join(node, "cpulist")).read()) if x in cpus]
+        except (IOError, ValueError):
+            continue
+        if node_cpus:
+            nodes.append(node_cpus)
+    if not nodes:
+        nodes.append(list(cpus))
+    return nodes
+
+def cpu_slots(workers, threads, nodes):
+    """one CPU set per worker, each with threads CPUs taken from a
+    single NUMA node, spreading the workers across nodes.  If there
+    are more workers than sets, sets are shared"""
+    per_node = [ ]
+    for node_cpus in nodes:
+        size = min(threads, len(node_cpus))
+        per_node.append([node_cpus[i:i+size] for i in range(0, len(node_cpus)-size+1, size)])
+    slots = [ ]
+    for i in range(max(map(len, per_node))):
+        for node_slots in per_node:
+            if i < len(node_slots): slots.append(node_slots[i])
+    return [slots[i % len(slots)] for i in range(workers)]
+
+_libraries = {}
+
+def affinity_setter(cpus):
+    """a preexec_fn pinning a launched program to cpus.  libc and the
+    CPU mask are set up here, in the parent, so the forked child of
+    this threaded process only makes the system call"""
+    if hasattr(os, "sched_setaffinity"):
+        return lambda: os.sched_setaffinity(0, cpus)
+    if "c" not in _libraries:
+        """find_library runs ldconfig, so it is only done once"""
+        _libraries["c"] = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc = _libraries["c"]
+    bits = 8*ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong*(max(cpus)//bits+1))()
+    for cpu in cpus:
+        mask[cpu//bits] |= 1 << (cpu % bits)
+    call = libc.sched_setaffinity
+    size = ctypes.sizeof(mask)
+    ref = ctypes.byref(mask)
+    def _set():
+        if call(0, size, ref) != 0:
+            raise OSError(ctypes.get_errno(), "sched_setaffinity failed")
+    return _set
+
+def cpu_slot_pool(workers, threads, pin):
+    """a queue of NUMA-local CPU sets for workers to pin the programs
+    they launch to, or None when pinning is off"""
+    if "T" != pin:
+        return None
+    pool = Queue.Queue()
+    for slot in cpu_slots(workers, threads, numa_cpu_sets()):
+        pool.put(slot)
+    return pool
+
+def run_pinned(pool, run):
+    """call run(preexec_fn), holding a CPU set from the pool while it
+    runs; preexec_fn pins a launched program to that set"""
+    if pool is None:
+        return run(None)
+    cpus = pool.get()
+    try:
+        return run(affinity_setter(cpus))
+    finally:
+        pool.put(cpus)
+
+def plan_threads(budget, num_tasks):
+    """split a core budget between tasks; returns how many tasks
+    run at once and how many threads each of them gets"""
+    workers = max(1, min(budget, num_tasks))
+    return workers, max(1, budget//workers)
+
+def read_task_times(times_file):
+    """durations measured on earlier runs, keyed by stage,
+    genome name and genome file size.  The timings are only
+    hints, so malformed lines are skipped"""
+    times = {}
+    try:
+        lines = open(times_file, "U").readlines()
+    except IOError:
+        return times
+    for line in lines:
+        fields = line.split()
+        try:
+            times.update({(fields[0], fields[1], int(fields[2])):float(fields[3])})
+        except (IndexError, ValueError):
+            continue
+    return times
+
+def write_task_times(times_file, new_times):
+    """merge newly measured durations into the times file.  Shards
+    of one run share the file, so it is re-read right before writing
+    and replaced by renaming a temporary file, which never leaves
+    a half-written file behind"""
+    times = read_task_times(times_file)
+    times.update(new_times)
+    fd, tmp = tempfile.mkstemp(prefix="%s." % os.path.basename(times_file), dir=os.path.dirname(os.path.abspath(times_file)))
+    outfile = os.fdopen(fd, "w")
+    for (stage, name, size), seconds in sorted(times.iteritems()):
+        print >> outfile, "%s\t%s\t%s\t%.2f" % (stage, name, size, seconds)
     outfile.close()
+    os.rename(tmp, times_file)
+
+def task_key(stage, f):
+    return (stage, get_seq_name(f), os.path.getsize(f))
+
+def estimate_cost(f):
+    """estimated cost of a genome: its size plus a fixed
+    overhead for each sequence"""
+    num_seqs = 0
+    for line in open(f, "U"):
+        if line.startswith(">"): num_seqs += 1
+    return os.path.getsize(f) + SEQ_OVERHEAD*num_seqs
+
+def order_by_cost(files, stage, times):
+    """order genomes by cost, most expensive first.  Genomes timed
+    on an earlier run use that duration; the rest are estimated,
+    scaled to seconds by the rate of the timed genomes"""
+    estimates = dict([(f, estimate_cost(f)) for f in files])
+    measured = dict([(f, times[task_key(stage, f)]) for f in files if task_key(stage, f) in times])
+    if measured and sum([estimates[f] for f in measured]) > 0:
+        rate = sum(measured.values())/sum([estimates[f] for f in measured])
+    else:
+        rate = 1
+    costs = dict([(f, measured.get(f, estimates[f]*rate)) for f in files])
+    return sorted(files, key=lambda f: (-costs[f], f))
+
+def timed_pmap(f, tasks, processors, times, key):
+    """pmap over tasks, adding the duration of each task
+    into times under key(task)"""
+    lock = threading.Lock()
+    def _timed(data):
+        start = time.time()
+        result = f(data)
+        lock.acquire()
+        try:
+            times[key(data)] = times.get(key(data), 0) + time.time()-start
+        finally:
+            lock.release()
+        return result
+    return p_func.pmap(_timed, tasks, num_workers=processors)
+
+def memory_ceiling(max_memory, meminfo="/proc/meminfo", cgroup_root="/sys/fs/cgroup"):
+    """bytes of memory that concurrent searches, or the matrix build,
+    may use: max_memory GB if set, otherwise 90% of the memory of the
+    machine or cgroup"""
+    if max_memory > 0:
+        return int(max_memory*1024**3)
+    limits = [ ]
+    try:
+        for line in open(meminfo):
+            if line.startswith("MemTotal:"):
+                limits.append(int(line.split()[1])*1024)
+    except (IOError, ValueError):
+        pass
+    for limit_file in ["memory.max", os.path.join("memory", "memory.limit_in_bytes")]:
+        try:
+            limits.append(int(open(os.path.join(cgroup_root, limit_file)).read()))
+        except (IOError, ValueError):
+            pass
+    if not limits:
+        return None
+    return int(0.9*min(limits))
+
+def estimate_memory(genome_bytes, query_bytes):
+    """rough peak memory of one search, before scaling by what
+    finished searches actually used"""
+    return MEM_BASE + MEM_PER_GENOME_BYTE*genome_bytes + MEM_PER_QUERY_BYTE*query_bytes
 
+def genome_hash(f):
+    """SHA-1 of a file's contents"""
+    sha = hashlib.sha1()
+    infile = open(f, "rb")
+    for block in iter(lambda: infile.read(1024*1024), ""):
+        sha.update(block)
+    infile.close()
+    return sha.hexdigest()
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+def run_prodigal(f, cache_dir=None, preexec_fn=None):
+    """predict the genes of genome f into f_genes.seqs and f_genes.pep.
+    With a cache_dir, predictions are stored by the SHA-1 of the genome
+    and a genome with the same contents is never predicted again"""
+    if cache_dir is None:
+        subprocess.check_call("prodigal -i %s -d %s_genes.seqs -a %s_genes.pep > /dev/null 2>&1" % (f, f, f),
+                              shell=True, preexec_fn=preexec_fn)
+        return
+    cached = os.path.join(cache_dir, genome_hash(f))
+    if not os.path.exists("%s.seqs" % cached) or not os.path.exists("%s.pep" % cached):
+        """predict into temporary names, so a cache entry is never seen half written"""
+        tmp = "%s.%s.tmp" % (cached, get_seq_name(f))
+        subprocess.check_call("prodigal -i %s -d %s.seqs -a %s.pep > /dev/null 2>&1" % (f, tmp, tmp),
+                              shell=True, preexec_fn=preexec_fn)
+        os.rename("%s.pep" % tmp, "%s.pep" % cached)
+        os.rename("%s.seqs" % tmp, "%s.seqs" % cached)
+    link_or_copy("%s.seqs" % cached, "%s_genes.seqs" % f)
+    link_or_copy("%s.pep" % cached, "%s_genes.pep" % f)
+
+def collect_genes(files, done, out_fasta, origins=None):
+    """stream the predicted genes of each genome into out_fasta as soon
+    as its prediction is received from the done channel, keeping the
+    order of files.  Genes containing an N are dropped and the rest are
+    renamed centroid_<n>, listed in origins next to their genome.
+    Returns the number of genes written"""
+    ready = set()
+    outfile = open(out_fasta, "w")
+    if origins:
+        origins_file = open(origins, "w")
+    kept = 0
+    for f in files:
+        while f not in ready:
+            ready.add(done.receive())
+        try:
+            infile = open("%s_genes.seqs" % f, "rU")
+        except IOError:
+            print "no genes were predicted for genome %s" % f
+            continue
+        for gene, seq in read_fasta(infile):
+            if "N" not in seq:
+                name = "centroid"+"_"+str(autoIncrement())
+                write_fasta(outfile, name, seq)
+                if origins:
+                    print >> origins_file, "%s\t%s" % (name, get_seq_name(f))
+                kept += 1
+        infile.close()
+    outfile.close()
+    if origins:
+        origins_file.close()
+    return kept
 
-def predict_genes(dir_path, processors):
+def predict_genes(dir_path, processors, pin="F", cache_dir=None, out_fasta=None, origins=None):
     """simple gene prediction using Prodigal in order
-    to find coding regions from a genome sequence"""    
+    to find coding regions from a genome sequence.
+    Largest genomes are started first.  With out_fasta,
+    genes are collected into it while predictions run,
+    and the number of genes collected is returned; origins
+    lists the genome each of them came from"""
     os.chdir("%s/joined" % dir_path)
     curr_dir=os.getcwd()
-    files = os.listdir(curr_dir)
-    files_and_temp_names = [(str(idx), os.path.join(curr_dir, f))
+    times_file = os.path.join(dir_path, TASK_TIMES)
+    times = read_task_times(times_file)
+    files = order_by_cost([os.path.join(curr_dir, f) for f in os.listdir(curr_dir) if f.endswith(".fasta.new")], "prodigal", times)
+    files_and_temp_names = [(str(idx), f)
                             for idx, f in enumerate(files)]
+    if cache_dir is not None and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    pool = cpu_slot_pool(processors, 1, pin)
+    done = Channel()
+    collected = [ ]
+    errors = [ ]
+    def _collect():
+        try:
+            collected.append(collect_genes(sorted(files), done, out_fasta, origins))
+        except Exception, err:
+            errors.append(err)
+    if out_fasta:
+        collector = threads.runThread(_collect)
     def _perform_workflow(data):
         tn, f = data
-        subprocess.check_call("prodigal -i %s -d %s_genes.seqs -a %s_genes.pep > /dev/null 2>&1" % (f, f, f), shell=True)
-    results = set(p_func.pmap(_perform_workflow,
-                              files_and_temp_names,
-                              num_workers=processors))
+        try:
+            run_pinned(pool, lambda preexec_fn: run_prodigal(f, cache_dir, preexec_fn))
+        finally:
+            done.send(f)
+    new_times = {}
+    results = set(timed_pmap(_perform_workflow,
+                             files_and_temp_names,
+                             processors, new_times,
+                             lambda data: task_key("prodigal", data[1])))
+    times.update(new_times)
+    write_task_times(times_file, new_times)
+    if out_fasta:
+        collector.join()
+        if errors:
+            raise errors[0]
+        return collected[0]
 
 def rename_fasta_header(fasta_in, fasta_out):
     """this is used for renaming the output,
@@ -96,30 +562,93 @@ def rename_fasta_header(fasta_in, fasta_out):
     rec=1
     handle = open(fasta_out, "w")
     outdata = [ ]
-    for record in SeqIO.parse(open(fasta_in), "fasta"):
+    for name, seq in read_fasta(fasta_in):
         try:
-            outdata.append(">"+"centroid"+"_"+record.id)
-            print >> handle, ">"+"centroid"+"_"+str(autoIncrement())
-            print >> handle, record.seq
+            outdata.append(">"+"centroid"+"_"+name)
+            write_fasta(handle, "centroid"+"_"+str(autoIncrement()), seq)
         except:
             raise TypeError("problem with input sequence encountered")
     handle.close()
     return outdata
     
-def translate_consensus(consensus):
-    """translate nucleotide into peptide with BioPython"""
-    infile = open(consensus, "rU")
-    output_handle = open("tmp.pep", "w")
-    outdata = [ ]
-    for record in SeqIO.parse(infile, "fasta"):
-        try:
-            print >> output_handle, ">"+record.id
-            print >> output_handle, record.seq.translate(to_stop=True)
-            outdata.append(record.seq.translate(to_stop=True))
-        except:
-            raise TypeError("invalid character observed in sequence %s" % record.id)
-    for record in outdata: return str(record)
-    output_handle.close()
+_codon_tables = {}
+
+def codon_table(table_id):
+    """amino acid of each of the 64 codons, indexed by
+    16*first+4*second+third base with A, C, G, T as 0-3"""
+    from Bio.Data import CodonTable
+    if table_id not in _codon_tables:
+        table = CodonTable.unambiguous_dna_by_id[table_id]
+        aa = [ ]
+        for codon in itertools.product("ACGT", repeat=3):
+            codon = "".join(codon)
+            aa.append(table.forward_table.get(codon, "*"))
+        _codon_tables[table_id] = np.frombuffer("".join(aa), dtype=np.uint8)
+    return _codon_tables[table_id]
+
+def translate_records(records, table=1):
+    """translate (id, sequence) records up to their first stop codon.
+    The codons of all ACGT sequences are looked up in the codon table
+    at once; anything else is left to BioPython"""
+    from Bio.Seq import translate
+    codes = np.zeros(256, dtype=np.uint8)
+    for code, base in enumerate("ACGT"):
+        codes[ord(base)] = code
+    peptides = [None]*len(records)
+    plain = [ ]
+    for idx, (name, seq) in enumerate(records):
+        seq = seq.upper()
+        if seq.translate(None, "ACGT"):
+            try:
+                peptides[idx] = str(translate(seq, to_stop=True, table=table))
+            except:
+                raise TypeError("invalid character observed in sequence %s" % name)
+        else:
+            plain.append((idx, seq[:len(seq)//3*3]))
+    enc = codes[np.frombuffer("".join([seq for idx, seq in plain]), dtype=np.uint8)]
+    aa = codon_table(table)[enc[0::3]*16+enc[1::3]*4+enc[2::3]].tostring()
+    start = 0
+    for idx, seq in plain:
+        peptides[idx] = aa[start:start+len(seq)//3].split("*", 1)[0]
+        start += len(seq)//3
+    return [(name, peptide) for (name, seq), peptide in zip(records, peptides)]
+
+def _translate_chunk(data):
+    records, table = data
+    return translate_records(records, table)
+
+def translate_fasta(in_fasta, out_pep, table=1, min_length=0, processors=1):
+    """translate each record of in_fasta into out_pep, keeping
+    peptides of at least min_length.  Chunks of records are
+    translated on a pool of processors processes and written in
+    order as they finish.  Returns the first peptide written"""
+    records = read_fasta(in_fasta)
+    chunks = ((chunk, table) for chunk in iter(lambda: list(itertools.islice(records, TRANSLATE_CHUNK)), []))
+    if processors > 1:
+        pool = multiprocessing.Pool(processors)
+        results = pool.imap(_translate_chunk, chunks)
+    else:
+        pool = None
+        results = itertools.imap(_translate_chunk, chunks)
+    output_handle = open(out_pep, "w")
+    first = None
+    try:
+        for chunk in results:
+            for name, peptide in chunk:
+                if len(peptide) >= min_length:
+                    write_fasta(output_handle, name, peptide)
+                    if first is None:
+                        first = peptide
+    finally:
+        output_handle.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return first
+
+def translate_consensus(consensus, processors=1):
+    """translate nucleotide into peptide"""
+    return translate_fasta(consensus, "tmp.pep", 1, 0, processors)
     
 def uclust_cluster(usearch, id):
     devnull = open("/dev/null", "w")
@@ -167,75 +696,432 @@ def blast_against_each_genome(dir_path, processors, filter, peptides, blast, pen
                               files_and_temp_names,
                               num_workers=processors))
 
-def blast_against_each_genome_tblastn(dir_path, processors, peptides):
-    """BLAST all peptides against each genome"""
-    curr_dir=os.getcwd()
-    files = os.listdir(curr_dir)
-    devnull = open("/scratch/jsahl/LS-BSR/run/blast_error.txt", "w")
-    files_and_temp_names = [(str(idx), os.path.join(curr_dir, f))
-                            for idx, f in enumerate(files)]
-    def _perform_workflow(data):
-	tn, f = data
-        if ".fasta.new" in f:
+def fasta_stats(in_fasta):
+    """number of sequences and total residues in a fasta file"""
+    num_seqs = 0
+    residues = 0
+    for name, seq in read_fasta(in_fasta):
+        num_seqs += 1
+        residues += len(seq)
+    return num_seqs, residues
+
+def query_shard_count(genome_sizes, num_queries, processors):
+    """number of shards to split the query set into.  The genome x shard
+    grid should have about TASKS_PER_WORKER tasks per worker, with the
+    task for the largest genome no bigger than the average, and no shard
+    smaller than MIN_SHARD_QUERIES queries"""
+    if len(genome_sizes) == 0:
+        return 1
+    target = sum(genome_sizes)/(TASKS_PER_WORKER*processors)
+    shards = int(math.ceil(max(genome_sizes)/max(target, 1)))
+    return max(1, min(shards, num_queries//MIN_SHARD_QUERIES))
+
+def split_queries(queries, num_shards):
+    """split a fasta into shards of similar total length, keeping
+    records whole.  Returns the shard file names"""
+    if num_shards <= 1:
+        return [queries]
+    num_seqs, residues = fasta_stats(queries)
+    shards = ["%s.shard%s" % (queries, idx) for idx in range(num_shards)]
+    outfiles = [open(x, "w") for x in shards]
+    written = 0
+    for name, seq in read_fasta(queries):
+        idx = min(int(written*num_shards/max(residues, 1)), num_shards-1)
+        write_fasta(outfiles[idx], name, seq)
+        written += len(seq)
+    for outfile in outfiles: outfile.close()
+    return shards
+
+def format_genome_db(f, dbtype):
+    """makeblastdb for genome f, unless it is already formatted"""
+    if genome_db_formatted(f, dbtype):
+        return
+    try:
+        subprocess.check_call("makeblastdb -in %s -dbtype %s > /dev/null 2>&1" % (f, dbtype), shell=True)
+    except:
+        print >> sys.stderr, "problem found in formatting genome %s" % f
+
+def format_genome_dbs(files, dbtype, stop):
+    """format genomes one at a time until stop, a threading.Event, is
+    set.  Meant to run in the background while genes are predicted and
+    clustered; search_genome_grid formats whatever is left"""
+    for f in files:
+        if stop.isSet():
+            break
+        format_genome_db(f, dbtype)
+
+def merge_shard_outputs(f, num_shards):
+    """concatenate the shard outputs of genome f into its _blast.out"""
+    outfile = open("%s_blast.out" % f, "w")
+    for idx in range(num_shards):
+        try:
+            shutil.copyfileobj(open("%s_blast.out.%s" % (f, idx)), outfile)
+            os.remove("%s_blast.out.%s" % (f, idx))
+        except IOError:
+            print "genomes %s cannot be used" % f
+    outfile.close()
+
+def genome_db_formatted(f, dbtype):
+    prefix = {"nucl": "n", "prot": "p"}[dbtype]
+    return os.path.exists("%s.%sin" % (f, prefix)) or os.path.exists("%s.%sal" % (f, prefix))
+
+def start_reducer(reduce):
+    """run reduce(report) in a thread of its own for each report sent
+    to the returned channel, until None is sent.  Returns the channel
+    and a function that waits for the thread and raises its first error"""
+    reports = Channel()
+    errors = [ ]
+    def _reduce_all():
+        while True:
+            report = reports.receive()
+            if report is None:
+                return
             try:
-                subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % f, shell=True)
-            except:
+                reduce(report)
+            except Exception, err:
+                errors.append(err)
+    thread = threads.runThread(_reduce_all)
+    def _finish():
+        reports.send(None)
+        thread.join()
+        if errors:
+            raise errors[0]
+    return reports, _finish
+
+def search_genome_grid(dir_path, processors, queries, stage, dbtype, search_cmd, mem_limit=None, pin="F", genome_queries=None, reduce=None, timeout=None):
+    """run search_cmd(query, genome, threads), a program writing its hits
+    to stdout, for every genome x query shard pair, then merge each
+    genome's shard outputs into its _blast.out.  dbtype is passed to
+    makeblastdb, or None if no database is needed.  Each genome is a
+    chain of database -> searches -> merge -> reduce(_blast.out), and
+    every step starts as soon as the steps it needs are done.  All
+    programs run from one event loop (commands.runProgramQueue); reduce
+    runs in a thread of its own.  Searches for the most expensive genomes
+    are started first, and processors is split between the searches
+    running at once.  With a mem_limit in bytes, a search only starts if
+    its estimated memory fits next to the searches already running;
+    estimates are scaled up to the peak memory measured on finished
+    searches.  With pin set to T, each search is pinned to CPUs of a
+    single NUMA node.  A search running longer than timeout seconds is
+    killed.  A genome with a search that fails, times out or cannot be
+    started gets no _blast.out and is not reduced; its other searches
+    still run, and its shard outputs are removed.  Anything each
+    genome's programs write to stderr is kept in its .log file.
+    genome_queries can map a genome to its own query file, used instead
+    of queries; genomes it leaves out are not searched"""
+    curr_dir=os.getcwd()
+    times_file = os.path.join(dir_path, TASK_TIMES)
+    times = read_task_times(times_file)
+    files = order_by_cost([os.path.join(curr_dir, f) for f in os.listdir(curr_dir) if f.endswith(".fasta.new")], stage, times)
+    if genome_queries is None:
+        genome_queries = dict([(f, queries) for f in files])
+    files = [f for f in files if f in genome_queries]
+    shards_for = {}
+    for query_file in set([genome_queries[f] for f in files]):
+        num_queries, residues = fasta_stats(query_file)
+        genome_sizes = [os.path.getsize(f) for f in files if genome_queries[f] == query_file]
+        if num_queries == 0:
+            shards_for[query_file] = [ ]
+        else:
+            shards_for[query_file] = split_queries(query_file, query_shard_count(genome_sizes, num_queries, processors))
+    grid = [(f, idx, shard) for f in files for idx, shard in enumerate(shards_for[genome_queries[f]])]
+    workers, threads = plan_threads(processors, len(grid))
+    pool = cpu_slot_pool(workers, threads, pin)
+    sizes = dict([(x, os.path.getsize(x)) for x in files+[y for x in shards_for.values() for y in x]])
+    scale = {'ratio': 1.0}
+    new_times = {}
+    unformatted = [f for f in files if dbtype and not genome_db_formatted(f, dbtype)]
+    formatting = set(unformatted)
+    pending = list(grid)
+    left = dict([(f, len([x for x in grid if x[0] == f])) for f in files])
+    state = {'used': 0}
+    failed = set()
+    if reduce:
+        reports, finish_reduce = start_reducer(reduce)
+    def _log(f, lines):
+        if lines:
+            open("%s.log" % f, "a").write("".join(lines))
+    def _genome_done(f):
+        if f in failed:
+            print "genomes %s cannot be used, see %s.log" % (f, f)
+            for name in ["%s_blast.out.%s" % (f, idx) for idx in range(len(shards_for[genome_queries[f]]))]+["%s_blast.out" % f]:
+                if os.path.exists(name):
+                    os.remove(name)
+            return
+        merge_shard_outputs(f, len(shards_for[genome_queries[f]]))
+        if reduce:
+            reports.send("%s_blast.out" % f)
+    def _memory(f, shard):
+        return estimate_memory(sizes[f], sizes[shard])*scale['ratio']
+    def _db_done(f, errors):
+        def _done(runner):
+            if runner.error is not None:
+                errors.append("makeblastdb could not be started: %s\n" % runner.error)
+            _log(f, errors)
+            if runner.exitCode != 0:
                 print "problem found in formatting genome %s" % f
-        if ".fasta.new" in f:
-            try:
-                devnull = open('/dev/null', 'w')
-                cmd = ["tblastn",
-                       "-query", peptides,
-                       "-db", f,
-                       "-num_threads", str(processors),
-                       "-evalue", "0.1",
-                       "-outfmt", "6",
-                       "-out", "%s_blast.out" % f]
-                subprocess.call(cmd, stdout=devnull, stderr=devnull)
-            except:
-                print "genomes %s cannot be used" % f
-            
-    results = set(p_func.pmap(_perform_workflow,
-                              files_and_temp_names,
-                              num_workers=processors))
+                failed.add(f)
+            formatting.discard(f)
+        return _done
+    def _search_done(f, shard, cost, cpus, out, errors, start):
+        def _done(runner):
+            out.close()
+            if runner.error is not None:
+                errors.append("%s could not be started: %s\n" % (runner.cmd, runner.error))
+            _log(f, errors)
+            state['used'] -= cost
+            if cpus is not None:
+                pool.put(cpus)
+            new_times[task_key(stage, f)] = new_times.get(task_key(stage, f), 0) + time.time()-start
+            if runner.maxRSS is not None:
+                scale['ratio'] = max(scale['ratio'], runner.maxRSS/estimate_memory(sizes[f], sizes[shard]))
+            if runner.timedOut:
+                print "search of genome %s timed out after %s seconds" % (f, timeout)
+            if runner.exitCode != 0:
+                failed.add(f)
+            left[f] -= 1
+            if left[f] == 0:
+                _genome_done(f)
+        return _done
+    def _next():
+        if unformatted:
+            f = unformatted.pop(0)
+            errors = [ ]
+            return commands.ProgramRunner(["makeblastdb", "-in", f, "-dbtype", dbtype], None, errors.append,
+                                          onDone=_db_done(f, errors))
+        for i, (f, idx, shard) in enumerate(pending):
+            if f in formatting:
+                continue
+            cost = _memory(f, shard)
+            if mem_limit and state['used'] + cost > mem_limit and state['used'] > 0:
+                continue
+            del pending[i]
+            state['used'] += cost
+            if pool is None:
+                cpus = None
+                preexec_fn = None
+            else:
+                cpus = pool.get()
+                preexec_fn = affinity_setter(cpus)
+            out = open("%s_blast.out.%s" % (f, idx), "w")
+            errors = [ ]
+            return commands.ProgramRunner(search_cmd(shard, f, threads), out.write, errors.append,
+                                          timeout=timeout, preexec_fn=preexec_fn,
+                                          onDone=_search_done(f, shard, cost, cpus, out, errors, time.time()))
+        if pending:
+            return None
+        raise StopIteration
+    for f in files:
+        if left[f] == 0:
+            _genome_done(f)
+    try:
+        commands.runProgramQueue(_next, workers)
+    finally:
+        if reduce:
+            finish_reduce()
+    times.update(new_times)
+    write_task_times(times_file, new_times)
+    for query_file, shards in shards_for.iteritems():
+        for shard in shards:
+            if shard != query_file: os.remove(shard)
 
-def blast_against_each_genome_blastn(dir_path, processors, filter, peptides, penalty, reward):
-    """BLAST all peptides against each genome"""
+def search_command(blast, query, f, threads, filter="F", penalty=-5, reward=1):
+    """the command searching query against genome f, or against its
+    predicted proteome with blastp, writing tabular hits to stdout"""
+    if "blat" == blast:
+        """BLAT is single threaded, and writes to stdout
+        when given it as the output file"""
+        return ["blat", "-out=blast8", "-minIdentity=75", f, query, "stdout"]
+    if "blastp" == blast:
+        f = "%s_genes.pep" % f
+    cmd = [blast,
+           "-query", query,
+           "-db", f,
+           "-num_threads", str(threads),
+           "-evalue", "0.1",
+           "-outfmt", "6"]
+    if "blastn" == blast:
+        if "F" in filter:
+            my_seg = "yes"
+        else:
+            my_seg = "no"
+        cmd.extend(["-dust", str(my_seg),
+                    "-penalty", str(penalty),
+                    "-reward", str(reward)])
+    return cmd
+
+def blast_against_each_genome_tblastn(dir_path, processors, peptides, mem_limit=None, pin="F", genome_queries=None, reduce=None, timeout=None):
+    """BLAST all peptides against each genome, as a grid
+    of genome x query shard tasks"""
+    def _search_cmd(query, f, threads):
+        return search_command("tblastn", query, f, threads)
+    search_genome_grid(dir_path, processors, peptides, "tblastn", "nucl", _search_cmd, mem_limit, pin, genome_queries, reduce, timeout)
+
+def unhit_queries(queries, report, out_fasta):
+    """write the queries that have no hit in a tabular report"""
+    found = set([line.split("\t",1)[0] for line in open(report, "U")])
+    outfile = open(out_fasta, "w")
+    for name, seq in read_fasta(queries):
+        if name not in found:
+            write_fasta(outfile, name, seq)
+    outfile.close()
+
+def blast_against_each_proteome(dir_path, processors, peptides, mem_limit=None, pin="F", genome_queries=None, timeout=None):
+    """blastp the peptides against the proteome Prodigal predicted
+    for each genome.  Peptides without a hit in a genome's proteome
+    are then searched against the genome itself with tblastn"""
+    curr_dir=os.getcwd()
+    files = [os.path.join(curr_dir, f) for f in os.listdir(curr_dir) if f.endswith(".fasta.new")]
+    if genome_queries is None:
+        genome_queries = dict([(f, peptides) for f in files])
+    def _format_db(data):
+        tn, f = data
+        try:
+            subprocess.check_call("makeblastdb -in %s_genes.pep -dbtype prot > /dev/null 2>&1" % f, shell=True)
+        except:
+            print "problem found in formatting proteome %s_genes.pep" % f
+    set(p_func.pmap(_format_db,
+                    [(str(idx), f) for idx, f in enumerate(files)],
+                    num_workers=processors))
+    def _search_cmd(query, f, threads):
+        return search_command("blastp", query, f, threads)
+    search_genome_grid(dir_path, processors, peptides, "blastp", None, _search_cmd, mem_limit, pin, genome_queries, None, timeout)
+    fallback = {}
+    for f in files:
+        if not os.path.exists("%s_blast.out" % f):
+            continue
+        os.rename("%s_blast.out" % f, "%s_blastp.out" % f)
+        fallback[f] = "%s.fallback" % f
+        unhit_queries(genome_queries[f], "%s_blastp.out" % f, fallback[f])
+    blast_against_each_genome_tblastn(dir_path, processors, peptides, mem_limit, pin, fallback, None, timeout)
+    for f in fallback:
+        if not os.path.exists("%s_blast.out" % f):
+            os.remove("%s_blastp.out" % f)
+            continue
+        outfile = open("%s_blast.out" % f, "a")
+        shutil.copyfileobj(open("%s_blastp.out" % f), outfile)
+        outfile.close()
+        os.remove("%s_blastp.out" % f)
+
+def blast_against_each_genome_blastn(dir_path, processors, filter, peptides, penalty, reward, mem_limit=None, pin="F", genome_queries=None, reduce=None, timeout=None):
+    """BLAST all peptides against each genome, as a grid
+    of genome x query shard tasks"""
+    def _search_cmd(query, f, threads):
+        return search_command("blastn", query, f, threads, filter, penalty, reward)
+    search_genome_grid(dir_path, processors, peptides, "blastn", "nucl", _search_cmd, mem_limit, pin, genome_queries, reduce, timeout)
+
+def genome_batches(files, processors, max_bases=MAX_BATCH_BASES):
+    """group genomes into batches of similar total size, with at
+    least one batch per worker and no more than max_bases per batch
+    unless a single genome is larger"""
+    sizes = sorted([(os.path.getsize(f), f) for f in files], reverse=True)
+    total = sum([size for size, f in sizes])
+    num_batches = max(min(processors, len(files)), int(math.ceil(total/max_bases)))
+    num_batches = min(num_batches, len(files))
+    batches = [[0, []] for x in range(num_batches)]
+    for size, f in sizes:
+        smallest = min(batches, key=lambda b: b[0])
+        smallest[0] += size
+        smallest[1].append(f)
+    return [sorted(b[1]) for b in batches]
+
+def write_batch_db(batch, out_fasta):
+    """concatenate a batch of genomes into one fasta.  Each sequence
+    is renamed to g<genome index>_<n>; the original IDs are returned"""
+    seq_ids = {}
+    outfile = open(out_fasta, "w")
+    for idx, f in enumerate(batch):
+        for name, seq in read_fasta(f):
+            tag = "g%s_%s" % (idx, len(seq_ids))
+            seq_ids.update({tag:name})
+            write_fasta(outfile, tag, seq)
+    outfile.close()
+    return seq_ids
+
+def split_batch_report(report, batch, seq_ids):
+    """write the hits from a batched search back out to one
+    report per genome, restoring the original subject IDs"""
+    outfiles = [open("%s_blast.out" % f, "w") for f in batch]
+    for line in open(report, "U"):
+        fields = line.split("\t")
+        try:
+            genome = int(fields[1][1:].split("_",1)[0])
+            fields[1] = seq_ids[fields[1]]
+        except:
+            raise TypeError("malformed blast line found")
+        outfiles[genome].write("\t".join(fields))
+    for outfile in outfiles: outfile.close()
+
+def blast_against_genome_batches(dir_path, processors, queries, blast, filter, penalty, reward):
+    """search all queries against batches of genomes, one database
+    and one search per batch, then split the hits back out per genome"""
     if "F" in filter:
         my_seg = "yes"
     else:
         my_seg = "no"
     curr_dir=os.getcwd()
-    files = os.listdir(curr_dir)
-    files_and_temp_names = [(str(idx), os.path.join(curr_dir, f))
-                            for idx, f in enumerate(files)]
+    files = [os.path.join(curr_dir, f) for f in os.listdir(curr_dir) if f.endswith(".fasta.new")]
+    batches = genome_batches(files, processors)
+    files_and_temp_names = [(str(idx), batch)
+                            for idx, batch in enumerate(batches)]
+    workers, threads = plan_threads(processors, len(batches))
     def _perform_workflow(data):
-	tn, f = data
-        if ".fasta.new" in f:
-            try:
-                subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % f, shell=True)
-            except:
-                print "problem found in formatting genome %s" % f
-        if ".fasta.new" in f:
-            devnull = open('/dev/null', 'w')
-            try:
-                cmd = ["blastn",
-                       "-query", peptides,
-                       "-db", f,
-                       "-dust", str(my_seg),
-                       "-num_threads", str(processors),
+        tn, batch = data
+        db = os.path.join(curr_dir, "batch_%s.fasta" % tn)
+        report = "%s.out" % db
+        seq_ids = write_batch_db(batch, db)
+        """searches are as deep as the number of sequences in the batch, and
+        E-values are calculated as if searching the largest genome alone"""
+        limits = ["-max_target_seqs", str(max(500, len(seq_ids))),
+                  "-dbsize", str(max([os.path.getsize(f) for f in batch]))]
+        devnull = open('/dev/null', 'w')
+        try:
+            if blast == "blat":
+                subprocess.check_call("blat -out=blast8 -minIdentity=75 %s %s %s > /dev/null 2>&1" % (db,queries,report), shell=True)
+            else:
+                subprocess.check_call("makeblastdb -in %s -dbtype nucl > /dev/null 2>&1" % db, shell=True)
+                cmd = [blast,
+                       "-query", queries,
+                       "-db", db,
+                       "-num_threads", str(threads),
                        "-evalue", "0.1",
                        "-outfmt", "6",
-                       "-penalty", str(penalty),
-                       "-reward", str(reward),
-                       "-out", "%s_blast.out" % f]
+                       "-out", report] + limits
+                if blast == "blastn":
+                    cmd.extend(["-dust", str(my_seg),
+                                "-penalty", str(penalty),
+                                "-reward", str(reward)])
                 subprocess.call(cmd, stdout=devnull, stderr=devnull)
-            except:
-                print "The genome file %s was not processed" % f
-            
+            split_batch_report(report, batch, seq_ids)
+        except:
+            print "batch of genomes %s cannot be used" % " ".join(batch)
+        os.system("rm -f %s*" % db)
     results = set(p_func.pmap(_perform_workflow,
                               files_and_temp_names,
-                              num_workers=processors))
+                              num_workers=workers))
+
+def search_genomes(dir_path, processors, queries, blast, filter, penalty, reward, batch="F", mem_limit=None, pin="F", genome_queries=None, reduce=None, timeout=None):
+    """search the queries against each genome in the current
+    directory, one genome at a time or in batches of genomes.
+    Batches are not used when genomes have their own queries.
+    reduce, if given, is called with each genome's finished
+    _blast.out as soon as it is complete, except with batches
+    and blastp, whose outputs are only complete at the end.
+    blastp searches proteomes, which are never batched.
+    Searches of single genomes running longer than timeout
+    seconds are killed"""
+    if "T" == batch and "blastp" == blast:
+        raise TypeError("batches of genomes can't be searched with blastp")
+    if "T" == batch and genome_queries is None:
+        blast_against_genome_batches(dir_path, processors, queries, blast, filter, penalty, reward)
+    elif "tblastn" == blast:
+        blast_against_each_genome_tblastn(dir_path, processors, queries, mem_limit, pin, genome_queries, reduce, timeout)
+    elif "blastn" == blast:
+        blast_against_each_genome_blastn(dir_path, processors, filter, queries, penalty, reward, mem_limit, pin, genome_queries, reduce, timeout)
+    elif "blastp" == blast:
+        blast_against_each_proteome(dir_path, processors, queries, mem_limit, pin, genome_queries, timeout)
+    elif "blat" == blast:
+        blat_against_each_genome(dir_path, queries, processors, mem_limit, pin, genome_queries, reduce, timeout)
 
 def get_seq_name(in_fasta):
     """used for renaming the sequences"""
@@ -245,15 +1131,12 @@ def filter_seqs(input_pep):
     """filter out short sequences from a multifasta.
     Will hopefully speed up the process without losing
     important information"""
-    long_sequences = [ ]
-    infile = open(input_pep, "rU")
     outfile = open("consensus.pep", "w")
     outdata = [ ]
-    for record in SeqIO.parse(infile, "fasta"):
-        if len(record.seq) >= int(50):
-            long_sequences.append(record)
-            outdata.append(len(record.seq))
-    SeqIO.write(long_sequences, outfile, "fasta")
+    for title, seq in read_fasta(input_pep, True):
+        if len(seq) >= int(50):
+            write_fasta(outfile, title, seq, 60)
+            outdata.append(len(seq))
     outfile.close()
     return outdata
 
@@ -340,23 +1223,69 @@ def parse_self_blast(lines):
             raise TypeError("blast file is malformed")
     return my_dict
 
-def translate_genes(genes):
-    """translate nucleotide into peptide with BioPython"""
-    infile = open(genes, "rU")
-    output = [ ]
-    output_handle = open("genes.pep", "w")
-    for record in SeqIO.parse(infile, "fasta"):
+def local_self_score(seq, self_scores, missing):
+    """raw score of the best local alignment of a sequence
+    against itself, ungapped along the diagonal"""
+    best = 0
+    running = 0
+    for x in seq.upper():
+        running = max(0, running + self_scores.get(x, missing))
+        best = max(best, running)
+    return best
+
+def format_bit_score(score):
+    """format a bit score the way BLAST tabular output does"""
+    if score > 99.9:
+        return "%.0f" % score
+    else:
+        return "%.1f" % score
+
+def calculate_self_scores(in_fasta, blast, penalty=-5, reward=1):
+    """calculate the bit score of each query aligned against itself
+    from the scoring system, instead of running a self-search.  Every
+    sequence in the file gets a value"""
+    if blast == "tblastn" or blast == "blastp":
+        lambda_k = BLOSUM62_LAMBDA_K
+    elif blast == "blastn":
         try:
-            if len(record.seq.translate(to_stop=True, table=11))>=30:
-                print >> output_handle, ">"+record.id
-                print >> output_handle, record.seq.translate(to_stop=True, table=11)
-                output.append(record.seq.translate(to_stop=True, table=11))
-        except:
-            raise TypeError("odd characters observed in sequence")
-    for record in output: return str(record)
-    infile.close()
-    output_handle.close()
-    return output
+            lambda_k = BLASTN_LAMBDA_K[(int(reward), int(penalty))]
+        except KeyError:
+            raise ValueError("reward/penalty of %s/%s not supported by blastn" % (reward, penalty))
+    elif blast == "blat":
+        lambda_k = None
+    else:
+        raise ValueError("no scoring system known for %s" % blast)
+    my_dict = {}
+    for name, seq in read_fasta(in_fasta):
+        if lambda_k is None:
+            raw = local_self_score(seq, BLASTZ_SELF, -100)
+            my_dict.update({name:"%d.0" % round(raw*BLASTZ_TO_BITS)})
+            continue
+        if blast == "blastn":
+            raw = local_self_score(seq, dict.fromkeys("ACGT", int(reward)), int(penalty))
+        else:
+            raw = local_self_score(seq, BLOSUM62_SELF, -1)
+        lam, k = lambda_k
+        bits = (lam*raw - math.log(k))/math.log(2)
+        my_dict.update({name:format_bit_score(bits)})
+    return my_dict
+
+def compare_self_scores(calculated, observed):
+    """relative difference between calculated self scores and
+    those reported by a self-search, for each gene found in both"""
+    deviations = {}
+    for k,v in observed.iteritems():
+        if k in calculated:
+            deviations.update({k:(float(calculated[k])-float(v))/float(v)})
+    return deviations
+
+def translate_genes(genes, processors=1):
+    """translate nucleotide into peptide, keeping
+    peptides of at least 30 amino acids"""
+    first = translate_fasta(genes, "genes.pep", 11, 30, processors)
+    if first is None:
+        return [ ]
+    return first
 
 rec=1
 
@@ -417,7 +1346,6 @@ def prune_matrix(matrix, group1, group2):
     in_matrix.close()
     
 def compare_values(pruned_1,pruned_2,upper,lower):
-    import numpy as np
     group1 = open(pruned_1, "U")
     group2 = open(pruned_2, "U")
     group1_out = open("group1_out.txt", "w")
@@ -459,32 +1387,28 @@ def compare_values(pruned_1,pruned_2,upper,lower):
 def find_uniques(combined,fasta):
     infile = open(combined, "U")
     group1_unique_ids = [ ]
-    seqrecords=[ ]
     testids = [ ]
     for line in infile:
 	fields=line.split()
 	if int(fields[2])/int(fields[3])==1 and int(fields[8])==0:
 	    group1_unique_ids.append(fields[0])
-    for record in SeqIO.parse(fasta, "fasta"):
-	if record.id in group1_unique_ids:
-	    seqrecords.append(record)
-        if record.id in group1_unique_ids:
-            testids.append(record.id)
     output_handle = open("group1_unique_seqs.fasta", "w")
-    SeqIO.write(seqrecords, output_handle, "fasta")
+    for title, seq in read_fasta(fasta, True):
+        name = fasta_id(title)
+        if name in group1_unique_ids:
+            write_fasta(output_handle, title, seq, 60)
+            testids.append(name)
     output_handle.close()
     group2_unique_ids = [ ]
-    seqrecords2 = [ ]
     infile = open(combined, "rU")
     for line in infile:
 	fields=line.split()
 	if int(fields[6])/int(fields[7])==1 and int(fields[4])==0:
 	    group2_unique_ids.append(fields[0])
-    for record in SeqIO.parse(fasta, "fasta"):
-	if record.id in group2_unique_ids:
-	    seqrecords2.append(record)
     output_handle2 = open("group2_unique_seqs.fasta", "w")
-    SeqIO.write(seqrecords2, output_handle2, "fasta")
+    for title, seq in read_fasta(fasta, True):
+        if fasta_id(title) in group2_unique_ids:
+            write_fasta(output_handle2, title, seq, 60)
     output_handle2.close()
     return group1_unique_ids, group2_unique_ids, testids
 
@@ -591,62 +1515,365 @@ def get_frequencies(matrix, threshold):
     outfile.close()
     return out_data
 
-def find_dups(ref_scores, length, max_plog, min_hlog):
+def find_dups(ref_scores, length, max_plog, min_hlog, processors=1):
+    """count the qualifying hits of each query over every *_blast.out
+    in the current directory, in parallel, and report the duplicates
+    and paralogs as report_dups does"""
     curr_dir=os.getcwd()
-    my_dict_o = {}
-    dup_dict = {}
-    paralogs = [ ]
+    files = sorted(glob.glob(os.path.join(curr_dir, "*_blast.out")))
+    names, ref = hit_table_arrays(ref_scores, ref_scores)
+    results = hit_table_results(files, names, ref, length, min_hlog, processors)
+    summary = merge_dup_summaries([results[f][1] for f in files], len(names))
+    return report_dups(names, summary, max_plog)
+
+def dup_summary(query, score, num):
+    """the number of counted hits of each query index and their
+    largest and smallest scores (+inf for queries without one)"""
+    count = np.bincount(query, minlength=num)[:num]
+    top = group_max(query, score, num)
+    low = np.where(count > 0, -group_max(query, -score, num), np.inf)
+    return count, top, low
+
+def merge_dup_summaries(summaries, num):
+    """combine dup_summary results of several hit files"""
+    count = np.zeros(num, dtype=np.int64)
+    top = np.zeros(num)
+    low = np.zeros(num)+np.inf
+    for x in summaries:
+        count += x[0]
+        top = np.maximum(top, x[1])
+        low = np.minimum(low, x[2])
+    return count, top, low
+
+def report_dups(names, summary, max_plog):
+    """write the queries with more than one qualifying hit to
+    duplicate_ids.txt, and those whose weakest such hit scores at most
+    max_plog of their best one to paralog_ids.txt.  Returns the
+    paralogs and the number of hits of each duplicate"""
+    count, top, low = summary
+    dup = count >= 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        paralog = dup & (low/top <= max_plog)
+    dup_dict = dict(zip(names[dup].tolist(), count[dup].tolist()))
+    nr = names[paralog].tolist()
     duplicate_file = open("duplicate_ids.txt", "w")
+    for k in names[dup].tolist():
+        print >> duplicate_file, k
+    duplicate_file.close()
     paralog_file = open("paralog_ids.txt", "w")
-    for infile in glob.glob(os.path.join(curr_dir, "*_blast.out")):
-        try:
-            for line in open(infile, "U"):
-                fields = line.split()
-                if fields[0] not in ref_scores: pass
-                elif float(fields[2])>=int(min_hlog) and (float(fields[11])/float(ref_scores.get(fields[0])))>=float(length):
-                    try:
-                        my_dict_o[fields[0]].append(fields[11])
-                    except KeyError:
-                        my_dict_o[fields[0]] = [fields[11]]
-                else:
-                    continue
-        except:
-            raise TypeError("problem parsing %s" % infile)
-    for k,v in my_dict_o.iteritems():
-        if int(len(v))>=2:
-            dup_dict.update({k:v})
-    for k,v in dup_dict.iteritems():
-        max_value = max(v)
-        for x in v:
-            if float(x)/float(max_value)<=max_plog:
-                paralogs.append(k)
-            else:
-                continue
-    for k, v in dup_dict.iteritems():
-        print >> duplicate_file, k,"\n",
-    nr=[x for i, x in enumerate(paralogs) if x not in paralogs[i+1:]]
     print >> paralog_file, "\n".join(nr),
-    return nr, dup_dict
-    duplicate_file.close()
     paralog_file.close()
+    return nr, dup_dict
+
+def field_chars(buf, begin, end, width=None):
+    """the bytes from begin to end of each line as the rows of a 2D
+    uint8 array, padded with zeros to the longest field or cut at
+    width.  Rows are gathered a few at a time so the index arrays stay
+    small however long the longest field is"""
+    longest = max(1, int((end-begin).max()))
+    if width is None or width > longest:
+        width = longest
+    end = np.minimum(end, begin+width)
+    chars = np.zeros((len(begin), width), dtype=np.uint8)
+    step = max(1, FIELD_GATHER_BYTES//width)
+    for lo in range(0, len(begin), step):
+        idx = begin[lo:lo+step,None]+np.arange(width)
+        inside = idx < end[lo:lo+step,None]
+        chars[lo:lo+step][inside] = buf[idx[inside]]
+    return chars
+
+def field_bytes(buf, begin, end, width=None):
+    """the bytes from begin to end of each line as a NumPy string
+    array, cut at width"""
+    chars = np.ascontiguousarray(field_chars(buf, begin, end, width))
+    return chars.view("S%s" % chars.shape[1])[:,0]
+
+def field_numbers(buf, begin, end):
+    """the plain decimal number from begin to end of each line.  Digits
+    are accumulated column by column into an integer mantissa that is
+    scaled once, which rounds exactly like float(); fields in any other
+    notation are converted by NumPy, or by float() when longer than
+    NUMBER_BYTES"""
+    chars = field_chars(buf, begin, end, NUMBER_BYTES)
+    digit = (chars >= 48) & (chars <= 57)
+    dot = chars == 46
+    after = np.cumsum(dot, axis=1) > 0
+    plain = ((digit | dot | (chars == 0)).all(axis=1) & (dot.sum(axis=1) <= 1)
+             & digit.any(axis=1) & (end-begin <= 15))
+    mantissa = np.zeros(len(chars))
+    for k in range(chars.shape[1]):
+        mantissa = np.where(digit[:,k], mantissa*10+(chars[:,k]-48.0), mantissa)
+    values = mantissa/10.0**(digit & after).sum(axis=1)
+    other = np.flatnonzero(~plain & (end-begin <= NUMBER_BYTES))
+    if len(other):
+        strings = np.ascontiguousarray(chars[other]).view("S%s" % chars.shape[1])[:,0]
+        values[other] = strings.astype(np.float64)
+    for i in np.flatnonzero(end-begin > NUMBER_BYTES):
+        values[i] = float(buf[begin[i]:end[i]].tostring())
+    return values
+
+def hit_chunk_lines(chunk):
+    """split a chunk of a tabular hit file line by line in Python,
+    for chunks that are not plain 12 column, tab separated text"""
+    rows = [ ]
+    for line in chunk.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) < 12:
+            raise TypeError("malformed blast line found")
+        rows.append(fields[:12])
+    if not rows:
+        rows = np.zeros((0, 12), dtype="S1")
+    return np.array(rows, dtype=str)
+
+def parse_hit_chunk(buf, names, coords):
+    """query index, percent identity, bit score and, with coords,
+    qstart/qend/sstart/send arrays for a chunk of whole lines"""
+    ends = np.flatnonzero(buf == 10)
+    if len(buf) and buf[-1] != 10:
+        ends = np.append(ends, len(buf))
+    starts = np.append(0, ends[:-1]+1)
+    tabs = np.flatnonzero(buf == 9)
+    plain = (len(ends) and len(tabs) == 11*len(ends) and not (buf == 13).any())
+    if plain:
+        tabs = tabs.reshape(-1, 11)
+        plain = (tabs[:,0] > starts).all() and (tabs[:,10] < ends).all()
+    columns = [0, 2, 11]
+    if coords:
+        columns.extend([6, 7, 8, 9])
+    try:
+        if plain:
+            bounds = [(starts if k == 0 else tabs[:,k-1]+1, ends if k == 11 else tabs[:,k]) for k in columns]
+            # a label longer than every name matches none of them,
+            # so no more of it is needed
+            labels = field_bytes(buf, bounds[0][0], bounds[0][1], names.dtype.itemsize+1)
+            values = [field_numbers(buf, *x) for x in bounds[1:]]
+        else:
+            table = hit_chunk_lines(buf.tostring())
+            labels = table[:,0]
+            values = [table[:,k].astype(np.float64) for k in columns[1:]]
+    except ValueError:
+        raise TypeError("malformed blast line found")
+    # hits come grouped by query, so only the first line of each run
+    # of equal query names needs a lookup
+    heads = np.flatnonzero(np.append(True, labels[1:] != labels[:-1]))
+    pos = np.minimum(np.searchsorted(names, labels[heads]), max(len(names)-1, 0))
+    if len(names):
+        found = np.where(names[pos] == labels[heads], pos, -1)
+    else:
+        found = np.zeros(len(heads), dtype=np.int64)-1
+    query = np.repeat(found, np.diff(np.append(heads, len(labels))))
+    keep = query >= 0
+    return [query[keep]]+[x[keep] for x in values]
+
+def iter_hit_chunks(infile, names, coords=False, chunk_bytes=HIT_CHUNK_BYTES):
+    """memory map a tabular BLAST/BLAT hit file and yield its hits
+    in chunks of whole lines as NumPy arrays: the index of the query
+    in the sorted string array names, percent identity, bit score and
+    optionally the coordinates.  Hits of other queries are dropped"""
+    handle = open(infile, "rb")
+    size = os.fstat(handle.fileno()).st_size
+    if size == 0:
+        handle.close()
+        return
+    mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = 0
+        while start < size:
+            end = min(start+chunk_bytes, size)
+            if end < size:
+                cut = mm.rfind("\n", start, end)
+                if cut < 0:
+                    cut = mm.find("\n", end)
+                end = size if cut < 0 else cut+1
+            yield parse_hit_chunk(np.frombuffer(mm, dtype=np.uint8, count=end-start, offset=start), names, coords)
+            start = end
+    finally:
+        mm.close()
+        handle.close()
+
+def load_hit_table(infile, names, coords=False):
+    """all hits of a tabular hit file, as iter_hit_chunks gives them"""
+    chunks = list(iter_hit_chunks(infile, names, coords))
+    if not chunks:
+        return [np.zeros(0, dtype=np.int64)]+[np.zeros(0) for x in range(6 if coords else 2)]
+    return [np.concatenate(x) for x in zip(*chunks)]
+
+def group_max(query, values, num):
+    """largest value of each query index, 0 for queries without one"""
+    best = np.zeros(num)
+    if len(query):
+        order = np.lexsort((values, query))
+        last = np.append(query[order][1:] != query[order][:-1], True)
+        best[query[order][last]] = values[order][last]
+    return best
+
+def parse_hit_table(infile, names, ref, length, min_hlog):
+    """read a tabular hit file once.  names is the sorted array of
+    query names and ref their reference scores (NaN if missing).
+    Returns the best score of each query, the dup_summary of the hits
+    find_dups counts, and the numbers of hits, queries hit and hits
+    counted for duplicates"""
+    best = np.zeros(len(names))
+    summaries = [ ]
+    hits = 0
+    try:
+        for query, identity, score in iter_hit_chunks(infile, names):
+            hits += len(query)
+            best = np.maximum(best, group_max(query, score, len(names)))
+            with np.errstate(invalid="ignore"):
+                counted = (identity >= int(min_hlog)) & (score/ref[query] >= float(length))
+            summaries.append(dup_summary(query[counted], score[counted], len(names)))
+    except TypeError:
+        raise TypeError("malformed blast line found in %s" % infile)
+    summary = merge_dup_summaries(summaries, len(names))
+    return best, summary, (hits, int((best > 0).sum()), int(summary[0].sum()))
+
+def column_store(path, num):
+    """an empty column store at path, for columns of the best scores
+    of num queries.  Columns are appended to the file in the order
+    genomes are parsed, so they need not be held in memory; the dup
+    summaries of the genomes are merged as they are added"""
+    open(path, "wb").close()
+    return {'path': path, 'num': num, 'reports': [ ], 'summary': None, 'lock': threading.Lock()}
+
+def keep_hit_table(results, report, result, store=None):
+    """results[report] = result, a parse_hit_table result.  With a
+    column_store, its best scores are appended to the store and its
+    dup summary merged into the store's, and only the index of the
+    column and the hit counts are kept in results"""
+    if store is None:
+        results[report] = result
+        return
+    best, summary, stats = result
+    results[report] = (store_columns(store, [report], [best], summary), None, stats)
+
+def store_columns(store, reports, columns, summary):
+    """append the columns of best scores of reports to a column_store
+    and merge their dup summary into the store's.  Returns the index
+    of the first column"""
+    with store['lock']:
+        outfile = open(store['path'], "ab")
+        for best in columns:
+            outfile.write(np.asarray(best, dtype=np.float64).tostring())
+        outfile.close()
+        index = len(store['reports'])
+        store['reports'].extend(reports)
+        if store['summary'] is None:
+            store['summary'] = summary
+        else:
+            store['summary'] = merge_dup_summaries([store['summary'], summary], store['num'])
+    return index
+
+def stored_columns(store):
+    """the columns of a column_store, as the rows of a read-only
+    memory map"""
+    if not store['reports']:
+        return np.zeros((0, store['num']))
+    return np.memmap(store['path'], dtype=np.float64, mode="r", shape=(len(store['reports']), store['num']))
+
+def hit_table_results(files, names, ref, length, min_hlog, processors, debug="F", store=None):
+    """parse_hit_table of each file, parsed in parallel, kept
+    as keep_hit_table does"""
+    results = {}
+    def _perform_workflow(data):
+        tn, f = data
+        keep_hit_table(results, f, parse_hit_table(f, names, ref, length, min_hlog), store)
+        if debug == "T":
+            logging.logPrint("sample %s processed" % f)
+    set(p_func.pmap(_perform_workflow,
+                    [(str(idx), f) for idx, f in enumerate(files)],
+                    num_workers=processors))
+    return results
+
+def hit_table_arrays(clusters, ref_scores):
+    """the sorted query names and their reference scores
+    (NaN if missing) as NumPy arrays"""
+    names = np.array(sorted(clusters), dtype=str)
+    ref = np.array([float(ref_scores.get(x, "nan")) for x in names])
+    return names, ref
+
+def hit_table_reducer(clusters, ref_scores, length, min_hlog, results, store=None):
+    """a reduce for search_genomes that parses each finished hit
+    table into results, kept as keep_hit_table does, to be handed
+    on to hit_table_columns"""
+    names, ref = hit_table_arrays(clusters, ref_scores)
+    def _reduce(report):
+        keep_hit_table(results, report, parse_hit_table(report, names, ref, length, min_hlog), store)
+    return _reduce
+
+def hit_table_columns(clusters, ref_scores, length, min_hlog, processors, debug="F", results=None, store=None):
+    """parse every *_blast.out in the current directory in one pass
+    each, in parallel.  results can hold tables already parsed by a
+    hit_table_reducer or by a remote search, whose _blast.out need
+    not exist here.  With a column_store, which the results were kept
+    in too, the columns are read from it.  Returns the sorted query
+    names, the genome names, each genome's column of best scores, the
+    dup_summary of all genomes and each genome's hit counts"""
+    curr_dir=os.getcwd()
+    results = dict(results or {})
+    files = sorted(set(glob.glob(os.path.join(curr_dir, "*_blast.out")))|set(results))
+    names, ref = hit_table_arrays(clusters, ref_scores)
+    results.update(hit_table_results([f for f in files if f not in results], names, ref, length, min_hlog, processors, debug, store))
+    genomes = [get_seq_name(f).replace(".fasta.new_blast.out", "") for f in files]
+    if store is None:
+        summary = merge_dup_summaries([results[f][1] for f in files], len(names))
+        columns = [results[f][0] for f in files]
+    else:
+        summary = store['summary'] or merge_dup_summaries([ ], len(names))
+        stored = stored_columns(store)
+        columns = [stored[results[f][0]] for f in files]
+    return names, genomes, columns, summary, [results[f][2] for f in files]
+
+def write_bsr_matrix(out_file, names, ref, genomes, columns, mem_limit):
+    """write the BSR matrix of the columns of best scores, one row per
+    query, each score divided by the query's reference score (by 1000
+    where it has none).  The columns are transposed a block of queries
+    at a time, with blocks as large as mem_limit bytes allow, so
+    columns read from a column_store are never all in memory.  Rows
+    are formatted one at a time straight from the block"""
+    ref = np.where(np.isnan(ref) | (ref == 0), 1000.0, ref)
+    width = max(1, len(genomes))
+    block = max(1, int((mem_limit-MATRIX_ROW_BYTES*width) // (MATRIX_VALUE_BYTES*width)))
+    outfile = open(out_file, "w")
+    print >> outfile, "\t".join([""]+list(genomes))
+    row_format = "\t%.2f"*len(genomes)+"\n"
+    values = np.empty((min(block, len(names)), len(genomes)))
+    for start in range(0, len(names), block):
+        end = min(start+block, len(names))
+        rows = values[:end-start]
+        for i, column in enumerate(columns):
+            rows[:, i] = column[start:end]
+        rows /= ref[start:end, None]
+        for k, name in enumerate(names[start:end].tolist()):
+            outfile.write(name+row_format % tuple(rows[k].tolist()))
+    outfile.close()
+
+def write_hit_stats(out_file, genomes, stats):
+    outfile = open(out_file, "w")
+    print >> outfile, "genome\thits\tqueries_hit\tduplicate_hits"
+    for name, counts in zip(genomes, stats):
+        print >> outfile, "%s\t%s\t%s\t%s" % ((name,)+tuple(counts))
+    outfile.close()
 
 def filter_paralogs(matrix, ids):
     in_matrix = open(matrix, "U")
     outfile = open("bsr_matrix_values_filtered.txt", "w")
     outdata = [ ]
-    genomes_file = open(ids, "rU").read().splitlines()
+    paralogs = set(open(ids, "rU").read().splitlines())
     firstLine = in_matrix.readline()
     print >> outfile, firstLine,
     for line in in_matrix:
         fields = line.split()
-        if fields[0] not in genomes_file:
+        if fields[0] not in paralogs:
             print >> outfile, line,
             outdata.append(fields[0])
         else:
             pass
-    return outdata
     in_matrix.close()
     outfile.close()
+    return outdata
             
 def filter_variome(matrix, threshold, step):
     in_matrix = open(matrix, "U")
@@ -671,31 +1898,58 @@ def filter_variome(matrix, threshold, step):
     outfile.close()
     return outdata
 
-def run_usearch(usearch, id):
-    rec=1
-    curr_dir=os.getcwd()
+def split_fasta_chunks(in_fasta, prefix, max_seqs=CHUNK_SEQS, max_bases=CHUNK_BASES):
+    """split a fasta into chunks of at most max_seqs records and
+    about max_bases bases, keeping records whole.  Returns the
+    chunk file names"""
+    chunks = [ ]
+    outfile = None
+    for name, seq in read_fasta(in_fasta):
+        if outfile is None or num_seqs >= max_seqs or num_bases+len(seq) > max_bases:
+            if outfile is not None: outfile.close()
+            chunks.append("%s%s" % (prefix, len(chunks)))
+            outfile = open(chunks[-1], "w")
+            num_seqs, num_bases = 0, 0
+        write_fasta(outfile, name, seq)
+        num_seqs += 1
+        num_bases += len(seq)
+    if outfile is not None: outfile.close()
+    return chunks
+
+def run_usearch(usearch, id, chunks, processors):
+    """cluster each chunk with USEARCH, splitting processors
+    between the chunks running at once.  Centroids of a chunk go
+    to <chunk>.usearch.out; returns the .uc file of each chunk"""
     devnull = open("/dev/null", "w")
-    for infile in glob.glob(os.path.join(curr_dir, "x*")):
+    files_and_temp_names = [(str(idx), os.path.abspath(f))
+                            for idx, f in enumerate(chunks)]
+    workers, threads = plan_threads(processors, len(chunks))
+    def _perform_workflow(data):
+        tn, f = data
         cmd = ["%s" % usearch,
-           "-cluster_fast", "%s" % infile,
+           "-cluster_fast", "%s" % f,
            "-id", str(id),
-           "-uc", "results.uc",
-           "-centroids", "%s.usearch.out" % str(autoIncrement())]
+           "-uc", "%s.uc" % f,
+           "-centroids", "%s.usearch.out" % f,
+           "-threads", str(threads)]
         subprocess.call(cmd,stdout=devnull,stderr=devnull)
+    results = set(p_func.pmap(_perform_workflow,
+                              files_and_temp_names,
+                              num_workers=workers))
     devnull.close()
-    
+    return ["%s.uc" % f for tn, f in files_and_temp_names]
+
 def filter_scaffolds(in_fasta):
-    infile = open(in_fasta, "U")
-    outrecords = [ ]
-    for record in SeqIO.parse(infile, "fasta"):
-        if "N" not in record.seq:
-            outrecords.append(record)
     output_handle = open("tmp.out", "w")
-    if int(len(outrecords))==0:
+    kept = 0
+    for title, seq in read_fasta(in_fasta, True):
+        if "N" not in seq:
+            write_fasta(output_handle, title, seq, 60)
+            kept += 1
+    output_handle.close()
+    if kept==0:
         print "no usable fasta records were found"
         sys.exit()
-    SeqIO.write(outrecords, output_handle, "fasta")
-    output_handle.close()
 
 def uclust_sort(usearch):
     """sort with Usearch. Updated to V6"""
@@ -854,6 +2108,132 @@ def reorder_matrix(in_matrix, names):
     my_matrix.close()
     outfile.close()
 
+def matrix_genomes(in_matrix):
+    """the genome names in the header of a BSR matrix"""
+    header = open(in_matrix, "U").readline().rstrip("\n").split("\t")
+    genomes = header[1:]
+    if len(set(genomes)) != len(genomes):
+        raise TypeError("a genome is named twice in %s" % in_matrix)
+    return genomes
+
+def iter_matrix_rows(in_matrix, index, num_genomes):
+    """(gene, index, values) for every row of a BSR matrix, in gene
+    order.  A matrix written by LS-BSR is already sorted and is read
+    straight through; any other is read through a hash index of the
+    offset of each gene's row"""
+    def _fields(line):
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != num_genomes+1:
+            raise TypeError("row %s of %s does not have %s values" % (fields[0], in_matrix, num_genomes))
+        return fields[0], index, fields[1:]
+    last = None
+    matrix = open(in_matrix, "U")
+    matrix.readline()
+    for line in matrix:
+        gene = line.split("\t", 1)[0]
+        if not line.strip():
+            continue
+        if last is not None and gene < last:
+            break
+        last = gene
+    else:
+        matrix = open(in_matrix, "U")
+        matrix.readline()
+        for line in matrix:
+            if line.strip():
+                yield _fields(line)
+        return
+    offsets = collections.defaultdict(list)
+    matrix = open(in_matrix, "U")
+    matrix.readline()
+    while True:
+        offset = matrix.tell()
+        line = matrix.readline()
+        if not line:
+            break
+        if line.strip():
+            offsets[line.split("\t", 1)[0]].append(offset)
+    for gene in sorted(offsets):
+        for offset in offsets[gene]:
+            matrix.seek(offset)
+            yield _fields(matrix.readline())
+
+def same_value(first, second, tolerance):
+    if first == second:
+        return True
+    try:
+        return abs(float(first)-float(second)) <= tolerance
+    except ValueError:
+        return False
+
+def merge_matrices(in_matrices, out_matrix, conflicts_file, missing="NA", tolerance=0.0):
+    """merge BSR matrices into one, aligning rows by gene and columns
+    by genome, so matrices of the same genes over different genomes
+    are joined side by side and matrices of different genes over the
+    same genomes are stacked.  Genes are written in sorted order and
+    genomes in the order they are first found.  A gene x genome value
+    given by more than one row is a duplicate if the values agree to
+    within tolerance and a conflict otherwise; conflicts are written to
+    conflicts_file and the first value is kept.  Values no matrix has
+    are written as missing.  Rows are streamed, merging one gene at a
+    time.  Returns the numbers of genes, genomes, duplicate, conflicting
+    and missing values"""
+    from heapq import merge
+    from operator import itemgetter
+    genomes = [ ]
+    position = {}
+    placements = [ ]
+    for in_matrix in in_matrices:
+        names = matrix_genomes(in_matrix)
+        shared = [(position[x], i) for i, x in enumerate(names) if x in position]
+        owned = [i for i, x in enumerate(names) if x not in position]
+        start = len(genomes)
+        for i in owned:
+            position[names[i]] = len(genomes)
+            genomes.append(names[i])
+        if len(owned) == 1:
+            getter = lambda values, i=owned[0]: (values[i],)
+        elif owned:
+            getter = itemgetter(*owned)
+        else:
+            getter = None
+        every = [(position[x], i) for i, x in enumerate(names)]
+        placements.append((start, len(owned), getter, shared, every))
+    out = open(out_matrix, "w")
+    conflicts = open(conflicts_file, "w")
+    print >> out, "\t".join([""]+genomes)
+    print >> conflicts, "gene\tgenome\tkept\tconflicting\tmatrix"
+    counts = {'genes': 0, 'duplicates': 0, 'conflicts': 0, 'missing': 0}
+    rows = merge(*[iter_matrix_rows(x, i, len(placements[i][4])) for i, x in enumerate(in_matrices)])
+    for gene, group in itertools.groupby(rows, itemgetter(0)):
+        row = [None]*len(genomes)
+        seen = set()
+        for _gene, index, values in group:
+            start, num_owned, getter, shared, every = placements[index]
+            if index in seen:
+                """the gene is in this matrix twice"""
+                shared = every
+            elif getter is not None:
+                row[start:start+num_owned] = getter(values)
+            seen.add(index)
+            for j, i in shared:
+                if row[j] is None:
+                    row[j] = values[i]
+                elif same_value(row[j], values[i], tolerance):
+                    counts['duplicates'] += 1
+                else:
+                    counts['conflicts'] += 1
+                    print >> conflicts, "%s\t%s\t%s\t%s\t%s" % (gene, genomes[j], row[j], values[i], in_matrices[index])
+        empty = row.count(None)
+        if empty:
+            counts['missing'] += empty
+            row = [missing if x is None else x for x in row]
+        print >> out, "\t".join([gene]+row)
+        counts['genes'] += 1
+    out.close()
+    conflicts.close()
+    return counts['genes'], len(genomes), counts['duplicates'], counts['conflicts'], counts['missing']
+
 def parse_tree(tree):
     names = []
     mytree = Phylo.read(tree, 'newick')
@@ -865,86 +2245,12 @@ def parse_tree(tree):
 def blat_against_self(query,reference,output,processors):
     subprocess.check_call("blat -out=blast8 -minIdentity=75 %s %s %s > /dev/null 2>&1" % (reference,query,output), shell=True)
 
-def blat_against_each_genome(dir_path,database,processors):
-    """BLAT all genes against each genome"""
-    curr_dir=os.getcwd()
-    files = os.listdir(curr_dir)
-    files_and_temp_names = [(str(idx), os.path.join(curr_dir, f))
-                            for idx, f in enumerate(files)]
-    def _perform_workflow(data):
-	tn, f = data
-        if ".fasta.new" in f:
-            try:
-                subprocess.check_call("blat -out=blast8 -minIdentity=75 %s %s %s_blast.out > /dev/null 2>&1" % (f,database,f), shell=True)
-            except:
-                print "genomes %s cannot be used" % f
-            
-    results = set(p_func.pmap(_perform_workflow,
-                              files_and_temp_names,
-                              num_workers=processors))
-
-def make_table_dev(infile, test, clusters):
-    """make the BSR matrix table"""
-    values = [ ]
-    names = [ ]
-    outdata = [ ]
-    name=[ ]
-    out=get_seq_name(infile)
-    name.append(out)
-    reduced=[ ]
-    """remove the junk at the end of the file"""
-    for x in name:reduced.append(x.replace('.fasta.new_blast.out.filtered.filtered.unique',''))
-    names.append(reduced)
-    my_dict={}
-    my_file=open(infile, "rU")
-    """make a dictionary of all clusters and values"""
-    try:
-        for line in my_file:
-            fields=line.split()
-            my_dict.update({fields[0]:fields[1]})
-    except:
-        raise TypeError("abnormal number of fields")
-    my_file.close()
-    """add in values, including any potentially missing ones"""
-    for x in clusters:
-        if x not in my_dict.keys():my_dict.update({x:0})
-    for x in reduced:
-        values.append(x)
-    """sort keys to get the same order between samples"""
-    od = collections.OrderedDict(sorted(my_dict.items()))
-    values_2 = od.values()
-    values_3 = values+values_2
-    if "T" in test:
-        myout=[x for i, x in enumerate(outdata) if x not in outdata[i+1:]]
-        return sorted(outdata)
-    else:
-        pass
-    return names, values_3
-    
-def create_bsr_matrix_dev(master_list):
-    new_matrix = open("bsr_matrix", "w")
-    test = map(list, zip(*master_list))
-    for x in test:
-        y = map(str, x)
-        print >> new_matrix, "\t".join(y)
-    new_matrix.close()
-
-def new_loop(to_iterate, processors, clusters, debug):
-    names = []
-    table_list = []
-    def _perform_workflow(data):
-        tn, f = data
-        name,values=make_table_dev(f, "F", clusters)
-        names.append(name)
-        table_list.append(values)
-        if debug == "T":
-            logging.logPrint("sample %s processed" % f)
-        else:
-            pass
-    set(p_func.pmap(_perform_workflow,
-                    to_iterate,
-                    num_workers=processors))
-    return names,table_list
+def blat_against_each_genome(dir_path,database,processors,mem_limit=None,pin="F",genome_queries=None,reduce=None,timeout=None):
+    """BLAT all genes against each genome, as a grid
+    of genome x query shard tasks"""
+    def _search_cmd(query, f, threads):
+        return search_command("blat", query, f, threads)
+    search_genome_grid(dir_path, processors, database, "blat", None, _search_cmd, mem_limit, pin, genome_queries, reduce, timeout)
 
 def run_vsearch(vsearch, id, processors):
     devnull = open("/dev/null", "w")
@@ -956,3 +2262,825 @@ def run_vsearch(vsearch, id, processors):
            "-centroids", "vsearch.out"]
     subprocess.call(cmd,stdout=devnull,stderr=devnull)
     devnull.close()
+
+def alphabet_kmers(seq, k, alphabet):
+    """sorted, distinct codes of the k-mers in seq, read as numbers
+    in base len(alphabet).  k-mers with other characters are skipped"""
+    base = len(alphabet)
+    table = np.zeros(256, dtype=np.uint64)+base
+    for code, letter in enumerate(alphabet):
+        table[ord(letter)] = code
+    enc = table[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(enc)-k+1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    codes = np.zeros(n, dtype=np.uint64)
+    bad = np.zeros(n, dtype=bool)
+    for i in range(k):
+        codes = codes*np.uint64(base)+enc[i:i+n]
+        bad |= enc[i:i+n] == base
+    return np.unique(codes[~bad])
+
+def kmer_codes(seq, k=KMER_SIZE):
+    """sorted, distinct 2-bit codes of the ACGT k-mers in seq"""
+    return alphabet_kmers(seq, k, "ACGT").astype(np.uint32)
+
+def max_edits(seq, id):
+    return int((1-float(id))*len(seq)+1e-9)
+
+def min_shared_kmers(codes, edits, k=KMER_SIZE):
+    """each edit removes at most k of a sequence's k-mers"""
+    return max(1, len(codes)-k*edits)
+
+def within_edits(query, target, limit):
+    """edit distance of query against its best matching part of
+    target, or None if it is more than limit.  Ungapped matches at
+    either end of target are tried first, and their mismatches are
+    returned if within limit.  Otherwise the dynamic programming
+    matrix is computed a row at a time over a band: an alignment
+    within limit starts at some offset into target and strays at
+    most limit cells from its diagonal, so only cells within limit
+    of the diagonals of offsets 0 to len(target)-len(query)+limit
+    are filled.  The alignment is given up once a row has no cell
+    within limit"""
+    q = np.frombuffer(query, dtype=np.uint8)
+    t = np.frombuffer(target, dtype=np.uint8)
+    if len(q) <= len(t):
+        for offset in sorted(set([0, len(t)-len(q)])):
+            mismatches = int((q != t[offset:offset+len(q)]).sum())
+            if mismatches <= limit:
+                return mismatches
+    elif len(q)-len(t) > limit:
+        return None
+    low = -limit
+    high = len(t)-len(q)+2*limit
+    big = len(q)+len(t)+limit+1
+    row = np.empty(len(t)+1, dtype=np.int64)
+    row.fill(big)
+    row[:min(len(t), high)+1] = 0
+    for i in range(len(q)):
+        first = max(0, i+1+low)
+        last = min(len(t), i+1+high)
+        cols = np.arange(first, last+1)
+        best = row[first:last+1]+1
+        if first == 0:
+            best[0] = i+1
+            best[1:] = np.minimum(best[1:], row[:last]+(t[:last] != q[i]))
+        else:
+            best = np.minimum(best, row[first-1:last]+(t[first-1:last] != q[i]))
+        """insertions along the row: D[j] = min over l<=j of best[l]+j-l"""
+        best = np.minimum.accumulate(best-cols)+cols
+        if first > 0:
+            row[first-1] = big
+        row[first:last+1] = best
+        if best.min() > limit:
+            return None
+    return int(row.min())
+
+def kmer_candidates(codes, segments, min_shared, below=None):
+    """ids of the sequences of the k-mer index segments sharing at
+    least min_shared k-mers with codes, most shared first, then by
+    id.  With below, only ids less than it are considered"""
+    cands = [ ]
+    counts = [ ]
+    for segment in segments:
+        index_kmers = segment["kmers"]
+        lo = np.searchsorted(index_kmers, codes, "left")
+        num = np.searchsorted(index_kmers, codes, "right")-lo
+        total = num.sum()
+        if total == 0:
+            continue
+        starts = np.repeat(lo-np.cumsum(num)+num, num)+np.arange(total)
+        shared = np.bincount(segment["ids"][starts]-segment["first"], minlength=len(segment["bounds"])-1)
+        if below is not None:
+            shared = shared[:max(0, below-segment["first"])]
+        cand = np.flatnonzero(shared >= min_shared)
+        cands.append(cand+segment["first"])
+        counts.append(shared[cand])
+    if not cands:
+        return [ ]
+    cand = np.concatenate(cands)
+    order = np.lexsort((cand, -np.concatenate(counts)))
+    return cand[order].tolist()
+
+def write_kmer_segment(path, first, codes, seqs):
+    """save the k-mer index of sequences first, first+1, ... with the
+    k-mer codes and sequences given, as .npy files under path"""
+    sizes = np.array([len(x) for x in codes], dtype=np.int64)
+    kmers = np.concatenate([np.zeros(0, dtype=np.uint32)]+list(codes))
+    ids = np.repeat(np.arange(first, first+len(codes), dtype=np.int64), sizes)
+    order = np.argsort(kmers, kind="mergesort")
+    bounds = np.zeros(len(seqs)+1, dtype=np.int64)
+    bounds[1:] = np.cumsum([len(x) for x in seqs])
+    save_kmer_segment(path, first, kmers[order], ids[order], np.frombuffer("".join(seqs), dtype=np.uint8), bounds)
+    return {'path': path, 'first': first, 'size': len(kmers)}
+
+def save_kmer_segment(path, first, kmers, ids, seqs, bounds):
+    os.makedirs(path)
+    for name, values in [("kmers", kmers), ("ids", ids), ("seqs", seqs), ("bounds", bounds),
+                         ("first", np.array([first], dtype=np.int64))]:
+        np.save(os.path.join(path, "%s.npy" % name), values)
+
+def load_kmer_segment(path):
+    """a k-mer index segment, memory mapped so processes reading it
+    share one copy"""
+    segment = dict([(name, np.load(os.path.join(path, "%s.npy" % name), mmap_mode="r").view(np.ndarray))
+                    for name in ["kmers", "ids", "seqs", "bounds"]])
+    segment["first"] = int(np.load(os.path.join(path, "first.npy"))[0])
+    return segment
+
+def segment_seq(segments, c):
+    """sequence c of the k-mer index"""
+    for segment in segments:
+        if segment["first"] <= c < segment["first"]+len(segment["bounds"])-1:
+            i = c-segment["first"]
+            return segment["seqs"][segment["bounds"][i]:segment["bounds"][i+1]].tostring()
+    raise KeyError(c)
+
+def merge_kmer_segments(path, older, newer):
+    """one segment with the k-mers and sequences of two adjacent ones.
+    The newer k-mers are inserted where they belong in the sorted older
+    ones instead of sorting the whole index again"""
+    a = load_kmer_segment(older["path"])
+    b = load_kmer_segment(newer["path"])
+    at = np.searchsorted(a["kmers"], b["kmers"], "right")
+    bounds = np.concatenate([a["bounds"], b["bounds"][1:]+a["bounds"][-1]])
+    save_kmer_segment(path, older["first"], np.insert(a["kmers"], at, b["kmers"]), np.insert(a["ids"], at, b["ids"]),
+                      np.concatenate([a["seqs"], b["seqs"]]), bounds)
+    del a, b
+    shutil.rmtree(older["path"])
+    shutil.rmtree(newer["path"])
+    return {'path': path, 'first': older["first"], 'size': older["size"]+newer["size"]}
+
+def fasta_index(in_fasta):
+    """the byte offset and sequence length of every record of a fasta
+    file, read without keeping any sequence"""
+    offsets = array.array("l")
+    lengths = array.array("l")
+    offset = 0
+    for line in open(in_fasta, "rb"):
+        if line[:1] == ">":
+            offsets.append(offset)
+            lengths.append(0)
+        elif lengths:
+            lengths[-1] += len(line.rstrip().replace(" ", "").replace("\r", ""))
+        offset += len(line)
+    return np.frombuffer(offsets, dtype=np.int64), np.frombuffer(lengths, dtype=np.int64)
+
+_cluster_state = {}
+
+def _init_cluster_worker(id):
+    _cluster_state.clear()
+    _cluster_state.update(id=id, segments={})
+
+def _cluster_segments(paths):
+    """the k-mer index segments at paths, loaded once per process"""
+    cache = _cluster_state["segments"]
+    for path in list(cache):
+        if path not in paths:
+            del cache[path]
+    for path in paths:
+        if path not in cache:
+            cache[path] = load_kmer_segment(path)
+    return [cache[x] for x in paths]
+
+def _match_centroids(data):
+    """for each (idx, seq), the first centroid of the index within the
+    identity threshold and its edits, or None and the k-mer codes of
+    the sequence"""
+    paths, items = data
+    segments = _cluster_segments(paths)
+    matches = [ ]
+    for idx, seq in items:
+        limit = max_edits(seq, _cluster_state["id"])
+        codes = kmer_codes(seq)
+        match = (idx, None, codes)
+        for c in kmer_candidates(codes, segments, min_shared_kmers(codes, limit))[:MAX_REJECTS]:
+            edits = within_edits(seq, segment_seq(segments, c), limit)
+            if edits is not None:
+                match = (idx, c, edits)
+                break
+        matches.append(match)
+    return matches
+
+def _match_earlier(data):
+    """for each sequence j of a batch's index, the earlier sequences of
+    the batch within the identity threshold and their edits, in the
+    order they were tried"""
+    paths, items = data
+    segments = _cluster_segments(paths)
+    matches = [ ]
+    for j in items:
+        seq = segment_seq(segments, j)
+        limit = max_edits(seq, _cluster_state["id"])
+        codes = kmer_codes(seq)
+        found = [ ]
+        for i in kmer_candidates(codes, segments, min_shared_kmers(codes, limit), j)[:MAX_REJECTS]:
+            edits = within_edits(seq, segment_seq(segments, i), limit)
+            if edits is not None:
+                found.append((i, edits))
+        matches.append((j, found))
+    return matches
+
+def kmer_cluster(in_fasta, id, processors, centroids_out, uc_out, batch_size=CLUSTER_BATCH):
+    """greedy centroid clustering at identity id, longest sequences
+    first.  Only an index of the records is held in memory; sequences
+    are read a batch at a time.  Each batch is matched against the
+    centroids found so far, using shared k-mers to pick candidates for
+    alignment; batches start small and double, so few sequences are
+    left over while there are few centroids.  Sequences left over are
+    matched against the earlier leftovers of their batch, and join the
+    first of those that became a centroid, or become centroids
+    themselves.  Both steps run on one
+    pool of processors for the whole run.  Centroids are indexed on
+    disk in sorted k-mer segments; a new batch's segment is merged into
+    the one before it once that is no more than twice its size, so the
+    index is rewritten O(log n) times.  Writes the centroids and a .uc
+    file, returns the number of clusters"""
+    offsets, lengths = fasta_index(in_fasta)
+    order = np.argsort(-lengths, kind="mergesort")
+    index_dir = tempfile.mkdtemp(prefix="kmer_index_", dir=os.path.dirname(os.path.abspath(centroids_out)))
+    if processors > 1:
+        pool = multiprocessing.Pool(processors, _init_cluster_worker, (id,))
+        pmap = pool.map
+    else:
+        _init_cluster_worker(id)
+        pmap = map
+    def _chunks(paths, items):
+        size = max(1, len(items)//(processors*TASKS_PER_WORKER))
+        return [(paths, items[x:x+size]) for x in range(0, len(items), size)]
+    infile = open(in_fasta, "rU")
+    outfile = open(centroids_out, "w")
+    uc = open(uc_out, "w")
+    segments = [ ]
+    names = [ ]
+    sizes = [ ]
+    try:
+        start = 0
+        size = max(1, batch_size//16)
+        while start < len(order):
+            batch = order[start:start+size].tolist()
+            start += size
+            size = min(batch_size, 2*size)
+            records = {}
+            for i in sorted(batch, key=lambda x: offsets[x]):
+                infile.seek(offsets[i])
+                name, seq = next(read_fasta(infile))
+                records[i] = (name, seq.upper())
+            paths = [x["path"] for x in segments]
+            assigned = {}
+            leftovers = [ ]
+            for chunk in pmap(_match_centroids, _chunks(paths, [(i, records[i][1]) for i in batch])):
+                for i, c, edits_or_codes in chunk:
+                    if c is None:
+                        leftovers.append((i, edits_or_codes))
+                    else:
+                        assigned[i] = (c, edits_or_codes)
+            first = len(names)
+            new = [ ]
+            if leftovers:
+                batch_path = os.path.join(index_dir, "batch")
+                write_kmer_segment(batch_path, 0, [codes for i, codes in leftovers], [records[i][1] for i, codes in leftovers])
+                centroid_of = {}
+                for chunk in pmap(_match_earlier, _chunks([batch_path], range(len(leftovers)))):
+                    for j, found in chunk:
+                        for k, edits in found:
+                            if k in centroid_of:
+                                assigned[leftovers[j][0]] = (centroid_of[k], edits)
+                                break
+                        else:
+                            centroid_of[j] = first+len(new)
+                            new.append(j)
+                shutil.rmtree(batch_path)
+            for j in new:
+                i = leftovers[j][0]
+                assigned[i] = (len(names), None)
+                names.append(records[i][0])
+                sizes.append(0)
+                print >> outfile, ">"+records[i][0]
+                print >> outfile, records[i][1]
+            for i in batch:
+                name, seq = records[i]
+                c, edits = assigned[i]
+                sizes[c] += 1
+                if edits is None:
+                    print >> uc, "S\t%s\t%s\t*\t*\t*\t*\t*\t%s\t*" % (c, len(seq), name)
+                else:
+                    identity = 100.0*(len(seq)-edits)/len(seq)
+                    print >> uc, "H\t%s\t%s\t%.1f\t+\t0\t0\t*\t%s\t%s" % (c, len(seq), identity, name, names[c])
+            if new:
+                segments.append(write_kmer_segment(os.path.join(index_dir, "%s-%s" % (first, len(names))), first,
+                                                   [leftovers[j][1] for j in new], [records[leftovers[j][0]][1] for j in new]))
+                while len(segments) > 1 and segments[-2]["size"] <= 2*segments[-1]["size"]:
+                    newer = segments.pop()
+                    older = segments.pop()
+                    segments.append(merge_kmer_segments(os.path.join(index_dir, "%s-%s" % (older["first"], len(names))), older, newer))
+    finally:
+        if processors > 1:
+            pool.close()
+            pool.join()
+        shutil.rmtree(index_dir)
+    outfile.close()
+    for c, name in enumerate(names):
+        print >> uc, "C\t%s\t%s\t*\t*\t*\t*\t*\t%s\t*" % (c, sizes[c], name)
+    uc.close()
+    return len(names)
+
+def query_kmers(seq, protein):
+    if protein:
+        return alphabet_kmers(seq.upper(), PRESCREEN_AA_K, AMINO_ACIDS)
+    return alphabet_kmers(seq.upper(), PRESCREEN_NT_K, "ACGT")
+
+def genome_sketch(f, protein):
+    """k-mers of both strands of a genome, translated in all
+    six frames if protein is set"""
+    from Bio.Seq import reverse_complement, translate
+    parts = [np.zeros(0, dtype=np.uint64)]
+    for name, seq in read_fasta(f):
+        seq = seq.upper()
+        for strand in [seq, reverse_complement(seq)]:
+            if not protein:
+                parts.append(query_kmers(strand, False))
+                continue
+            for frame in range(3):
+                end = frame+(len(strand)-frame)//3*3
+                parts.append(query_kmers(translate(strand[frame:end]), True))
+    return np.unique(np.concatenate(parts))
+
+def prescreen_queries(queries, files, protein, cutoff, processors, skipped_out, genome_queries=None):
+    """write, for each genome, the queries with at least cutoff of
+    their k-mers in the genome; the others are taken to be absent
+    and listed in skipped_out with their containment.  genome_queries
+    can give each genome its own query file.  Returns the query file
+    of each genome"""
+    if genome_queries is None:
+        genome_queries = dict([(f, queries) for f in files])
+    codes = {}
+    skipped = {}
+    screened = dict([(f, "%s.prescreen" % f) for f in files])
+    def _perform_workflow(data):
+        tn, f = data
+        sketch = genome_sketch(f, protein)
+        outfile = open(screened[f], "w")
+        skipped[f] = [ ]
+        for name, seq in read_fasta(genome_queries[f]):
+            if seq not in codes:
+                codes[seq] = query_kmers(seq, protein)
+            if len(codes[seq]):
+                containment = np.in1d(codes[seq], sketch, assume_unique=True).mean()
+                if containment < cutoff:
+                    skipped[f].append((name, containment))
+                    continue
+            write_fasta(outfile, name, seq)
+        outfile.close()
+    set(p_func.pmap(_perform_workflow,
+                    [(str(idx), f) for idx, f in enumerate(files)],
+                    num_workers=processors))
+    outfile = open(skipped_out, "w")
+    for f in sorted(files):
+        name = get_seq_name(f).replace(".fasta.new", "")
+        for query, containment in skipped.get(f, []):
+            print >> outfile, "%s\t%s\t%.3f" % (query, name, containment)
+    outfile.close()
+    return screened
+
+def prescreen_misses(skipped, matrix, min_bsr):
+    """pairs the prescreen skipped that have a BSR value of at least
+    min_bsr in a matrix from a run without the prescreen.  Returns
+    the misses and the number of skipped pairs checked"""
+    infile = open(matrix, "U")
+    genomes = infile.readline().split()
+    values = {}
+    for line in infile:
+        fields = line.split()
+        values[fields[0]] = dict(zip(genomes, fields[1:]))
+    infile.close()
+    misses = [ ]
+    checked = 0
+    for line in open(skipped, "U"):
+        query, genome, containment = line.split()
+        try:
+            bsr = float(values[query][genome])
+        except KeyError:
+            continue
+        checked += 1
+        if bsr >= float(min_bsr):
+            misses.append((query, genome, float(containment), bsr))
+    return misses, checked
+
+def collapse_duplicates(in_fasta, out_fasta, table):
+    """write one representative of each distinct sequence in
+    in_fasta to out_fasta.  Every gene is listed in table next
+    to its representative.  Returns the number of representatives"""
+    seen = {}
+    outfile = open(out_fasta, "w")
+    tablefile = open(table, "w")
+    for name, seq in read_fasta(in_fasta):
+        key = hashlib.sha1(seq.upper()).digest()
+        if key not in seen:
+            seen[key] = name
+            write_fasta(outfile, name, seq)
+        print >> tablefile, "%s\t%s" % (name, seen[key])
+    outfile.close()
+    tablefile.close()
+    return len(seen)
+
+def read_uc_links(uc_files):
+    """map each clustered sequence to its centroid and percent
+    identity from the hit records of USEARCH/VSEARCH .uc files"""
+    links = {}
+    for uc_file in uc_files:
+        for line in open(uc_file, "U"):
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == "H":
+                try:
+                    identity = float(fields[3])
+                except ValueError:
+                    identity = 100.0
+                links[fields[8].split()[0]] = (fields[9].split()[0], identity)
+    return links
+
+def cluster_membership(uc_files, table, out_file):
+    """write the centroid of every gene in the duplicate table
+    and its approximate percent identity to it, following hits
+    through each level of clustering"""
+    links = read_uc_links(uc_files)
+    outfile = open(out_file, "w")
+    for line in open(table, "U"):
+        gene, centroid = line.split()
+        identity = 100.0
+        for i in range(len(links)):
+            if centroid not in links:
+                break
+            centroid, link_identity = links[centroid]
+            identity = identity*link_identity/100
+        print >> outfile, "%s\t%s\t%.1f" % (gene, centroid, identity)
+    outfile.close()
+
+def membership_hits(membership, origins):
+    """members of each cluster by genome, read from a cluster
+    membership file and the genome origins of the genes:
+    {genome: {centroid: [(gene, identity)]}}"""
+    genomes = dict([line.split() for line in open(origins, "U")])
+    hits = {}
+    for line in open(membership, "U"):
+        gene, centroid, identity = line.split()
+        if gene in genomes:
+            hits.setdefault(genomes[gene], {}).setdefault(centroid, []).append((gene, float(identity)))
+    return hits
+
+def ambiguous_queries(queries, files, hits):
+    """write, for each genome, the queries with no cluster member
+    from that genome.  Returns the query file of each genome"""
+    records = list(read_fasta(queries))
+    genome_queries = {}
+    for f in files:
+        found = hits.get(get_seq_name(f), {})
+        genome_queries[f] = "%s.ambiguous" % f
+        outfile = open(genome_queries[f], "w")
+        for name, seq in records:
+            if name not in found:
+                write_fasta(outfile, name, seq)
+        outfile.close()
+    return genome_queries
+
+def write_membership_hits(hits, ref_scores):
+    """add a tabular hit to each genome's _blast.out for every cluster
+    member it contributed, scored as the centroid's reference score
+    scaled by the member's identity to the centroid"""
+    for genome, centroids in hits.iteritems():
+        outfile = open("%s_blast.out" % genome, "a")
+        for centroid, members in sorted(centroids.iteritems()):
+            if centroid not in ref_scores:
+                continue
+            for gene, identity in members:
+                score = float(ref_scores[centroid])*identity/100
+                print >> outfile, "%s\t%s\t%.2f\t0\t0\t0\t0\t0\t0\t0\t0\t%.1f" % (centroid, gene, identity, score)
+        outfile.close()
+
+def write_manifest(out_file, blast, queries, protein, fast, files):
+    """record what the shards of a run search: the search program,
+    the query file, whether the prescreen compares proteins, whether
+    presence comes from cluster membership, and every genome with
+    its size"""
+    outfile = open(out_file, "w")
+    print >> outfile, "blast\t%s" % blast
+    print >> outfile, "queries\t%s" % os.path.abspath(queries)
+    print >> outfile, "protein\t%s" % protein
+    print >> outfile, "fast\t%s" % fast
+    for f in sorted(files):
+        print >> outfile, "genome\t%s\t%s" % (get_seq_name(f), os.path.getsize(f))
+    outfile.close()
+
+def read_manifest(in_file):
+    manifest = {"genomes": [ ]}
+    try:
+        for line in open(in_file, "U"):
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == "genome":
+                manifest["genomes"].append((fields[1], int(fields[2])))
+            else:
+                manifest[fields[0]] = fields[1]
+    except (IndexError, ValueError):
+        raise TypeError("malformed manifest %s" % in_file)
+    return manifest
+
+def write_ref_scores(out_file, ref_scores):
+    outfile = open(out_file, "w")
+    for query, score in sorted(ref_scores.iteritems()):
+        print >> outfile, "%s\t%s" % (query, score)
+    outfile.close()
+
+def read_ref_scores(in_file):
+    return dict([line.split() for line in open(in_file, "U") if line.strip()])
+
+def parse_shard(value):
+    """the shard number and count of an i/N shard, counted from 1"""
+    try:
+        shard, num_shards = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise TypeError("shards are given as i/N")
+    if num_shards < 1 or shard < 1 or shard > num_shards:
+        raise TypeError("shard %s is not between 1 and %s" % (shard, num_shards))
+    return shard, num_shards
+
+def shard_genomes(genomes, shard, num_shards):
+    """the genomes of shard i of N, from a list of (genome, size).
+    Largest genomes are dealt first, each to the shard with the least
+    sequence so far, so every run of the same manifest splits the
+    genomes the same way"""
+    totals = [0]*num_shards
+    assigned = [[ ] for x in range(num_shards)]
+    for name, size in sorted(genomes, key=lambda x: (-x[1], x[0])):
+        smallest = totals.index(min(totals))
+        totals[smallest] += size
+        assigned[smallest].append(name)
+    return sorted(assigned[shard-1])
+
+def shard_file(shard, num_shards):
+    return "shard_%s_of_%s.npz" % (shard, num_shards)
+
+def complete_shard_files(files):
+    """the archives of every shard of one i/N split among files, in
+    shard order.  Raises TypeError if shards are missing or the files
+    come from different splits"""
+    found = {}
+    for f in files:
+        fields = os.path.basename(f)[:-4].split("_")
+        try:
+            found[(int(fields[1]), int(fields[3]))] = f
+        except (IndexError, ValueError):
+            raise TypeError("%s is not a shard archive" % f)
+    splits = set([num_shards for shard, num_shards in found])
+    if len(splits) != 1:
+        raise TypeError("shard archives of %s different splits found" % len(splits))
+    num_shards = splits.pop()
+    missing = [x for x in range(1, num_shards+1) if (x, num_shards) not in found]
+    if missing:
+        raise TypeError("shards %s of %s haven't finished" % (", ".join(map(str, missing)), num_shards))
+    return [found[(x, num_shards)] for x in range(1, num_shards+1)]
+
+def write_shard_columns(out_file, names, genomes, columns, summary, stats):
+    """save the matrix columns, duplicate summary and hit counts of
+    one shard's genomes in a compressed NumPy archive.  The archive
+    is written under a temporary name first, so a rerun shard never
+    leaves half an archive behind"""
+    count, top, low = summary
+    tmp = "%s.tmp.npz" % out_file[:-4]
+    np.savez_compressed(tmp, names=names, genomes=np.array(genomes, dtype=str),
+                        best=np.array(columns).reshape(len(genomes), len(names)),
+                        count=count, top=top, low=low,
+                        stats=np.array(stats, dtype=np.int64).reshape(len(genomes), 3))
+    os.rename(tmp, out_file)
+
+def merge_shard_columns(shard_files, store):
+    """combine the archives of write_shard_columns, ordering the
+    genomes by the name of their _blast.out as a single run does.
+    The columns are appended to the column_store store one shard at a
+    time, so only one shard's columns are ever in memory.  Returns
+    what hit_table_columns returns"""
+    names = None
+    genomes = [ ]
+    stats = [ ]
+    for f in shard_files:
+        shard = np.load(f)
+        if names is None:
+            names = shard["names"]
+        if len(names) != store['num'] or not np.array_equal(names, shard["names"]):
+            raise TypeError("shard %s was searched with different queries" % f)
+        store_columns(store, shard["genomes"].tolist(), shard["best"], (shard["count"], shard["top"], shard["low"]))
+        genomes.extend(shard["genomes"].tolist())
+        stats.extend([tuple(x) for x in shard["stats"].tolist()])
+    if len(set(genomes)) != len(genomes):
+        raise TypeError("a genome was searched by more than one shard")
+    order = sorted(range(len(genomes)), key=lambda x: "%s.fasta.new_blast.out" % genomes[x])
+    stored = stored_columns(store)
+    return (names, [genomes[x] for x in order], [stored[x] for x in order],
+            store['summary'] or merge_dup_summaries([ ], store['num']), [stats[x] for x in order])
+
+
+def encode_hit_table(result):
+    """a parse_hit_table result as lines of text, so a remote
+    search can send back a genome's column instead of its hits"""
+    best, (count, top, low), stats = result
+    lines = [ ]
+    for key, values in [("best", best), ("count", count), ("top", top), ("low", low)]:
+        lines.append("\t".join([key]+[repr(x) for x in values.tolist()]))
+    lines.append("\t".join(["stats"]+[str(x) for x in stats]))
+    return "\n".join(lines)+"\n"
+
+def decode_hit_table(lines):
+    """the parse_hit_table result encoded by encode_hit_table"""
+    fields = dict([(x[0], x[1:]) for x in [line.rstrip("\n").split("\t") for line in lines] if x[0]])
+    try:
+        best, count, top, low = [np.array([float(y) for y in fields[x]]) for x in ["best", "count", "top", "low"]]
+        stats = tuple([int(x) for x in fields["stats"]])
+    except (KeyError, ValueError):
+        raise TypeError("malformed hit table summary")
+    if len(stats) != 3 or not len(best) == len(count) == len(top) == len(low):
+        raise TypeError("malformed hit table summary")
+    return best, (count.astype(np.int64), top, low), stats
+
+def local_executor(dir_path, processors, filter, penalty, reward, length, min_hlog, batch="F", mem_limit=None, pin="F", timeout=None):
+    """the executor searching genomes on this machine with
+    search_genomes.  An executor is called as execute(queries, blast,
+    genome_queries, clusters, ref_scores, results, store) to search
+    every genome in the current directory.  With results, a dict, each
+    genome's hits are parsed into it by the name of its _blast.out, and
+    kept in the column_store store if given, as hit_table_reducer does;
+    without, the hits are left in the _blast.out files"""
+    def _execute(queries, blast, genome_queries, clusters, ref_scores, results=None, store=None):
+        if results is None:
+            reduce = None
+        else:
+            reduce = hit_table_reducer(clusters, ref_scores, length, min_hlog, results, store)
+        search_genomes(dir_path, processors, queries, blast, filter, penalty, reward, batch, mem_limit, pin,
+                       genome_queries, reduce, timeout)
+    return _execute
+
+def parse_hosts(hosts, slots):
+    """host slot counts from --hosts entries, each a host or host:slots;
+    a host without a count of its own gets slots"""
+    host_slots = {}
+    for x in hosts:
+        host, sep, count = x.partition(":")
+        try:
+            host_slots[host] = int(count) if sep else slots
+        except ValueError:
+            raise TypeError("%s isn't a host or host:slots" % x)
+        if not host or host_slots[host] < 1:
+            raise TypeError("%s isn't a host or host:slots" % x)
+    return host_slots
+
+def ssh_executor(hosts, remote_dir, slots, filter, penalty, reward, length, min_hlog, timeout=None,
+                 run=None, copy=None):
+    """the executor, as local_executor describes, searching genomes
+    on hosts over ssh, from one commands.runProgramQueue.  hosts are
+    host or host:slots; each runs its slots single threaded searches,
+    or slots of them without a count of its own, at a time.  Each call works in a
+    directory of its own under remote_dir on every host, removed once
+    it is done.  The query files (and reference scores) are copied
+    there once, and each genome to the host that searches it, where
+    ls_bsr.worker formats and searches it.  Only the parsed column of a genome comes
+    back, or its hits without results.  A host that cannot be reached
+    or copied to is dropped and its genomes are searched on the other
+    hosts; a genome whose search fails is tried once more on another
+    host before it is given up.  Anything a search writes to stderr is
+    kept in the genome's .log file.  A search running longer than
+    timeout seconds is stopped on its host by timeout(1), and its ssh
+    killed if it has not returned SSH_TIMEOUT_GRACE seconds later.
+    A genome that is given up leaves no _blast.out.  run(host, cmd, stdoutf,
+    stderrf) and copy(host, src, dst) give the ProgramRunners running
+    a shell command on a host and copying a file to it, by default
+    ssh and scp with SSH_OPTIONS.  LS-BSR and the search programs
+    must be on the PYTHONPATH and PATH of every host"""
+    host_slots = parse_hosts(hosts, slots)
+    hosts = sorted(host_slots)
+    if run is None:
+        def run(host, cmd, stdoutf, stderrf):
+            return ssh.runSystemSSHA(host, cmd, stdoutf, stderrf, options="-n %s" % SSH_OPTIONS)
+    if copy is None:
+        def copy(host, src, dst):
+            return ssh.scpToA(host, src, dst, options=SSH_OPTIONS)
+    def _execute(queries, blast, genome_queries, clusters, ref_scores, results=None, store=None):
+        run_dir = os.path.join(remote_dir, "%s-%s-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex))
+        def _remote(path):
+            return os.path.join(run_dir, os.path.basename(path))
+        curr_dir=os.getcwd()
+        files = sorted([os.path.join(curr_dir, f) for f in os.listdir(curr_dir) if f.endswith(".fasta.new")])
+        if genome_queries is None:
+            genome_queries = dict([(f, queries) for f in files])
+        shared = sorted(set([genome_queries[f] for f in files]))
+        if results is not None:
+            ref_file = os.path.join(curr_dir, REF_SCORES)
+            write_ref_scores(ref_file, dict([(x, ref_scores.get(x, "nan")) for x in clusters]))
+            shared.append(ref_file)
+        live = set()
+        staged = set()
+        def _stage(host):
+            for runner in [run(host, "mkdir -p %s" % run_dir, None, None)]+[copy(host, x, _remote(x)) for x in shared]:
+                yield runner
+                if runner.exitCode != 0:
+                    print "host %s cannot be used" % host
+                    return
+                staged.add(host)
+            live.add(host)
+        def _clean(host):
+            runner = run(host, "rm -rf %s" % run_dir, None, None)
+            runner.timeout = SSH_TIMEOUT_GRACE
+            yield runner
+        pending = deque(files)
+        copied = deque()
+        running = dict([(host, 0) for host in hosts])
+        failed_on = dict([(f, set()) for f in files])
+        def _lost(host, f):
+            if host in live:
+                live.discard(host)
+                print "host %s failed, its genomes are searched on the other hosts" % host
+            running[host] -= 1
+            pending.appendleft(f)
+        def _copy_done(host, f):
+            def _done(runner):
+                if runner.exitCode == 0:
+                    copied.append((host, f))
+                else:
+                    _lost(host, f)
+            return _done
+        def _search_done(host, f, out, errors):
+            def _done(runner):
+                out.close()
+                passed = runner.exitCode == 0
+                if passed and results is not None:
+                    try:
+                        keep_hit_table(results, "%s_blast.out" % f, decode_hit_table(open(out.name, "U")), store)
+                    except TypeError:
+                        errors.append("malformed hit table summary from %s\n" % host)
+                        passed = False
+                if results is not None or not passed:
+                    os.remove(out.name)
+                if errors:
+                    open("%s.log" % f, "a").write("".join(errors))
+                if runner.exitCode == 255:
+                    """ssh itself failed"""
+                    _lost(host, f)
+                    return
+                running[host] -= 1
+                if passed:
+                    return
+                if runner.timedOut or (timeout and runner.exitCode == 124):
+                    print "search of genome %s timed out on %s after %s seconds" % (f, host, timeout)
+                failed_on[f].add(host)
+                if len(failed_on[f]) < 2:
+                    pending.append(f)
+                else:
+                    print "genomes %s cannot be used, see %s.log" % (f, f)
+            return _done
+        def _search(host, f):
+            cmd = ["cd", run_dir, "&&"]
+            if timeout:
+                cmd.extend(["timeout", "-k", "10", str(timeout)])
+            cmd.extend(["python", "-m", "ls_bsr.worker",
+                        "-g", _remote(f), "-q", _remote(genome_queries[f]), "-b", blast,
+                        "-f", filter, "--penalty", str(penalty), "--reward", str(reward)])
+            if results is None:
+                out = open("%s_blast.out" % f, "w")
+            else:
+                out = open("%s.summary" % f, "w")
+                cmd.extend(["-r", _remote(ref_file), "-l", str(length), "-n", str(min_hlog)])
+            errors = [ ]
+            runner = run(host, " ".join(cmd), out.write, errors.append)
+            if timeout:
+                runner.timeout = timeout+SSH_TIMEOUT_GRACE
+            runner.onDone = _search_done(host, f, out, errors)
+            return runner
+        def _next():
+            while copied:
+                host, f = copied.popleft()
+                if host in live:
+                    return _search(host, f)
+                running[host] -= 1
+                pending.appendleft(f)
+            if pending and not live:
+                raise TypeError("none of the hosts %s could be used" % ",".join(hosts))
+            for f in [f for f in pending if not live-failed_on[f]]:
+                pending.remove(f)
+                print "genomes %s cannot be used, see %s.log" % (f, f)
+            for host in sorted(live, key=lambda x: running[x]):
+                if running[host] >= host_slots[host]:
+                    continue
+                for f in pending:
+                    if host not in failed_on[f]:
+                        pending.remove(f)
+                        running[host] += 1
+                        runner = copy(host, f, _remote(f))
+                        runner.onDone = _copy_done(host, f)
+                        return runner
+            if [host for host in hosts if running[host]]:
+                return None
+            raise StopIteration
+        try:
+            commands.runCommandGens([_stage(host) for host in hosts])
+            commands.runProgramQueue(_next, sum(host_slots.values()))
+        finally:
+            commands.runCommandGens([_clean(host) for host in sorted(staged)])
+    return _execute
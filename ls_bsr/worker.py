@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""searches one genome on a remote host for ssh_executor, writing
+its hits, or with reference scores its parsed column, to stdout"""
+
+from optparse import OptionParser
+from ls_bsr.util import *
+import os
+import sys
+import shutil
+import subprocess
+
+def main(genome, queries, blast, filter, penalty, reward, ref_file, length, min_hlog):
+    if blast in ["tblastn", "blastn"]:
+        format_genome_db(genome, "nucl")
+    out_file = "%s_blast.out" % genome
+    outfile = open(out_file, "w")
+    code = subprocess.call(search_command(blast, queries, genome, 1, filter, penalty, reward), stdout=outfile)
+    outfile.close()
+    if code != 0:
+        print >> sys.stderr, "%s exited with %s" % (blast, code)
+        sys.exit(1)
+    if ref_file is None:
+        shutil.copyfileobj(open(out_file), sys.stdout)
+    else:
+        ref_scores = read_ref_scores(ref_file)
+        names, ref = hit_table_arrays(ref_scores, ref_scores)
+        sys.stdout.write(encode_hit_table(parse_hit_table(out_file, names, ref, length, min_hlog)))
+    os.remove(out_file)
+
+if __name__ == "__main__":
+    usage="usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-g", "--genome", dest="genome",
+                      help="/path/to/genome.fasta.new [REQUIRED]",
+                      action="store", type="string")
+    parser.add_option("-q", "--queries", dest="queries",
+                      help="/path/to/queries [REQUIRED]",
+                      action="store", type="string")
+    parser.add_option("-b", "--blast", dest="blast",
+                      help="tblastn, blastn or blat [REQUIRED]",
+                      action="store", type="choice", choices=["tblastn", "blastn", "blat"])
+    parser.add_option("-f", "--filter", dest="filter",
+                      help="F to filter blastn queries, T not to, defaults to F",
+                      action="store", default="F", type="string")
+    parser.add_option("--penalty", dest="penalty",
+                      help="blastn mismatch penalty, defaults to -5",
+                      action="store", default="-5", type="int")
+    parser.add_option("--reward", dest="reward",
+                      help="blastn match reward, defaults to 1",
+                      action="store", default="1", type="int")
+    parser.add_option("-r", "--ref_scores", dest="ref_file",
+                      help="/path/to/ref_scores.txt, to send back the parsed column instead of the hits",
+                      action="store", type="string")
+    parser.add_option("-l", "--length", dest="length",
+                      help="minimum BSR of a duplicate, defaults to 0.7",
+                      action="store", default="0.7", type="float")
+    parser.add_option("-n", "--min_hlog", dest="min_hlog",
+                      help="minimum identity of a duplicate, defaults to 75",
+                      action="store", default="75", type="int")
+    options, args = parser.parse_args()
+
+    mandatories = ["genome", "queries", "blast"]
+    for m in mandatories:
+        if not options.__dict__[m]:
+            print >> sys.stderr, "\nMust provide %s.\n" %m
+            parser.print_help(sys.stderr)
+            exit(-1)
+
+    main(options.genome, options.queries, options.blast, options.filter, options.penalty,
+         options.reward, options.ref_file, options.length, options.min_hlog)
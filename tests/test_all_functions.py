@@ -7,6 +7,7 @@ from ls_bsr.util import *
 import os
 import tempfile
 import shutil
+import numpy
 
 curr_dir=os.getcwd()
 
@@ -206,43 +207,32 @@ class Test6(unittest.TestCase):
         
         
 class Test8(unittest.TestCase):
-    def test_divide_values_basic_function(self):
-        """tests basic functionality of the divide_values function"""
+    def test_write_bsr_matrix_basic_function(self):
+        """each value is divided by its row's reference score"""
         tdir = tempfile.mkdtemp(prefix="filetest_",)
-        fpath = os.path.join(tdir,"testfile.filtered")
-        fp = open(fpath, "w")
-        fp.write("	sample1	sample2\n")
-        fp.write("Cluster0	30.2	15.2\n")
-        fp.write("Cluster1	40.5	0\n")
-        fp.write("Cluster2	60.6	30.6")
-        fp.close()
-        self.assertEqual(divide_values(fpath, {'Cluster2': '60.6', 'Cluster0': '30.2', 'Cluster1': '40.5'}),
-                     [[1.0, 0.5033112582781457], [1.0, 0.0], [1.0, 0.504950495049505]])
+        fpath = os.path.join(tdir,"matrix")
+        names, ref = hit_table_arrays(["Cluster2", "Cluster0", "Cluster1"], {'Cluster2': '60.6', 'Cluster0': '30.2', 'Cluster1': '40.5'})
+        columns = [numpy.array([30.2, 40.5, 60.6]), numpy.array([15.2, 0, 30.6])]
+        write_bsr_matrix(fpath, names, ref, ["sample1", "sample2"], columns, 10**6)
+        self.assertEqual(open(fpath).read(), "\tsample1\tsample2\nCluster0\t1.00\t0.50\nCluster1\t1.00\t0.00\nCluster2\t1.00\t0.50\n")
         shutil.rmtree(tdir)
-    def test_divide_values_missing_values(self):
-        """tests if a condition has a missing value"""
+    def test_parse_hit_table_missing_values(self):
+        """a hit line with too few fields raises an error"""
         tdir = tempfile.mkdtemp(prefix="filetest_",)
-        fpath = os.path.join(tdir,"testfile.filtered")
-        fp = open(fpath, "w")
-        fp.write("	sample1	sample2\n")
-        fp.write("Cluster0	30.2	15.2\n")
-        fp.write("Cluster1	40.5	0\n")
-        fp.write("Cluster2	60.6")
-        fp.close()
-        self.assertRaises(TypeError, divide_values, {'Cluster2': '60.6', 'Cluster0': '30.2', 'Cluster1': '40.5'})
-        os.system("rm BSR_matrix_values.txt")
+        fpath = os.path.join(tdir,"testfile_blast.out")
+        open(fpath, "w").write("Cluster0\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t30.2\n"
+                               "Cluster1\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\n")
+        names, ref = hit_table_arrays(["Cluster0", "Cluster1"], {'Cluster0': '30.2', 'Cluster1': '40.5'})
+        self.assertRaises(TypeError, parse_hit_table, fpath, names, ref, 0.7, 75)
         shutil.rmtree(tdir)
-    def test_divide_values_weird_value(self):
-        """tests if a non float or integer value is encountered
-        should raise an error"""
+    def test_parse_hit_table_weird_value(self):
+        """a non float or integer score should raise an error"""
         tdir = tempfile.mkdtemp(prefix="filetest_",)
-        fpath = os.path.join(tdir,"testfile.filtered")
-        fp = open(fpath, "w")
-        fp.write("	sample1	sample2\n")
-        fp.write("Cluster0	30.2	15.2\n")
-        fp.write("Cluster1	40.5	ABCDE")
-        fp.close()
-        self.assertRaises(TypeError, divide_values, {'Cluster2': '60.6', 'Cluster0': '30.2', 'Cluster1': '40.5'})
+        fpath = os.path.join(tdir,"testfile_blast.out")
+        open(fpath, "w").write("Cluster0\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t30.2\n"
+                               "Cluster1\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\tABCDE\n")
+        names, ref = hit_table_arrays(["Cluster0", "Cluster1"], {'Cluster0': '30.2', 'Cluster1': '40.5'})
+        self.assertRaises(TypeError, parse_hit_table, fpath, names, ref, 0.7, 75)
         shutil.rmtree(tdir)
         
 class Test9(unittest.TestCase):
@@ -655,7 +645,7 @@ class Test19(unittest.TestCase):
         fp.write("Cluster1	Cluster1	100.00	15	0	0	1	15	1	15	1e-07	40.5\n")
         fp.write("Cluster2	Cluster2	100.00	15	0	0	1	15	1	15	1e-07	60.6")
         fp.close()
-        self.assertEqual(find_dups({'Cluster0': '500', 'Cluster1': '40.5', 'Cluster2': '60.6'}, 0.7, 0.85, 75), (['Cluster0'], {'Cluster0': ['500', '420'], 'Cluster1': ['40.5', '40.5']}))
+        self.assertEqual(find_dups({'Cluster0': '500', 'Cluster1': '40.5', 'Cluster2': '60.6'}, 0.7, 0.85, 75), (['Cluster0'], {'Cluster0': 2, 'Cluster1': 2}))
         os.chdir("%s" % curr_dir)
         shutil.rmtree(tdir)
     def test_find_dups_multiple_dups(self):
@@ -671,7 +661,7 @@ class Test19(unittest.TestCase):
         fp.write("Cluster1	Cluster1	100.00	15	0	0	1	15	1	15	1e-07	40.5\n")
         fp.write("Cluster2	Cluster2	100.00	15	0	0	1	15	1	15	1e-07	60.6")
         fp.close()
-        self.assertEqual(find_dups({'Cluster0': '500', 'Cluster1': '40.5', 'Cluster2': '60.6'}, 0.7, 0.85, 75), (['Cluster0'], {'Cluster0': ['500', '420', '430'], 'Cluster1': ['40.5', '40.5']}))
+        self.assertEqual(find_dups({'Cluster0': '500', 'Cluster1': '40.5', 'Cluster2': '60.6'}, 0.7, 0.85, 75), (['Cluster0'], {'Cluster0': 3, 'Cluster1': 2}))
         os.chdir("%s" % curr_dir)
         shutil.rmtree(tdir)
     def test_find_dups_bad_input(self):
@@ -908,6 +898,832 @@ class Test24(unittest.TestCase):
         np.write("ATGAAGAAATCAATATTATTTATTTTTCTTTCTGTATTGTCTTTT")
         np.close()
         self.assertEqual(get_cluster_ids(npath), ['bfp-B','LT_X','ST#%$'])
+
+class Test25(unittest.TestCase):
+    def test_calculate_self_scores_tblastn(self):
+        """BLOSUM62 self scores; terminal X residues are trimmed from the
+        local alignment and an empty peptide still gets a value"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile.pep")
+        fp = open(fpath, "w")
+        fp.write(">Cluster0\n")
+        fp.write("MTSFP\n")
+        fp.write(">Cluster1\n")
+        fp.write("XXMTSFPXX\n")
+        fp.write(">Cluster2\n")
+        fp.close()
+        self.assertEqual(calculate_self_scores(fpath, "tblastn"), {'Cluster0': '15.0', 'Cluster1': '15.0', 'Cluster2': '4.6'})
+        shutil.rmtree(tdir)
+    def test_calculate_self_scores_blastn(self):
+        """tests reward/penalty scoring, and an unsupported pair"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile.fasta")
+        fp = open(fpath, "w")
+        fp.write(">Cluster0\n")
+        fp.write("ATGC"*25)
+        fp.close()
+        self.assertEqual(calculate_self_scores(fpath, "blastn", -5, 1), {'Cluster0': '201'})
+        self.assertEqual(calculate_self_scores(fpath, "blat"), {'Cluster0': '196.0'})
+        self.assertRaises(ValueError, calculate_self_scores, fpath, "blastn", -9, 1)
+        shutil.rmtree(tdir)
+    def test_compare_self_scores(self):
+        self.assertEqual(compare_self_scores({'Cluster0':'110','Cluster1':'5'},{'Cluster0':'100','Cluster2':'3'}), {'Cluster0': 0.1})
+
+class Test26(unittest.TestCase):
+    def test_genome_batches_basic_function(self):
+        """genomes are packed largest first into the emptiest batch"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        files = [ ]
+        for name, size in [("a", 50), ("b", 40), ("c", 30), ("d", 20)]:
+            fpath = os.path.join(tdir, name)
+            open(fpath, "w").write("A"*size)
+            files.append(fpath)
+        batches = genome_batches(files, 2)
+        self.assertEqual([[os.path.basename(x) for x in b] for b in batches], [['a', 'd'], ['b', 'c']])
+        self.assertEqual(len(genome_batches(files, 1, max_bases=60)), 3)
+        shutil.rmtree(tdir)
+    def test_search_genomes_batch_blastp(self):
+        """blastp can't be searched in batches of genomes"""
+        self.assertRaises(TypeError, search_genomes, curr_dir, 1, "consensus.pep", "blastp", "F", -5, 1, "T")
+    def test_split_batch_report_basic_function(self):
+        """hits are written back to their own genome with the original
+        subject IDs"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        g1 = os.path.join(tdir, "g1.fasta.new")
+        g2 = os.path.join(tdir, "g2.fasta.new")
+        open(g1, "w").write(">contig1\nATGC\n>contig2\nATGC\n")
+        open(g2, "w").write(">contig1\nATGC\n")
+        db = os.path.join(tdir, "batch_0.fasta")
+        seq_ids = write_batch_db([g1, g2], db)
+        self.assertEqual(seq_ids, {'g0_0': 'contig1', 'g0_1': 'contig2', 'g1_2': 'contig1'})
+        report = os.path.join(tdir, "batch_0.fasta.out")
+        fp = open(report, "w")
+        fp.write("Cluster0	g1_2	100.00	15	0	0	1	15	1	15	1e-07	30.2\n")
+        fp.write("Cluster0	g0_1	90.00	15	0	0	1	15	1	15	1e-06	25.0\n")
+        fp.close()
+        split_batch_report(report, [g1, g2], seq_ids)
+        self.assertEqual(open("%s_blast.out" % g1).read(), "Cluster0	contig2	90.00	15	0	0	1	15	1	15	1e-06	25.0\n")
+        self.assertEqual(open("%s_blast.out" % g2).read(), "Cluster0	contig1	100.00	15	0	0	1	15	1	15	1e-07	30.2\n")
+        shutil.rmtree(tdir)
+
+class Test27(unittest.TestCase):
+    def test_query_shard_count_basic_function(self):
+        """few genomes and many queries get more shards, capped by the
+        minimum shard size"""
+        self.assertEqual(query_shard_count([100, 100], 100000, 4), 8)
+        self.assertEqual(query_shard_count([100]*16, 100000, 4), 1)
+        self.assertEqual(query_shard_count([100, 100], 500, 4), 2)
+        self.assertEqual(query_shard_count([], 500, 4), 1)
+    def test_search_genome_grid_basic_function(self):
+        """each genome's shard outputs are merged back in shard order"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir("%s" % tdir)
+        fp = open("queries.fasta", "w")
+        for x in range(5):
+            fp.write(">Cluster%s\nATGCATGC\n" % x)
+        fp.close()
+        self.assertEqual(split_queries("queries.fasta", 1), ["queries.fasta"])
+        shards = split_queries("queries.fasta", 2)
+        self.assertEqual(open(shards[0]).read(), ">Cluster0\nATGCATGC\n>Cluster1\nATGCATGC\n>Cluster2\nATGCATGC\n")
+        for shard in shards: os.remove(shard)
+        open("g1.fasta.new", "w").write(">contig1\nATGC\n")
+        search_genome_grid(tdir, 1, "queries.fasta", "cp", None, lambda query, f, threads: ["cat", query])
+        self.assertEqual(open("g1.fasta.new_blast.out").read(), open("queries.fasta").read())
+        self.assertEqual(sorted(os.listdir(tdir)), ["g1.fasta.new", "g1.fasta.new_blast.out", "ls_bsr_task_times.txt", "queries.fasta"])
+        self.assertEqual(read_task_times(os.path.join(tdir, "ls_bsr_task_times.txt")).keys(), [("cp", "g1.fasta.new", 14)])
+        os.chdir("%s" % curr_dir)
+        shutil.rmtree(tdir)
+
+class Test28(unittest.TestCase):
+    def test_order_by_cost_estimated(self):
+        """without measurements, size and sequence count decide"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        a = os.path.join(tdir, "a")
+        b = os.path.join(tdir, "b")
+        c = os.path.join(tdir, "c")
+        open(a, "w").write(">1\n"+"A"*100+"\n")
+        open(b, "w").write(">1\n"+"A"*5000+"\n")
+        open(c, "w").write(">1\nA\n>2\nA\n")
+        self.assertEqual(order_by_cost([a, b, c], "prodigal", {}), [c, b, a])
+        shutil.rmtree(tdir)
+    def test_order_by_cost_measured(self):
+        """measured durations win, and are written back out"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        a = os.path.join(tdir, "a")
+        b = os.path.join(tdir, "b")
+        open(a, "w").write(">1\nAAAA\n")
+        open(b, "w").write(">1\nAA\n")
+        times_file = os.path.join(tdir, "times")
+        write_task_times(times_file, {("prodigal", "b", 6): 30.0, ("prodigal", "a", 8): 10.0, ("blat", "a", 8): 60.0})
+        times = read_task_times(times_file)
+        self.assertEqual(times, {("prodigal", "b", 6): 30.0, ("prodigal", "a", 8): 10.0, ("blat", "a", 8): 60.0})
+        self.assertEqual(order_by_cost([a, b], "prodigal", times), [b, a])
+        self.assertEqual(order_by_cost([a, b], "blat", times), [a, b])
+        shutil.rmtree(tdir)
+    def test_task_times_merge(self):
+        """new durations are merged into the file and malformed lines are skipped"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        times_file = os.path.join(tdir, "times")
+        open(times_file, "w").write("prodigal\ta\t8\t10.00\nprodigal\tb\t6\t30.00\nblat\ta\t8\n")
+        write_task_times(times_file, {("prodigal", "b", 6): 20.0, ("blat", "a", 8): 60.0})
+        self.assertEqual(read_task_times(times_file), {("prodigal", "a", 8): 10.0, ("prodigal", "b", 6): 20.0, ("blat", "a", 8): 60.0})
+        self.assertEqual(os.listdir(tdir), ["times"])
+        shutil.rmtree(tdir)
+
+class Test29(unittest.TestCase):
+    def test_parse_cpu_list_basic_function(self):
+        self.assertEqual(parse_cpu_list("0-3,8,10-11\n"), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(parse_cpu_list(""), [])
+    def test_cgroup_cpu_limit(self):
+        """tests cgroup v2, v1 and no quota"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        self.assertEqual(cgroup_cpu_limit(tdir), None)
+        os.makedirs(os.path.join(tdir, "cpu"))
+        open(os.path.join(tdir, "cpu", "cpu.cfs_quota_us"), "w").write("-1\n")
+        open(os.path.join(tdir, "cpu", "cpu.cfs_period_us"), "w").write("100000\n")
+        self.assertEqual(cgroup_cpu_limit(tdir), None)
+        open(os.path.join(tdir, "cpu", "cpu.cfs_quota_us"), "w").write("250000\n")
+        self.assertEqual(cgroup_cpu_limit(tdir), 2.5)
+        open(os.path.join(tdir, "cpu.max"), "w").write("400000 100000\n")
+        self.assertEqual(cgroup_cpu_limit(tdir), 4)
+        shutil.rmtree(tdir)
+    def test_available_cores_quota(self):
+        """a quota below the affinity mask caps the cores"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        open(os.path.join(tdir, "cpu.max"), "w").write("150000 100000\n")
+        self.assertEqual(available_cores(cgroup_root=tdir), 1)
+        shutil.rmtree(tdir)
+    def test_plan_threads_basic_function(self):
+        self.assertEqual(plan_threads(32, 1000), (32, 1))
+        self.assertEqual(plan_threads(32, 2), (2, 16))
+        self.assertEqual(plan_threads(8, 3), (3, 2))
+        self.assertEqual(plan_threads(8, 0), (1, 8))
+
+class Test30(unittest.TestCase):
+    def test_memory_ceiling(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        meminfo = os.path.join(tdir, "meminfo")
+        open(meminfo, "w").write("MemTotal:       1000 kB\nMemFree:         500 kB\n")
+        self.assertEqual(memory_ceiling(2, meminfo, tdir), 2*1024**3)
+        self.assertEqual(memory_ceiling(0, meminfo, tdir), 921600)
+        open(os.path.join(tdir, "memory.max"), "w").write("102400\n")
+        self.assertEqual(memory_ceiling(0, meminfo, tdir), 92160)
+        self.assertEqual(memory_ceiling(0, os.path.join(tdir, "missing"), os.path.join(tdir, "missing")), None)
+        shutil.rmtree(tdir)
+
+class Test31(unittest.TestCase):
+    def test_numa_cpu_sets_basic_function(self):
+        """nodes are read from sysfs and limited to the allowed CPUs"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        for node, cpulist in [("node0", "0-3\n"), ("node1", "4-7\n"), ("node10", "8\n")]:
+            os.makedirs(os.path.join(tdir, node))
+            open(os.path.join(tdir, node, "cpulist"), "w").write(cpulist)
+        self.assertEqual(numa_cpu_sets(tdir, range(8)), [[0, 1, 2, 3], [4, 5, 6, 7]])
+        self.assertEqual(numa_cpu_sets(tdir, [1, 8]), [[1], [8]])
+        self.assertEqual(numa_cpu_sets(os.path.join(tdir, "missing"), [0, 1]), [[0, 1]])
+        shutil.rmtree(tdir)
+    def test_cpu_slots_basic_function(self):
+        """slots stay inside one node and alternate between nodes"""
+        nodes = [[0, 1, 2, 3], [4, 5, 6, 7]]
+        self.assertEqual(cpu_slots(4, 2, nodes), [[0, 1], [4, 5], [2, 3], [6, 7]])
+        self.assertEqual(cpu_slots(3, 1, nodes), [[0], [4], [1]])
+        self.assertEqual(cpu_slots(2, 8, nodes), [[0, 1, 2, 3], [4, 5, 6, 7]])
+        self.assertEqual(cpu_slots(3, 4, [[0, 1, 2, 3]]), [[0, 1, 2, 3], [0, 1, 2, 3], [0, 1, 2, 3]])
+    def test_run_pinned_basic_function(self):
+        """a launched program only sees the CPU it was pinned to"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        cpu = allowed_cpus()[0]
+        pool = Queue.Queue()
+        pool.put([cpu])
+        out = open(os.path.join(tdir, "status"), "w")
+        run_pinned(pool, lambda preexec_fn: subprocess.call(["cat", "/proc/self/status"], stdout=out, preexec_fn=preexec_fn))
+        out.close()
+        self.assertEqual(allowed_cpus(os.path.join(tdir, "status")), [cpu])
+        self.assertEqual(pool.get_nowait(), [cpu])
+        shutil.rmtree(tdir)
+
+class Test32(unittest.TestCase):
+    def test_run_prodigal_cache_hit(self):
+        """a genome already in the cache is linked, not predicted"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        genome = os.path.join(tdir, "genome.fasta")
+        open(genome, "w").write(">contig\nATGAAATAG\n")
+        cached = os.path.join(tdir, genome_hash(genome))
+        open(cached+".seqs", "w").write(">gene\nATGAAATAG\n")
+        open(cached+".pep", "w").write(">gene\nMK*\n")
+        run_prodigal(genome, tdir)
+        self.assertEqual(open(genome+"_genes.seqs").read(), ">gene\nATGAAATAG\n")
+        self.assertEqual(open(genome+"_genes.pep").read(), ">gene\nMK*\n")
+        shutil.rmtree(tdir)
+    def test_collect_genes_basic_function(self):
+        """genes are written in genome order, whatever order predictions finish in"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        a = os.path.join(tdir, "a.fasta")
+        b = os.path.join(tdir, "b.fasta")
+        open(a+"_genes.seqs", "w").write(">a1\nATGAAA\n>a2\nATGNNN\n")
+        open(b+"_genes.seqs", "w").write(">b1\nATGCCC\n")
+        done = Channel()
+        done.send(b)
+        done.send(a)
+        out = os.path.join(tdir, "out.fasta")
+        self.assertEqual(collect_genes([a, b], done, out), 2)
+        lines = open(out).read().splitlines()
+        self.assertEqual(lines[1::2], ["ATGAAA", "ATGCCC"])
+        self.assertTrue(lines[0].startswith(">centroid_"))
+        shutil.rmtree(tdir)
+    def test_predict_genes_collector_error(self):
+        """an error collecting genes is raised, not lost"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.makedirs(os.path.join(tdir, "joined"))
+        os.makedirs(os.path.join(tdir, "cache"))
+        genome = os.path.join(tdir, "joined", "g.fasta.new")
+        open(genome, "w").write(">contig1\nATGC\n")
+        for ext in ["seqs", "pep"]:
+            open(os.path.join(tdir, "cache", "%s.%s" % (genome_hash(genome), ext)), "w").write(">gene1\nATG\n")
+        self.assertRaises(IOError, predict_genes, tdir, 1, "F", os.path.join(tdir, "cache"),
+                          os.path.join(tdir, "missing", "genes.fasta"))
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test33(unittest.TestCase):
+    def test_collapse_duplicates_basic_function(self):
+        """identical sequences are written once and tabled against the first"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genes.fasta")
+        open(fpath, "w").write(">c1\nATGAAA\n>c2\nATGCCC\n>c3\natgaaa\n")
+        self.assertEqual(collapse_duplicates(fpath, os.path.join(tdir,"out.fasta"), os.path.join(tdir,"table")), 2)
+        self.assertEqual(open(os.path.join(tdir,"out.fasta")).read(), ">c1\nATGAAA\n>c2\nATGCCC\n")
+        self.assertEqual(open(os.path.join(tdir,"table")).read(), "c1\tc1\nc2\tc2\nc3\tc1\n")
+        shutil.rmtree(tdir)
+    def test_cluster_membership_basic_function(self):
+        """duplicates inherit the centroid of their representative across levels"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        table = os.path.join(tdir,"table")
+        open(table, "w").write("c1\tc1\nc2\tc2\nc3\tc1\nc4\tc4\n")
+        first = os.path.join(tdir,"first.uc")
+        open(first, "w").write("S\t0\t6\t*\t*\t*\t*\t*\tc2\t*\nH\t0\t6\t95.0\t+\t0\t0\t6M\tc1\tc2\nC\t0\t2\t*\t*\t*\t*\t*\tc2\t*\n")
+        second = os.path.join(tdir,"second.uc")
+        open(second, "w").write("H\t0\t6\t95.0\t+\t0\t0\t6M\tc2\tc4\n")
+        cluster_membership([first, second], table, os.path.join(tdir,"out"))
+        self.assertEqual(open(os.path.join(tdir,"out")).read(), "c1\tc4\t90.2\nc2\tc4\t95.0\nc3\tc4\t90.2\nc4\tc4\t100.0\n")
+        shutil.rmtree(tdir)
+
+class Test34(unittest.TestCase):
+    def test_split_fasta_chunks_basic_function(self):
+        """chunks close on either limit and never split a record"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genes.fasta")
+        open(fpath, "w").write(">c1\nATGAAA\nTAG\n>c2\nATG\n>c3\nATGCCC\n>c4\nATG\n")
+        self.assertEqual(len(split_fasta_chunks(fpath, os.path.join(tdir,"single"), 1, 1000)), 4)
+        chunks = split_fasta_chunks(fpath, os.path.join(tdir,"chunk"), 3, 12)
+        self.assertEqual([os.path.basename(x) for x in chunks], ["chunk0", "chunk1"])
+        self.assertEqual(open(chunks[0]).read(), ">c1\nATGAAATAG\n>c2\nATG\n")
+        self.assertEqual(open(chunks[1]).read(), ">c3\nATGCCC\n>c4\nATG\n")
+        self.assertEqual(split_fasta_chunks(fpath, os.path.join(tdir,"one"), 10, 1000), [os.path.join(tdir,"one0")])
+        shutil.rmtree(tdir)
+
+class Test35(unittest.TestCase):
+    def test_within_edits_basic_function(self):
+        """edits are counted against the best part of the target"""
+        self.assertEqual(within_edits("ACGTACGT", "TTACGTACGTTT", 0), 0)
+        self.assertEqual(within_edits("ACGAACGT", "TTACGTACGTTT", 2), 1)
+        self.assertEqual(within_edits("ACGTTACGT", "ACGTACGT", 1), 1)
+        self.assertEqual(within_edits("AAAAAAAA", "CCCCCCCC", 3), None)
+        self.assertEqual(within_edits("CCGTTAACGTAC", "GGACGTACGTACGG", 3), 3)
+        self.assertEqual(within_edits("ACGTACGTACGTAC", "ACGTAC", 3), None)
+    def test_kmer_codes_basic_function(self):
+        """k-mers spanning anything but ACGT are skipped"""
+        self.assertEqual(kmer_codes("ACGTA", 2).tolist(), [1, 6, 11, 12])
+        self.assertEqual(kmer_codes("ACNGT", 2).tolist(), [1, 11])
+        self.assertEqual(len(kmer_codes("ACG", 8)), 0)
+    def test_kmer_cluster_basic_function(self):
+        """similar genes join the longest centroid, the rest seed clusters"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genes.fasta")
+        seq = "ATGGCTAGCTTAGGCACCGATCGATTACGGCATCAGGACTTGA"
+        other = "ATGCCCGGGTTTAAACCCGGGTTTAAACTGACTGCATGCATGA"
+        open(fpath, "w").write(">c1\n%s\n>c2\n%s\n>c3\n%s\n>c4\n%s\n" % (seq[:-3], other, seq, seq[:20]+"T"+seq[21:]))
+        for processors, batch_size in [(1, 10000), (2, 1)]:
+            centroids = os.path.join(tdir,"consensus.fasta")
+            uc = os.path.join(tdir,"results.uc")
+            self.assertEqual(kmer_cluster(fpath, 0.9, processors, centroids, uc, batch_size), 2)
+            self.assertEqual(get_cluster_ids(centroids), ["c2", "c3"])
+            records = [line.split("\t") for line in open(uc).read().splitlines()]
+            self.assertEqual([(x[0], x[8], x[9]) for x in records if x[0] == "H"], [("H", "c4", "c3"), ("H", "c1", "c3")])
+            self.assertEqual([(x[8], x[2]) for x in records if x[0] == "C"], [("c2", "1"), ("c3", "3")])
+        shutil.rmtree(tdir)
+
+class Test36(unittest.TestCase):
+    def test_membership_hits_basic_function(self):
+        """cluster members are grouped by the genome they came from"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        membership = os.path.join(tdir,"membership")
+        open(membership, "w").write("c1\tc1\t100.0\nc2\tc1\t95.0\nc3\tc3\t100.0\nc4\tc1\t100.0\n")
+        origins = os.path.join(tdir,"origins")
+        open(origins, "w").write("c1\tA.fasta.new\nc2\tB.fasta.new\nc3\tB.fasta.new\nc4\tA.fasta.new\n")
+        hits = membership_hits(membership, origins)
+        self.assertEqual(hits, {"A.fasta.new": {"c1": [("c1", 100.0), ("c4", 100.0)]},
+                                "B.fasta.new": {"c1": [("c2", 95.0)], "c3": [("c3", 100.0)]}})
+        shutil.rmtree(tdir)
+    def test_ambiguous_queries_basic_function(self):
+        """only clusters without a member from the genome are searched"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        queries = os.path.join(tdir,"consensus.fasta")
+        open(queries, "w").write(">c1\nATG\n>c3\nAAA\n")
+        files = [os.path.join(tdir,"A.fasta.new"), os.path.join(tdir,"B.fasta.new")]
+        genome_queries = ambiguous_queries(queries, files, {"A.fasta.new": {"c1": [("c1", 100.0)]}})
+        self.assertEqual(open(genome_queries[files[0]]).read(), ">c3\nAAA\n")
+        self.assertEqual(open(genome_queries[files[1]]).read(), ">c1\nATG\n>c3\nAAA\n")
+        shutil.rmtree(tdir)
+    def test_write_membership_hits_basic_function(self):
+        """member hits are scored from the reference score and identity"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        open("B.fasta.new_blast.out", "w").write("c3\tcontig\t99.0\t10\t0\t0\t1\t10\t1\t10\t1e-5\t50.0\n")
+        write_membership_hits({"B.fasta.new": {"c1": [("c2", 95.0)], "c9": [("c9", 100.0)]}}, {"c1": "200"})
+        lines = open("B.fasta.new_blast.out").read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split("\t")[0:3]+lines[1].split("\t")[11:], ["c1", "c2", "95.00", "190.0"])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test37(unittest.TestCase):
+    def test_unhit_queries_basic_function(self):
+        """queries hit in the proteome are not searched again"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        queries = os.path.join(tdir,"consensus.pep")
+        open(queries, "w").write(">c1\nMKL\n>c2\nMAA\n>c3\nMTT\n")
+        report = os.path.join(tdir,"blastp.out")
+        open(report, "w").write("c2\tgene_1\t100.0\t3\t0\t0\t1\t3\t1\t3\t1e-5\t10.0\n")
+        unhit_queries(queries, report, os.path.join(tdir,"fallback"))
+        self.assertEqual(open(os.path.join(tdir,"fallback")).read(), ">c1\nMKL\n>c3\nMTT\n")
+        shutil.rmtree(tdir)
+
+class Test38(unittest.TestCase):
+    def test_alphabet_kmers_basic_function(self):
+        """k-mers are numbers in the base of the alphabet"""
+        self.assertEqual(alphabet_kmers("ACDA", 2, "ACD").tolist(), [1, 5, 6])
+        self.assertEqual(alphabet_kmers("AC*DA", 2, "ACD").tolist(), [1, 6])
+    def test_prescreen_queries_basic_function(self):
+        """only queries sharing enough k-mers with a genome are kept for it"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        gene = "ATGGCTAGCTTAGGCACCGATCGATTACGGCATCAGGACTTGA"
+        other = "ATGCCCGGGTTTAAACCCGGGTTTAAACTGACTGCATGCATGA"
+        queries = os.path.join(tdir,"genes.fasta")
+        open(queries, "w").write(">g1\n%s\n>g2\n%s\n>g3\nATG\n" % (gene, other))
+        genome = os.path.join(tdir,"A.fasta.new")
+        open(genome, "w").write(">contig\nTTTTTCAAGTCCTGATGCCGTAATCGATCGGTGCCTAAGCTAGCCATTTTT\n")
+        skipped = os.path.join(tdir,"skipped")
+        screened = prescreen_queries(queries, [genome], False, 0.5, 1, skipped)
+        self.assertEqual(get_cluster_ids(screened[genome]), ["g1", "g3"])
+        self.assertEqual(open(skipped).read(), "g2\tA\t0.000\n")
+        peptides = os.path.join(tdir,"genes.pep")
+        open(peptides, "w").write(">g1\nMASLGTDRLRHQDL\n>g2\nMPGFKPGFKLTACM\n")
+        screened = prescreen_queries(peptides, [genome], True, 0.5, 1, skipped)
+        self.assertEqual(get_cluster_ids(screened[genome]), ["g1"])
+        shutil.rmtree(tdir)
+    def test_prescreen_misses_basic_function(self):
+        """skipped pairs with a BSR value at the threshold are misses"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        matrix = os.path.join(tdir,"matrix")
+        open(matrix, "w").write("\tA\tB\ng1\t1.00\t0.10\ng2\t0.00\t0.90\n")
+        skipped = os.path.join(tdir,"skipped")
+        open(skipped, "w").write("g1\tB\t0.010\ng2\tA\t0.000\ng2\tB\t0.200\ng9\tA\t0.000\n")
+        self.assertEqual(prescreen_misses(skipped, matrix, 0.4), ([("g2", "B", 0.2, 0.9)], 3))
+        shutil.rmtree(tdir)
+
+class Test39(unittest.TestCase):
+    def test_read_fasta_basic_function(self):
+        """records are read as SeqIO reads them"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        open(fpath, "w").write("junk\n>\nAC GT\r\n\n>a b c\nAAA\nTT\n> x\nC\n")
+        self.assertEqual(list(read_fasta(fpath)), [("", "ACGT"), ("a", "AAATT"), ("x", "C")])
+        self.assertEqual(list(read_fasta(open(fpath), True))[1], ("a b c", "AAATT"))
+        self.assertEqual(fasta_ids(fpath), ["", "a", "x"])
+        open(fpath, "w").write("not a fasta file")
+        self.assertEqual(list(read_fasta(fpath)), [])
+        shutil.rmtree(tdir)
+    def test_fasta_id(self):
+        """the id is the first word of the title"""
+        self.assertEqual([fasta_id(x) for x in ["a b\tc", " x", "", "\t"]], ["a", "x", "", ""])
+    def test_write_fasta_wrapped(self):
+        """wrapped records match SeqIO.write"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"testfile")
+        handle = open(fpath, "w")
+        write_fasta(handle, "a b", "A"*130, 60)
+        write_fasta(handle, "c", "", 60)
+        write_fasta(handle, "d", "ACG")
+        handle.close()
+        self.assertEqual(open(fpath).read(), ">a b\n"+"A"*60+"\n"+"A"*60+"\n"+"A"*10+"\n>c\n>d\nACG\n")
+        shutil.rmtree(tdir)
+
+class Test40(unittest.TestCase):
+    def test_translate_records_basic_function(self):
+        """translation stops at the first stop codon and drops partial codons"""
+        records = [("a", "ATGACGAGCTTTCCGTAAGGG"), ("b", "atgaatcactac"), ("c", "ATGAA"), ("d", "")]
+        self.assertEqual(translate_records(records), [("a", "MTSFP"), ("b", "MNHY"), ("c", "M"), ("d", "")])
+    def test_translate_records_ambiguous_bases(self):
+        """sequences with other characters are translated by BioPython"""
+        self.assertEqual(translate_records([("a", "ATGNNNAAA"), ("b", "AUGUUU")], 11), [("a", "MXK"), ("b", "MF")])
+        self.assertRaises(TypeError, translate_records, [("a", "ATG1CG")])
+    def test_translate_fasta_processors(self):
+        """chunks translated in parallel are written in order"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"genes.fasta")
+        open(fpath, "w").write("".join([">g%s\nATG%sTAA\n" % (x, "GCT"*x) for x in range(50)]))
+        out = os.path.join(tdir,"genes.pep")
+        self.assertEqual(translate_fasta(fpath, out, 11, 10, 2), "M"+"A"*9)
+        self.assertEqual(list(read_fasta(out)), [("g%s" % x, "M"+"A"*x) for x in range(9, 50)])
+        shutil.rmtree(tdir)
+
+class Test41(unittest.TestCase):
+    def test_parse_hit_table_basic_function(self):
+        """best scores, duplicate hits and counts come from one pass"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"A.fasta.new_blast.out")
+        open(fpath, "w").write("Cluster0\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t500\n"
+                               "Cluster0\tc2\t80.00\t15\t0\t0\t1\t15\t1\t15\t1e-06\t420\n"
+                               "Cluster0\tc3\t70.00\t15\t0\t0\t1\t15\t1\t15\t1e-06\t600\n"
+                               "Cluster1\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t40.5\n")
+        names = numpy.array(["Cluster0", "Cluster1", "Cluster2"])
+        ref = numpy.array([500, 40.5, numpy.nan])
+        best, summary, stats = parse_hit_table(fpath, names, ref, 0.7, 75)
+        self.assertEqual(best.tolist(), [600, 40.5, 0])
+        self.assertEqual([x.tolist() for x in summary], [[2, 1, 0], [500, 40.5, 0], [420, 40.5, numpy.inf]])
+        self.assertEqual(stats, (4, 2, 3))
+        open(fpath, "a").write("Cluster1\tc1\t100.00\n")
+        self.assertRaises(TypeError, parse_hit_table, fpath, names, ref, 0.7, 75)
+        shutil.rmtree(tdir)
+    def test_report_dups_numeric_scores(self):
+        """scores compare as numbers, so 95 is not the best over 500"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        names = numpy.array(["Cluster0", "Cluster1"])
+        summary = merge_dup_summaries([dup_summary(numpy.array([0, 1]), numpy.array([500.0, 40.5]), 2),
+                                       dup_summary(numpy.array([0, 1]), numpy.array([95.0, 40.0]), 2)], 2)
+        self.assertEqual(report_dups(names, summary, 0.85), (["Cluster0"], {"Cluster0": 2, "Cluster1": 2}))
+        self.assertEqual(open("duplicate_ids.txt").read().splitlines(), ["Cluster0", "Cluster1"])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_hit_table_columns_basic_function(self):
+        """columns follow the sorted clusters and duplicates span genomes"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        open("A.fasta.new_blast.out", "w").write("Cluster1\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t40.5\n")
+        open("B.fasta.new_blast.out", "w").write("Cluster1\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t30.0\n"
+                                                 "Cluster0\tc2\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t80\n")
+        names, genomes, columns, summary, stats = hit_table_columns(["Cluster1", "Cluster0"], {'Cluster0': '100', 'Cluster1': '40.5'}, 0.7, 75, 2)
+        write_hit_stats("hit_stats.txt", genomes, stats)
+        report_dups(names, summary, 0.85)
+        self.assertEqual(names.tolist(), ["Cluster0", "Cluster1"])
+        self.assertEqual(genomes, ["A", "B"])
+        self.assertEqual([x.tolist() for x in columns], [[0, 40.5], [80, 30.0]])
+        self.assertEqual(open("duplicate_ids.txt").read().split(), ["Cluster1"])
+        self.assertEqual(open("paralog_ids.txt").read().split(), ["Cluster1"])
+        self.assertEqual(open("hit_stats.txt").read().splitlines()[1:], ["A\t1\t1\t1", "B\t2\t2\t2"])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test42(unittest.TestCase):
+    def test_load_hit_table_basic_function(self):
+        """columns are read from raw bytes and queries mapped to their index"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"hits")
+        open(fpath, "w").write("b\tc1\t99.50\t15\t0\t0\t1\t15\t3\t17\t1e-07\t1.2e+03\n"
+                               "x\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t10\n"
+                               "a\tc2\t80.00\t15\t0\t0\t2\t14\t20\t8\t1e-06\t42.5")
+        names = numpy.array(["a", "b"])
+        query, identity, score, qstart, qend, sstart, send = load_hit_table(fpath, names, True)
+        self.assertEqual(query.tolist(), [1, 0])
+        self.assertEqual(identity.tolist(), [99.5, 80.0])
+        self.assertEqual(score.tolist(), [1200.0, 42.5])
+        self.assertEqual(sstart.tolist(), [3, 20])
+        chunks = list(iter_hit_chunks(fpath, names, False, 10))
+        self.assertEqual(numpy.concatenate([x[2] for x in chunks]).tolist(), [1200.0, 42.5])
+        open(fpath, "w").write("b c1 99.5 15 0 0 1 15 3 17 1e-07 7\n\n")
+        self.assertEqual(load_hit_table(fpath, names)[2].tolist(), [7.0])
+        open(fpath, "w").write("")
+        self.assertEqual(len(load_hit_table(fpath, names)[0]), 0)
+        shutil.rmtree(tdir)
+    def test_field_numbers_basic_function(self):
+        """plain decimals are parsed in NumPy, other notations fall back"""
+        buf = numpy.frombuffer(b"99.50\t.25\t007\t1e-5\t-2\t", dtype=numpy.uint8)
+        ends = numpy.flatnonzero(buf == 9)
+        starts = numpy.append(0, ends[:-1]+1)
+        self.assertEqual(field_numbers(buf, starts, ends).tolist(), [99.5, 0.25, 7.0, 1e-05, -2.0])
+    def test_load_hit_table_long_fields(self):
+        """long query names and numbers are cut from the gather, not
+        misread"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        fpath = os.path.join(tdir,"hits")
+        open(fpath, "w").write("b\tc1\t99.50\t15\t0\t0\t1\t15\t3\t17\t1e-07\t%s\n"
+                               "%s\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t10\n"
+                               "a\tc2\t80.00\t15\t0\t0\t2\t14\t20\t8\t1e-06\t42.5\n" % ("0"*40+"12.5", "b"*5000))
+        query, identity, score = load_hit_table(fpath, numpy.array(["a", "b"]))
+        self.assertEqual(query.tolist(), [1, 0])
+        self.assertEqual(score.tolist(), [12.5, 42.5])
+        shutil.rmtree(tdir)
+    def test_group_max_basic_function(self):
+        self.assertEqual(group_max(numpy.array([2, 0, 2, 0]), numpy.array([1.0, 5.0, 3.0, 2.0]), 4).tolist(), [5, 0, 3, 0])
+
+class Test43(unittest.TestCase):
+    def test_search_genome_grid_reduce(self):
+        """each genome's merged output is reduced once it is complete"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir("%s" % tdir)
+        open("queries.fasta", "w").write(">Cluster0\nATGCATGC\n")
+        open("g1.fasta.new", "w").write(">contig1\nATGC\n")
+        open("g2.fasta.new", "w").write(">contig1\nATGCA\n")
+        reduced = {}
+        def _reduce(report):
+            reduced[os.path.basename(report)] = open(report).read()
+        search_genome_grid(tdir, 2, "queries.fasta", "cp", None, lambda query, f, threads: ["cat", query], reduce=_reduce)
+        self.assertEqual(reduced, {"g1.fasta.new_blast.out": ">Cluster0\nATGCATGC\n", "g2.fasta.new_blast.out": ">Cluster0\nATGCATGC\n"})
+        os.chdir("%s" % curr_dir)
+        shutil.rmtree(tdir)
+    def test_hit_table_columns_reduced(self):
+        """tables parsed during the search are not parsed again"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        open("A.fasta.new_blast.out", "w").write("Cluster0\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t40.5\n")
+        open("B.fasta.new_blast.out", "w").write("Cluster0\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t30.0\n")
+        reduced = {}
+        hit_table_reducer(["Cluster0"], {'Cluster0': '40.5'}, 0.7, 75, reduced)(os.path.join(tdir, "A.fasta.new_blast.out"))
+        open("A.fasta.new_blast.out", "w").write("")
+        names, genomes, columns, summary, stats = hit_table_columns(["Cluster0"], {'Cluster0': '40.5'}, 0.7, 75, 1, "F", reduced)
+        self.assertEqual(genomes, ["A", "B"])
+        self.assertEqual([x.tolist() for x in columns], [[40.5], [30.0]])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test44(unittest.TestCase):
+    def test_run_program_queue_basic_function(self):
+        """programs run from one thread at most max_running at a time, a
+        finished program can make another ready, output arrives as lines
+        and programs past their timeout are killed"""
+        from igs.utils import commands
+        out = [ ]
+        err = [ ]
+        done = [ ]
+        ready = [["printf", "a\\nb"], ["sh", "-c", "echo oops >&2"], ["sleep", "5"]]
+        runners = [ ]
+        def _done(runner):
+            done.append(runner.cmd[0])
+            if runner.cmd[0] == "printf":
+                ready.append(["echo", "after printf"])
+        def _next():
+            if ready:
+                runner = commands.ProgramRunner(ready.pop(0), out.append, err.append, timeout=0.5, onDone=_done)
+                runners.append(runner)
+                return runner
+            if len(done) < 3:
+                return None
+            raise StopIteration
+        commands.runProgramQueue(_next, 2)
+        self.assertEqual(sorted(out), ["a\n", "after printf\n", "b"])
+        self.assertEqual(err, ["oops\n"])
+        self.assertEqual(sorted(done), ["echo", "printf", "sh", "sleep"])
+        sleep = [x for x in runners if x.cmd[0] == "sleep"][0]
+        self.assertTrue(sleep.timedOut)
+        self.assertEqual(sleep.exitCode, -9)
+        self.assertEqual([x.exitCode for x in runners if x.cmd[0] != "sleep"], [0, 0, 0])
+    def test_run_program_queue_start_failure(self):
+        """a program that cannot be started is failed and the rest run"""
+        from igs.utils import commands
+        out = [ ]
+        done = [ ]
+        ready = [["no_such_program"], ["echo", "ran"]]
+        def _next():
+            if ready:
+                return commands.ProgramRunner(ready.pop(0), out.append, None, onDone=done.append)
+            raise StopIteration
+        commands.runProgramQueue(_next, 1)
+        self.assertEqual(out, ["ran\n"])
+        self.assertEqual([x.exitCode for x in done], [127, 0])
+        self.assertTrue(isinstance(done[0].error, OSError))
+    def test_search_genome_grid_stderr_and_timeout(self):
+        """each genome's stderr is kept in its log, and a search that runs
+        past the timeout is killed, or one that cannot start is failed,
+        without stopping the others.  Failed genomes are not merged or
+        reduced"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir("%s" % tdir)
+        open("queries.fasta", "w").write(">Cluster0\nATGCATGC\n")
+        open("g1.fasta.new", "w").write(">contig1\nATGC\n")
+        open("g2.fasta.new", "w").write(">contig1\nATGCA\n")
+        open("g3.fasta.new", "w").write(">contig1\nATG\n")
+        def _search_cmd(query, f, threads):
+            if f.endswith("g2.fasta.new"):
+                return ["sh", "-c", "echo partial; echo slow >&2; exec sleep 5"]
+            if f.endswith("g3.fasta.new"):
+                return ["no_such_search_program"]
+            return ["sh", "-c", "echo searching >&2; cat %s" % query]
+        reduced = [ ]
+        search_genome_grid(tdir, 2, "queries.fasta", "sh", None, _search_cmd, reduce=reduced.append, timeout=0.5)
+        self.assertEqual(open("g1.fasta.new_blast.out").read(), ">Cluster0\nATGCATGC\n")
+        self.assertEqual(glob.glob("g[23].fasta.new_blast.out*"), [])
+        self.assertEqual([os.path.basename(x) for x in reduced], ["g1.fasta.new_blast.out"])
+        self.assertEqual(open("g1.fasta.new.log").read(), "searching\n")
+        self.assertEqual(open("g2.fasta.new.log").read(), "slow\n")
+        self.assertTrue("could not be started" in open("g3.fasta.new.log").read())
+        os.chdir("%s" % curr_dir)
+        shutil.rmtree(tdir)
+
+class Test45(unittest.TestCase):
+    def test_shard_genomes_basic_function(self):
+        """every genome goes to exactly one shard, largest first to the
+        lightest shard, whatever order the manifest lists them in"""
+        genomes = [("a", 50), ("b", 40), ("c", 30), ("d", 20), ("e", 10)]
+        shards = [shard_genomes(genomes, x, 2) for x in [1, 2]]
+        self.assertEqual(shards, [["a", "d", "e"], ["b", "c"]])
+        self.assertEqual([shard_genomes(list(reversed(genomes)), x, 2) for x in [1, 2]], shards)
+        self.assertEqual(shard_genomes(genomes, 3, 3), ["c", "d"])
+        self.assertEqual(parse_shard("3/50"), (3, 50))
+        self.assertRaises(TypeError, parse_shard, "0/2")
+        self.assertRaises(TypeError, parse_shard, "3")
+    def test_complete_shard_files(self):
+        self.assertEqual(complete_shard_files(["x/shard_2_of_2.npz", "x/shard_1_of_2.npz"]),
+                         ["x/shard_1_of_2.npz", "x/shard_2_of_2.npz"])
+        self.assertRaises(TypeError, complete_shard_files, ["shard_1_of_3.npz", "shard_3_of_3.npz"])
+        self.assertRaises(TypeError, complete_shard_files, ["shard_1_of_1.npz", "shard_1_of_2.npz", "shard_2_of_2.npz"])
+        self.assertRaises(TypeError, complete_shard_files, [ ])
+    def test_merge_shard_columns_basic_function(self):
+        """merged shards give what one pass over all genomes gives,
+        in the same genome order"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        line = "%s\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t%s\n"
+        tables = {"A": line % ("Cluster0", 500)+line % ("Cluster0", 420),
+                  "A-1": line % ("Cluster1", 40.5),
+                  "C": line % ("Cluster0", 95)+line % ("Cluster1", 40.5)}
+        ref_scores = {'Cluster0': '500', 'Cluster1': '40.5'}
+        for genome, table in tables.items():
+            open("%s.fasta.new_blast.out" % genome, "w").write(table)
+        whole = hit_table_columns(ref_scores.keys(), ref_scores, 0.7, 75, 1)
+        for shard, genomes in [(1, ["C"]), (2, ["A", "A-1"])]:
+            os.mkdir(str(shard))
+            os.chdir(str(shard))
+            for genome in genomes:
+                open("%s.fasta.new_blast.out" % genome, "w").write(tables[genome])
+            write_shard_columns(os.path.join(tdir, shard_file(shard, 2)),
+                                *hit_table_columns(ref_scores.keys(), ref_scores, 0.7, 75, 1))
+            os.chdir(tdir)
+        store = column_store(os.path.join(tdir, COLUMN_STORE), 2)
+        merged = merge_shard_columns(complete_shard_files(["shard_2_of_2.npz", "shard_1_of_2.npz"]), store)
+        self.assertEqual(os.path.getsize(COLUMN_STORE), 3*2*8)
+        self.assertEqual(merged[0].tolist(), whole[0].tolist())
+        self.assertEqual(merged[1], whole[1])
+        self.assertEqual(merged[1], ["A-1", "A", "C"])
+        self.assertEqual([x.tolist() for x in merged[2]], [x.tolist() for x in whole[2]])
+        self.assertEqual([x.tolist() for x in merged[3]], [x.tolist() for x in whole[3]])
+        self.assertEqual(merged[4], whole[4])
+        open("A.fasta.new", "w").write(">contig1\nATGC\n")
+        write_manifest("manifest", "blastn", "genes.fasta", False, "F", [os.path.join(tdir, "A.fasta.new")])
+        manifest = read_manifest("manifest")
+        self.assertEqual(manifest["genomes"], [("A.fasta.new", 14)])
+        self.assertEqual((manifest["blast"], manifest["protein"], manifest["fast"]), ("blastn", "False", "F"))
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test46(unittest.TestCase):
+    def test_encode_hit_table_round_trip(self):
+        result = (numpy.array([500.0, 0.0]), (numpy.array([2, 0]), numpy.array([500.0, 0.0]), numpy.array([420.5, numpy.inf])), (3, 1, 2))
+        decoded = decode_hit_table(encode_hit_table(result).splitlines(True))
+        self.assertEqual(decoded[0].tolist(), result[0].tolist())
+        self.assertEqual([x.tolist() for x in decoded[1]], [x.tolist() for x in result[1]])
+        self.assertEqual(decoded[2], (3, 1, 2))
+        self.assertRaises(TypeError, decode_hit_table, ["BioPython is not in your PATH, but needs to be\n"])
+    def test_ssh_executor_failed_hosts(self):
+        """genomes of a host that fails are searched on the others, and
+        come back parsed as they would be here.  Each run's directory is
+        removed from the hosts afterwards.  Hosts are stood in for by
+        directories, and the stub blat reports the genome file itself as
+        its hits"""
+        from igs.utils import commands
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        os.mkdir("bin")
+        open("bin/blat", "w").write("#!/bin/sh\ncat \"$3\"\n")
+        os.chmod("bin/blat", 0755)
+        line = "%s\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t%s\n"
+        os.mkdir("run")
+        os.chdir("run")
+        open("queries.fasta", "w").write(">Cluster0\nATGC\n>Cluster1\nATGC\n")
+        open("A.fasta.new", "w").write(line % ("Cluster0", 500)+line % ("Cluster0", 420))
+        open("B.fasta.new", "w").write(line % ("Cluster1", 40.5))
+        open("C.fasta.new", "w").write("")
+        env = {"PATH": "%s:%s" % (os.path.join(tdir, "bin"), os.environ["PATH"]),
+               "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}
+        def _run(host, cmd, stdoutf, stderrf):
+            if "flaky" == host and "ls_bsr.worker" in cmd:
+                return commands.ProgramRunner("exit 255", stdoutf, stderrf)
+            cmd = cmd.replace("/remote", os.path.join(tdir, host)).replace("python ", "%s " % sys.executable)
+            return commands.ProgramRunner(cmd, stdoutf, stderrf, addEnv=env)
+        def _copy(host, src, dst):
+            if "down" == host:
+                return commands.ProgramRunner("exit 1", None, None)
+            return commands.ProgramRunner(["cp", src, dst.replace("/remote", os.path.join(tdir, host))], None, None)
+        ref_scores = {'Cluster0': '500', 'Cluster1': '40.5'}
+        execute = ssh_executor(["down", "flaky", "up"], "/remote", 2, "F", -5, 1, 0.7, 75, run=_run, copy=_copy)
+        results = {}
+        execute("queries.fasta", "blat", None, ref_scores.keys(), ref_scores, results)
+        for genome in ["A", "B", "C"]:
+            os.rename("%s.fasta.new" % genome, "%s.fasta.new_blast.out" % genome)
+        expected = hit_table_columns(ref_scores.keys(), ref_scores, 0.7, 75, 1)
+        for genome in ["A", "B", "C"]:
+            os.rename("%s.fasta.new_blast.out" % genome, "%s.fasta.new" % genome)
+        self.assertEqual(sorted(results), [os.path.join(tdir, "run", "%s.fasta.new_blast.out" % x) for x in ["A", "B", "C"]])
+        parsed = hit_table_columns(ref_scores.keys(), ref_scores, 0.7, 75, 1, results=results)
+        self.assertEqual([x.tolist() for x in parsed[2]], [x.tolist() for x in expected[2]])
+        self.assertEqual([x.tolist() for x in parsed[3]], [x.tolist() for x in expected[3]])
+        self.assertEqual(parsed[4], expected[4])
+        self.assertEqual([os.listdir(os.path.join(tdir, x)) for x in ["down", "flaky", "up"]], [[ ], [ ], [ ]])
+        execute = ssh_executor(["up"], "/remote", 2, "F", -5, 1, 0.7, 75, 30, run=_run, copy=_copy)
+        execute("queries.fasta", "blat", None, ref_scores.keys(), ref_scores, None)
+        self.assertEqual(open("A.fasta.new_blast.out").read(), open("A.fasta.new").read())
+        self.assertEqual(os.listdir(os.path.join(tdir, "up")), [ ])
+        self.assertRaises(TypeError, ssh_executor(["down"], "/remote", 2, "F", -5, 1, 0.7, 75, run=_run, copy=_copy),
+                          "queries.fasta", "blat", None, ref_scores.keys(), ref_scores, results)
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_parse_hosts(self):
+        """hosts without a slot count of their own get the default"""
+        self.assertEqual(parse_hosts(["h1", "h2:4"], 2), {"h1": 2, "h2": 4})
+        self.assertRaises(TypeError, parse_hosts, ["h1:x"], 2)
+        self.assertRaises(TypeError, parse_hosts, ["h1:0"], 2)
+        self.assertRaises(TypeError, parse_hosts, [":3"], 2)
+
+class Test47(unittest.TestCase):
+    def test_merge_matrices_basic_function(self):
+        """matrices over other genomes are joined side by side and
+        matrices over other genes are stacked, whatever order their
+        rows and columns are in"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        open("run1", "w").write("\tA\tB\nCluster0\t1.00\t0.50\nCluster1\t0.20\t0.00\n")
+        open("run2", "w").write("\tC\nCluster1\t0.90\nCluster0\t0.80\n")
+        open("markers", "w").write("\tC\tA\tB\nmarker0\t0.10\t0.30\t0.40\n")
+        self.assertEqual(merge_matrices(["run1", "run2", "markers"], "merged", "conflicts"), (3, 3, 0, 0, 0))
+        self.assertEqual(open("merged").read(), "\tA\tB\tC\nCluster0\t1.00\t0.50\t0.80\nCluster1\t0.20\t0.00\t0.90\n"
+                                                "marker0\t0.30\t0.40\t0.10\n")
+        self.assertEqual(open("conflicts").read(), "gene\tgenome\tkept\tconflicting\tmatrix\n")
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_merge_matrices_duplicates_and_conflicts(self):
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        open("run1", "w").write("\tA\tB\nCluster0\t1.00\t0.50\nCluster1\t0.20\t0.00\n")
+        open("run2", "w").write("\tB\tC\nCluster0\t0.5\t0.80\nCluster1\t0.30\t0.90\nCluster2\t1.00\t1.00\n")
+        self.assertEqual(merge_matrices(["run1", "run2"], "merged", "conflicts", "NA", 0.01), (3, 3, 1, 1, 1))
+        self.assertEqual(open("merged").read().splitlines()[1:], ["Cluster0\t1.00\t0.50\t0.80", "Cluster1\t0.20\t0.00\t0.90",
+                                                                  "Cluster2\tNA\t1.00\t1.00"])
+        self.assertEqual(open("conflicts").read().splitlines()[1:], ["Cluster1\tB\t0.00\t0.30\trun2"])
+        open("bad", "w").write("\tA\tA\nCluster0\t1.00\t0.50\n")
+        self.assertRaises(TypeError, merge_matrices, ["run1", "bad"], "merged", "conflicts")
+        open("short", "w").write("\tA\tC\nCluster0\t1.00\n")
+        self.assertRaises(TypeError, merge_matrices, ["run1", "short"], "merged", "conflicts")
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+
+class Test48(unittest.TestCase):
+    def test_column_store_basic_function(self):
+        """columns kept on disk come back as the same matrix columns,
+        duplicate summary and hit counts as columns kept in memory"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        os.chdir(tdir)
+        line = "%s\tc1\t100.00\t15\t0\t0\t1\t15\t1\t15\t1e-07\t%s\n"
+        open("A.fasta.new_blast.out", "w").write(line % ("Cluster0", 500)+line % ("Cluster0", 420))
+        open("B.fasta.new_blast.out", "w").write(line % ("Cluster1", 40.5))
+        open("C.fasta.new_blast.out", "w").write("")
+        ref_scores = {'Cluster0': '500', 'Cluster1': '40.5'}
+        whole = hit_table_columns(ref_scores.keys(), ref_scores, 0.7, 75, 2)
+        store = column_store(os.path.join(tdir, COLUMN_STORE), 2)
+        results = {}
+        hit_table_reducer(ref_scores.keys(), ref_scores, 0.7, 75, results, store)(os.path.join(tdir, "B.fasta.new_blast.out"))
+        stored = hit_table_columns(ref_scores.keys(), ref_scores, 0.7, 75, 2, "F", results, store)
+        self.assertEqual(store['reports'][0], os.path.join(tdir, "B.fasta.new_blast.out"))
+        self.assertEqual(os.path.getsize(COLUMN_STORE), 3*2*8)
+        self.assertEqual(stored[1], ["A", "B", "C"])
+        self.assertEqual([x.tolist() for x in stored[2]], [x.tolist() for x in whole[2]])
+        self.assertEqual([x.tolist() for x in stored[3]], [x.tolist() for x in whole[3]])
+        self.assertEqual(stored[4], whole[4])
+        os.chdir(curr_dir)
+        shutil.rmtree(tdir)
+    def test_write_bsr_matrix_blocks(self):
+        """the matrix is the same whatever the block size, and scores of
+        queries without a reference score are divided by 1000"""
+        tdir = tempfile.mkdtemp(prefix="filetest_",)
+        names = numpy.array(["Cluster0", "Cluster1", "Cluster2"])
+        ref = numpy.array([500.0, numpy.nan, 40.5])
+        columns = [numpy.array([500.0, 100.0, 0.0]), numpy.array([250.0, 0.0, 40.5])]
+        expected = "\tA\tB\nCluster0\t1.00\t0.50\nCluster1\t0.10\t0.00\nCluster2\t0.00\t1.00\n"
+        for mem_limit in [1, 32, 10**9]:
+            write_bsr_matrix(os.path.join(tdir, "matrix"), names, ref, ["A", "B"], columns, mem_limit)
+            self.assertEqual(open(os.path.join(tdir, "matrix")).read(), expected)
+        shutil.rmtree(tdir)
+
 if __name__ == "__main__":
     unittest.main()
     main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""checks the gene x genome pairs skipped by the k-mer
+prescreen against a BSR matrix from a run without it"""
+
+from optparse import OptionParser
+from ls_bsr.util import prescreen_misses
+import sys
+
+def test_file(option, opt_str, value, parser):
+    try:
+        with open(value): setattr(parser.values, option.dest, value)
+    except IOError:
+        print '%s file cannot be opened' % option
+        sys.exit()
+
+def main(skipped, matrix, threshold):
+    misses, checked = prescreen_misses(skipped, matrix, threshold)
+    for query, genome, containment, bsr in misses:
+        print "%s\t%s\t%.3f\t%.2f" % (query, genome, containment, bsr)
+    if checked:
+        print "%s of %s skipped pairs have a BSR of %s or more (%.2f%%)" % (len(misses), checked, threshold, 100*len(misses)/float(checked))
+    else:
+        print "no skipped pairs were found in the matrix"
+
+if __name__ == "__main__":
+    usage="usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--skipped", dest="skipped",
+                      help="/path/to/prescreen_skipped.txt [REQUIRED]",
+                      action="callback", callback=test_file, type="string")
+    parser.add_option("-b", "--bsr_matrix", dest="matrix",
+                      help="/path/to/bsr_matrix from a run without the prescreen [REQUIRED]",
+                      action="callback", callback=test_file, type="string")
+    parser.add_option("-t", "--threshold", dest="threshold",
+                      help="BSR value counted as a missed gene, defaults to 0.4",
+                      action="store", default="0.4", type="float")
+    options, args = parser.parse_args()
+
+    mandatories = ["skipped", "matrix"]
+    for m in mandatories:
+        if not options.__dict__[m]:
+            print "\nMust provide %s.\n" %m
+            parser.print_help()
+            exit(-1)
+
+    main(options.skipped, options.matrix, options.threshold)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""merges BSR matrices from separate runs, side by side when
+they share genes and stacked when they share genomes"""
+
+from optparse import OptionParser
+from ls_bsr.util import merge_matrices
+import sys
+
+def test_files(option, opt_str, value, parser):
+    for x in value.split(","):
+        try:
+            with open(x): pass
+        except IOError:
+            print '%s file cannot be opened' % x
+            sys.exit()
+    setattr(parser.values, option.dest, value.split(","))
+
+def main(matrices, prefix, missing, tolerance):
+    try:
+        genes, genomes, duplicates, conflicts, empty = merge_matrices(matrices, "%s_bsr_matrix.txt" % prefix,
+                                                                      "%s_conflicts.txt" % prefix, missing, tolerance)
+    except TypeError, err:
+        print err
+        sys.exit()
+    print "%s genes x %s genomes written to %s_bsr_matrix.txt" % (genes, genomes, prefix)
+    if duplicates:
+        print "%s values were in more than one matrix and agreed" % duplicates
+    if conflicts:
+        print "%s values were in more than one matrix and disagreed, the first was kept; see %s_conflicts.txt" % (conflicts, prefix)
+    if empty:
+        print "%s values were in no matrix and are written as %s" % (empty, missing)
+
+if __name__ == "__main__":
+    usage="usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-b", "--bsr_matrices", dest="matrices",
+                      help="comma separated /path/to/bsr_matrix files [REQUIRED]",
+                      action="callback", callback=test_files, type="string")
+    parser.add_option("-p", "--prefix", dest="prefix",
+                      help="prefix for the output files, defaults to merged",
+                      action="store", default="merged", type="string")
+    parser.add_option("-m", "--missing", dest="missing",
+                      help="value written for gene x genome pairs in no matrix, defaults to NA",
+                      action="store", default="NA", type="string")
+    parser.add_option("-t", "--tolerance", dest="tolerance",
+                      help="largest difference between values of the same pair that is not a conflict, defaults to 0",
+                      action="store", default="0", type="float")
+    options, args = parser.parse_args()
+
+    mandatories = ["matrices"]
+    for m in mandatories:
+        if not options.__dict__[m]:
+            print "\nMust provide %s.\n" %m
+            parser.print_help()
+            exit(-1)
+
+    main(options.matrices, options.prefix, options.missing, options.tolerance)
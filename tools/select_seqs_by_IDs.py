@@ -3,8 +3,10 @@
 """takes a list of record.ids and returns to you the sequences 
 from a fasta list that are part of the list"""
 
-from Bio import SeqIO
 from optparse import OptionParser
+from ls_bsr.util import read_fasta
+from ls_bsr.util import write_fasta
+from ls_bsr.util import fasta_id
 import sys
 
 def test_file(option, opt_str, value, parser):
@@ -15,15 +17,11 @@ def test_file(option, opt_str, value, parser):
         sys.exit()
 
 def main(in_fasta, ids, out_fasta):
-    infile = open(in_fasta, "U")
-    data = open(ids, "U").read().splitlines()
+    data = set(open(ids, "U").read().splitlines())
     output_handle = open(out_fasta, "w")
-    seqrecords=[ ]
-    for record in SeqIO.parse(infile, "fasta"):
-        if record.id in data:
-            seqrecords.append(record)
-    SeqIO.write(seqrecords, output_handle, "fasta") 
-    infile.close()
+    for title, seq in read_fasta(in_fasta, True):
+        if fasta_id(title) in data:
+            write_fasta(output_handle, title, seq, 60)
     output_handle.close()
 
 if __name__ == "__main__":